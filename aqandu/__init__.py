@@ -6,6 +6,7 @@ from flask import Flask
 from flask_caching import Cache
 from google.cloud import bigquery
 import logging
+import signal
 import time
 import sys
 
@@ -26,12 +27,77 @@ app.config["CACHE_DEFAULT_TIMEOUT"] = 1
 cache = Cache(app)
 assets.init(app)
 
+# where the modeling routes get their measurements from, one of measurement_store.STORE_KINDS
+MEASUREMENT_STORE = os.getenv("MEASUREMENT_STORE", "bigquery")
+
 os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = "aqandu/aqandu.json"
-bq_client = bigquery.Client(project=PROJECT_ID)
+# the fake store runs completely offline, so don't ask for credentials
+if MEASUREMENT_STORE == "fake":
+    bq_client = None
+else:
+    bq_client = bigquery.Client(project=PROJECT_ID)
+
+from aqandu import measurement_store
+source_table_map = {
+    "AirU": os.getenv("AIRU_TABLE_ID"),
+    "PurpleAir": os.getenv("PURPLEAIR_TABLE_ID"),
+    "DAQ": os.getenv("DAQ_TABLE_ID"),
+}
+sensor_store = measurement_store.createStore(
+    MEASUREMENT_STORE,
+    client=bq_client,
+    source_table_map=source_table_map,
+    path=os.getenv("MEASUREMENT_STORE_PATH", "measurement_store"))
+
+# remember what has already been fetched so that overlapping estimate requests only fetch what is new
+FETCH_CACHE_MAX_MB = float(os.getenv("FETCH_CACHE_MAX_MB", "128"))
+if FETCH_CACHE_MAX_MB > 0:
+    from aqandu import fetch_cache
+    import numpy
+    sensor_store = fetch_cache.FetchCache(
+        sensor_store,
+        max_bytes=int(FETCH_CACHE_MAX_MB * 1024 * 1024),
+        settle=numpy.timedelta64(int(os.getenv("FETCH_CACHE_SETTLE_MINUTES", "180")), "m"))
 
-from aqandu import utils
+# /api/liveSensors answers from a table of the latest reading per sensor that a background thread keeps
+# up to date (see live_snapshot.py), started here so that no request waits for it.  LIVE_SNAPSHOT_POLL_SECONDS=0
+# turns it off.  The live map always reads the tables themselves -- a parquet store is only as fresh as its last sync.
+LIVE_SNAPSHOT_POLL_SECONDS = float(os.getenv("LIVE_SNAPSHOT_POLL_SECONDS", "30"))
+if LIVE_SNAPSHOT_POLL_SECONDS > 0:
+    from aqandu.live_snapshot import LiveSnapshot
+    live_sensor_snapshot = LiveSnapshot(
+        measurement_store.createStore("fake" if MEASUREMENT_STORE == "fake" else "bigquery",
+                                      client=bq_client, source_table_map=source_table_map),
+        poll_seconds=LIVE_SNAPSHOT_POLL_SECONDS,
+        max_age_seconds=float(os.getenv("LIVE_SNAPSHOT_MAX_AGE_SECONDS", "180")))
+    live_sensor_snapshot.start()
+else:
+    live_sensor_snapshot = None
+
+from aqandu import elevation
 # WARNING - current status of the elevation_map.mat files is that longitude is the first coordinate
-elevation_interpolator = utils.setupElevationInterpolator('elevation_map.mat')
+# (memory-mapped from elevation_map.npy, see elevation.py; ELEVATION_INTERPOLATION is cubic or linear)
+ELEVATION_INTERPOLATION = os.getenv("ELEVATION_INTERPOLATION", "cubic")
+elevation_interpolator = elevation.loadElevationMap('elevation_map.mat', kind=ELEVATION_INTERPOLATION)
+
+# per-sensor UTM coordinates, elevation and type, computed once per sensor (SENSOR_REGISTRY_PATH='' keeps it
+# in memory only)
+from aqandu.registry import SensorRegistry
+elevation_map_stat = os.stat('elevation_map.mat')
+sensor_registry = SensorRegistry(
+    elevation_interpolator,
+    path=os.getenv("SENSOR_REGISTRY_PATH", "sensor_registry.npz"),
+    elevation_map_spec=(f"elevation_map.mat {elevation_map_stat.st_size} {elevation_map_stat.st_mtime} "
+                        f"{ELEVATION_INTERPOLATION}"))
+
+# the bounding box, correction factors and length scales, reloaded when the files change or on SIGHUP
+from aqandu.model_config import ModelConfig
+model_config = ModelConfig('bounding_box.csv', 'correction_factors.csv', 'length_scales.csv')
+try:
+    signal.signal(signal.SIGHUP, lambda signum, frame: model_config.requestReload())
+except (AttributeError, ValueError):
+    # no SIGHUP (windows), or not imported on the main thread
+    logging.info('Not reloading the model configuration on SIGHUP')
 
 
 from aqandu import api_routes, basic_routes
@@ -1,8 +1,16 @@
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 import os
+import click
+import functools
+import itertools
+import time
 from aqandu import app, bq_client, bigquery, utils, elevation_interpolator, gaussian_model_utils, cache
+from aqandu import sensor_registry, model_config
+from aqandu import measurement_store, fetch_cache, sensor_store, MEASUREMENT_STORE, rollups, telemetry
+from aqandu import streaming, live_sensor_snapshot
+from aqandu.sensor_data import SensorData
 from dotenv import load_dotenv
-from flask import request, jsonify
+from flask import request, jsonify, json, Response, stream_with_context
 # regular expression stuff for decoding quer 
 import re
 import numpy as np
@@ -18,6 +26,12 @@ SOURCE_TABLE_MAP = {
     "DAQ": DAQ_TABLE_ID,
 }
 VALID_SENSOR_SOURCES = ["AirU", "PurpleAir", "DAQ", "all"]
+# the aggregation functions of /api/timeAggregatedDataFrom
+SQL_FUNCTIONS = {
+    "mean": "AVG",
+    "min": "MIN",
+    "max": "MAX",
+}
 TIME_KERNEL_FACTOR_PADDING = 3.0
 SPACE_KERNEL_FACTOR_PADDING = 2.
 MIN_ACCEPTABLE_ESTIMATE = -5.0
@@ -26,7 +40,41 @@ MIN_ACCEPTABLE_ESTIMATE = -5.0
 # in units of time-scale parameter
 # This is a tradeoff between looping through the data multiple times and having to do the fft inversion (n^2) of large time matrices
 # If the bin size is 10 mins, and the and the time scale is 20 mins, then a value of 30 would give 30*20/10, which is a matrix size of 60.  Which is not that big.  
-TIME_SEQUENCE_SIZE = 20.
+# The model is solved in Kronecker factored form (see gaussian_model.py), which only needs the sensors x sensors and
+# bins x bins matrices, so the chunks can be much longer than when it built the (sensors*bins)^2 matrix (this was 20).
+# With the 8 minute bins and a 15 minute time scale a chunk is 30 hours, about 240 bins with the padding.
+TIME_SEQUENCE_SIZE = 120.
+
+# /api/rawDataFromSensors: the most sensors in one request, and the most measurements per streamed line
+MAX_BATCH_SENSORS = 200
+RAW_DATA_CHUNK_SIZE = 1000
+RAW_DATA_FORMATS = ["ndjson", "columns"]
+
+# the estimate routes compute the variance of the estimates unless they are given variance=false (for callers
+# such as map animations that only show PM2.5)
+VARIANCE_OPTIONS = ["true", "false"]
+
+# MAP_TILE_CELLS > 0 has getEstimateMap split grids bigger than that into tiles of about MAP_TILE_CELLS x
+# MAP_TILE_CELLS cells (see estimateMapTiles), each estimated by its own models from only the sensors within
+# MAP_TILE_RADIUS_FACTOR latlon length scales of the tile, instead of one model of every sensor near the map for
+# all of the cells.  Neighbouring tiles overlap by MAP_TILE_OVERLAP_CELLS cells, where their estimates are
+# blended.  The tiled estimates are an approximation of the whole map's (see benchmarkTiles for how far apart
+# they are).  0 (the default) turns it off.
+MAP_TILE_CELLS = int(os.getenv("MAP_TILE_CELLS", "0"))
+MAP_TILE_OVERLAP_CELLS = int(os.getenv("MAP_TILE_OVERLAP_CELLS", "2"))
+MAP_TILE_RADIUS_FACTOR = 3.
+
+# STREAMING_PIPELINE=1 has the estimate routes screen, correct and bin the measurements batch by batch as
+# they are read (see streaming.py) instead of loading the whole query first -- for long time ranges, where
+# memory would otherwise grow with the number of measurements.  STREAMING_BATCH_ROWS is the batch size.
+STREAMING_PIPELINE = os.getenv("STREAMING_PIPELINE", "0") == "1"
+STREAMING_BATCH_ROWS = int(os.getenv("STREAMING_BATCH_ROWS", str(measurement_store.BATCH_ROWS)))
+
+
+# the routes that still query the tables directly need a bigquery client, which MEASUREMENT_STORE=fake doesn't
+# set up, so they answer with this instead
+def bigqueryUnavailable():
+    return f"This needs bigquery, which isn't configured with MEASUREMENT_STORE={MEASUREMENT_STORE}", 503
 
 
 @app.route("/api/rawDataFrom", methods=["GET"])
@@ -52,6 +100,9 @@ def rawDataFrom():
         msg = f"Incorrect date format, should be {utils.DATETIME_FORMAT}, e.g.: 2018-01-03T20:00:00Z"
         return msg, 400
 
+    if bq_client is None:
+        return bigqueryUnavailable()
+
     # Define the BigQuery query
     query = f"""
         SELECT
@@ -74,10 +125,12 @@ def rawDataFrom():
 
     # Run the query and collect the result
     measurements = []
+    started = time.time()
     query_job = bq_client.query(query, job_config=job_config)
     rows = query_job.result()
     for row in rows:
         measurements.append({"PM2_5": row.PM2_5, "time": row.time.strftime(utils.DATETIME_FORMAT)})
+    telemetry.recordJob(query_job, time.time() - started, len(measurements))
     tags = [{
         "ID": id,
         "SensorSource": sensor_source,
@@ -87,8 +140,119 @@ def rawDataFrom():
     return jsonify({"data": measurements, "tags": tags})
 
 
+# The raw data of many sensors at once, e.g. for a dashboard plotting dozens of them.  There is one query
+# per source table (not per sensor), and the result is streamed back as it is read, one JSON object per line,
+# grouped by sensor.  A sensor with many measurements is split over several lines of at most
+# RAW_DATA_CHUNK_SIZE measurements.  Each line has the ID, SensorSource and SensorModel of the sensor and either
+#   format=ndjson:  "data": [{"PM2_5": ..., "time": ...}, ...]  (like rawDataFrom)
+#   format=columns: "PM2_5": [...], "time": [...]
+@app.route("/api/rawDataFromSensors", methods=["GET"])
+def rawDataFromSensors():
+    # Get the arguments from the query string
+    start = request.args.get('start')
+    end = request.args.get('end')
+    output_format = request.args.get('format', 'ndjson')
+
+    ids_by_source, msg = sensorsBySource(request.args.get('ids', ''), request.args.get('sensorSources', ''))
+    if msg is not None:
+        return msg, 400
+
+    # Check that the data is formatted correctly
+    if not utils.validateDate(start) or not utils.validateDate(end):
+        msg = f"Incorrect date format, should be {utils.DATETIME_FORMAT}, e.g.: 2018-01-03T20:00:00Z"
+        return msg, 400
+
+    if output_format not in RAW_DATA_FORMATS:
+        return f"format is invalid. It must be one of {RAW_DATA_FORMATS}", 400
+
+    if bq_client is None:
+        return bigqueryUnavailable()
+
+    def generateLines():
+        for sensor_source, source_ids in ids_by_source.items():
+            for line in rawDataLines(sensor_source, source_ids, start, end, output_format):
+                yield json.dumps(line) + "\n"
+
+    return Response(stream_with_context(generateLines()), mimetype="application/x-ndjson")
+
+
+# parses the comma separated ids and sensorSources of rawDataFromSensors into {source: [ids]}.  Returns that and
+# None, or None and the message when they are invalid.
+def sensorsBySource(ids_arg, sources_arg):
+    ids = ids_arg.split(',')
+    sensor_sources = sources_arg.split(',')
+
+    # Check the IDs are valid
+    if any(id == "" or id == "undefined" for id in ids):
+        return None, "ids is invalid. It must be a comma separated list of strings that are not '' or 'undefined'."
+
+    if len(ids) > MAX_BATCH_SENSORS:
+        return None, f"ids is invalid. At most {MAX_BATCH_SENSORS} sensors can be requested at once."
+
+    # one source for all of the sensors, or one per sensor
+    if len(sensor_sources) == 1:
+        sensor_sources = sensor_sources * len(ids)
+    if len(sensor_sources) != len(ids) or any(source not in SOURCE_TABLE_MAP for source in sensor_sources):
+        return None, f"sensorSources is invalid. It must be one of {list(SOURCE_TABLE_MAP)}, or one per id"
+
+    ids_by_source = {}
+    for id, sensor_source in zip(ids, sensor_sources):
+        ids_by_source.setdefault(sensor_source, []).append(id)
+    return ids_by_source, None
+
+
+# runs the query for the sensors of one source and turns the rows (ordered by ID, then time) into lines
+def rawDataLines(sensor_source, ids, start, end, output_format):
+    query = f"""
+        SELECT
+            ID,
+            {measurement_store.sourceSelectList(sensor_source, ["SensorModel"])},
+            PM2_5,
+            time
+        FROM `{SOURCE_TABLE_MAP[sensor_source]}`
+        WHERE ID IN UNNEST(@ids)
+            AND time >= @start
+            AND time <= @end
+        ORDER BY ID, time
+    """
+
+    job_config = bigquery.QueryJobConfig(
+        query_parameters=[
+            bigquery.ArrayQueryParameter("ids", "STRING", ids),
+            bigquery.ScalarQueryParameter("start", "TIMESTAMP", start),
+            bigquery.ScalarQueryParameter("end", "TIMESTAMP", end),
+        ]
+    )
+
+    # the rows are read page by page as the lines are sent
+    started = time.time()
+    query_job = bq_client.query(query, job_config=job_config)
+    rows = query_job.result()
+    chunk = []
+    num_rows = 0
+    for row in rows:
+        if chunk and (row.ID != chunk[0].ID or len(chunk) == RAW_DATA_CHUNK_SIZE):
+            yield rawDataLine(sensor_source, chunk, output_format)
+            chunk = []
+        chunk.append(row)
+        num_rows += 1
+    if chunk:
+        yield rawDataLine(sensor_source, chunk, output_format)
+    telemetry.recordJob(query_job, time.time() - started, num_rows)
+
+
+def rawDataLine(sensor_source, rows, output_format):
+    line = {"ID": str(rows[0].ID), "SensorSource": sensor_source, "SensorModel": rows[0].SensorModel}
+    times = [row.time.strftime(utils.DATETIME_FORMAT) for row in rows]
+    if output_format == "columns":
+        line["PM2_5"] = [row.PM2_5 for row in rows]
+        line["time"] = times
+    else:
+        line["data"] = [{"PM2_5": row.PM2_5, "time": row_time} for row, row_time in zip(rows, times)]
+    return line
+
+
 @app.route("/api/liveSensors", methods=["GET"])
-@cache.cached(timeout=59, query_string=True)
 def liveSensors():
     # Get the arguments from the query string
     sensor_source = request.args.get('sensorSource')
@@ -98,13 +262,32 @@ def liveSensors():
         msg = f"sensor_source is invalid. It must be one of {VALID_SENSOR_SOURCES}"
         return msg, 400
 
+    # answer from the in-memory snapshot (started with the app, see __init__.py), or with the queries if it
+    # hasn't loaded yet, isn't up to date or is turned off -- never wait for the snapshot itself
+    if live_sensor_snapshot is not None and live_sensor_snapshot.isFresh():
+        response = jsonify(live_sensor_snapshot.sensors(sensor_source))
+        response.headers["X-Snapshot-Age"] = f"{live_sensor_snapshot.age():.1f}"
+    elif bq_client is None and live_sensor_snapshot is not None:
+        retry_after = str(int(live_sensor_snapshot.poll_seconds))
+        return "The live sensor snapshot isn't loaded yet", 503, {"Retry-After": retry_after}
+    elif bq_client is None:
+        return bigqueryUnavailable()
+    else:
+        response = jsonify(queryLiveSensors(sensor_source))
+        response.headers["X-Snapshot-Age"] = "none"
+    return response
+
+
+# the latest measurement of each sensor that reported recently, straight from the tables
+@cache.memoize(timeout=59)
+def queryLiveSensors(sensor_source):
     # Define the BigQuery query
     one_hour_ago = datetime.utcnow() - timedelta(hours=1)  # AirU + PurpleAir sensors have reported in the last hour
     three_hours_ago = datetime.utcnow() - timedelta(hours=3)  # DAQ sensors have reported in the 3 hours
-    query_list = []
+    queries = {}
 
     if sensor_source == "AirU" or sensor_source == "all":
-        query_list.append(
+        queries["AirU"] = (
             f"""(
                 SELECT a.ID, time, PM2_5, Latitude, Longitude, SensorModel, 'AirU' as SensorSource
                 FROM `{AIRU_TABLE_ID}` as a
@@ -119,7 +302,7 @@ def liveSensors():
         )
 
     if sensor_source == "PurpleAir" or sensor_source == "all":
-        query_list.append(
+        queries["PurpleAir"] = (
             f"""(
                 SELECT a.ID, time, PM2_5, Latitude, Longitude, '' as SensorModel, 'PurpleAir' as SensorSource
                 FROM `{PURPLEAIR_TABLE_ID}` as a
@@ -134,7 +317,7 @@ def liveSensors():
         )
 
     if sensor_source == "DAQ" or sensor_source == "all":
-        query_list.append(
+        queries["DAQ"] = (
             f"""(
                 SELECT a.ID, time, PM2_5, Latitude, Longitude, '' as SensorModel, 'DAQ' as SensorSource
                 FROM `{DAQ_TABLE_ID}` as a
@@ -148,14 +331,13 @@ def liveSensors():
             )"""
         )
 
-    # Build the actual query from the list of options
-    query = " UNION ALL ".join(query_list)
-
-    # Run the query and collect the result
+    # Run the queries side by side and collect the result
+    streams = [
+        measurement_store.streamRows(f"{source} live sensors query", lambda query=query: bq_client.query(query))
+        for source, query in queries.items()
+    ]
     sensor_list = []
-    query_job = bq_client.query(query)
-    rows = query_job.result()
-    for row in rows:
+    for row in itertools.chain(*streams):
         sensor_list.append(
             {
                 "ID": str(row.ID),
@@ -168,7 +350,44 @@ def liveSensors():
             }
         )
 
-    return jsonify(sensor_list)
+    return sensor_list
+
+
+# the elevations of a map grid only depend on the grid, so maps of the same area share them
+@functools.lru_cache(maxsize=64)
+def mapElevations(lat_lo, lat_hi, lon_lo, lon_hi, lat_res, lon_res):
+    lon_vector, lat_vector = utils.interpolateQueryLocations(lat_lo, lat_hi, lon_lo, lon_hi, lat_res, lon_res)
+    elevations = elevation_interpolator(lon_vector, lat_vector)
+    elevations.flags.writeable = False
+    return elevations
+
+
+# parses the lat-lon box and the grid size of getEstimateMap.  Returns (lat_lo, lat_hi, lon_lo, lon_hi, lat_size,
+# lon_size) and None, or None and the message when they are invalid.
+def mapGrid(args):
+    try:
+        lat_hi = float(args.get('lat_hi'))
+        lat_lo = float(args.get('lat_lo'))
+        lon_hi = float(args.get('lon_hi'))
+        lon_lo = float(args.get('lon_lo'))
+    except ValueError:
+        return None, 'lat, lon, lat_res, be floats in the lat-lon (not UTM) case'
+    try:
+        lat_size = int(args.get('lat_size'))
+        lon_size = int(args.get('lon_size'))
+    except ValueError:
+        return None, 'lat, lon, sizes must be ints (not UTM) case'
+    return (lat_lo, lat_hi, lon_lo, lon_hi, lat_size, lon_size), None
+
+
+# the estimates on the (lats x lons) grid of getEstimateMap, tile by tile (computeEstimatesForMap) when
+# MAP_TILE_CELLS is set and the grid is bigger than that, otherwise for all of the cells as query locations
+def computeEstimatesForGrid(query_dates, lat_vector, lon_vector, elevations, variance=True):
+    if MAP_TILE_CELLS > 0 and max(lat_vector.shape[0], lon_vector.shape[0]) > MAP_TILE_CELLS:
+        return computeEstimatesForMap(query_dates, lat_vector, lon_vector, elevations, variance=variance)
+    locations_lon, locations_lat = np.meshgrid(lon_vector, lat_vector)
+    query_locations = np.column_stack((locations_lat.flatten(), locations_lon.flatten()))
+    return computeEstimatesForLocations(query_dates, query_locations, elevations.flatten(), variance=variance)
 
 
 @app.route("/api/getEstimateMap", methods=["GET"])
@@ -185,28 +404,25 @@ def getEstimateMap():
 
     # Get the arguments from the query string
     if not UTM:
-        try:
-            lat_hi = float(request.args.get('lat_hi'))
-            lat_lo = float(request.args.get('lat_lo'))
-            lon_hi = float(request.args.get('lon_hi'))
-            lon_lo = float(request.args.get('lon_lo'))
-        except ValueError:
-            return 'lat, lon, lat_res, be floats in the lat-lon (not UTM) case', 400
-        try:
-            lat_size = int(request.args.get('lat_size'))
-            lon_size = int(request.args.get('lon_size'))
-        except ValueError:
-            return 'lat, lon, sizes must be ints (not UTM) case', 400
+        grid, msg = mapGrid(request.args)
+        if msg is not None:
+            return msg, 400
+        lat_lo, lat_hi, lon_lo, lon_hi, lat_size, lon_size = grid
 
         lat_res = (lat_hi-lat_lo)/float(lat_size)
         lon_res = (lon_hi-lon_lo)/float(lon_size)
 
+    query_variance = request.args.get('variance', 'true')
+    if query_variance not in VARIANCE_OPTIONS:
+        return f"variance must be one of {VARIANCE_OPTIONS}", 400
+    query_variance = query_variance == 'true'
+
     query_date = request.args.get('date')
     if not utils.validateDate(query_date):
         msg = f"Incorrect date format, should be {utils.DATETIME_FORMAT}, e.g.: 2018-01-03T20:00:00Z"
         return msg, 400
 
-    query_datetime = utils.parseDateString(query_date)
+    query_datetime = utils.parseDateString64(query_date)
 
     app.logger.info((
         f"Query parameters: lat_lo={lat_lo} lat_hi={lat_hi}  lon_lo={lon_lo} lon_hi={lon_hi} lat_res={lat_res} lon_res={lon_res} date={query_datetime}"
@@ -236,13 +452,8 @@ def getEstimateMap():
 #        query_locations_
         return 'UTM not yet supported', 400
 
-    elevations = elevation_interpolator(lon_vector, lat_vector)
-    locations_lon, locations_lat = np.meshgrid(lon_vector, lat_vector)
-    query_lats = locations_lat.flatten()
-    query_lons= locations_lon.flatten()
-    query_elevations = elevations.flatten()
+    elevations = mapElevations(lat_lo, lat_hi, lon_lo, lon_hi, lat_res, lon_res)
     query_dates = np.array([query_datetime])
-    query_locations = np.column_stack((query_lats, query_lons))    
 
 #   # step 3, query relevent data
 #   # for this compute a circle center at the query volume.  Radius is related to lenth scale + the size fo the box.
@@ -261,19 +472,24 @@ def getEstimateMap():
 #     if not ((zone_num_lo == zone_num_hi) and (zone_let_lo == zone_let_hi)):
 #         return 'Requested region spans UTM zones', 400        
 
-    yPred, yVar = computeEstimatesForLocations(query_dates, query_locations, query_elevations)
-    
+    result = computeEstimatesForGrid(query_dates, lat_vector, lon_vector, elevations, variance=query_variance)
+    # an error message and code
+    if isinstance(result[0], str):
+        return result
+    yPred, yVar, status = result
+
     # yPred, yVar = gaussian_model_utils.estimateUsingModel(
     #     model, locations_lat, locations_lon, elevations, [query_datetime], time_offset)
 
     elevations = (elevations).tolist()
     yPred = yPred.reshape((lat_size, lon_size))
-    yVar = yVar.reshape((lat_size, lon_size))
     estimates = yPred.tolist()
-    variances = yVar.tolist()
-    return jsonify({"Elevations":elevations, "PM2.5":estimates, "PM2.5 variance":variances, "Latitudes":lat_vector.tolist(), "Longitudes":lon_vector.tolist()})
-    
-    
+    result = {"Elevations": elevations, "PM2.5": estimates, "Latitudes": lat_vector.tolist(),
+              "Longitudes": lon_vector.tolist()}
+    if query_variance:
+        result["PM2.5 variance"] = yVar.reshape((lat_size, lon_size)).tolist()
+    return jsonify(result)
+
 
 @app.route("/api/timeAggregatedDataFrom", methods=["GET"])
 def timeAggregatedDataFrom():
@@ -285,12 +501,6 @@ def timeAggregatedDataFrom():
     function = request.args.get('function')
     timeInterval = request.args.get('timeInterval')  # Time interval in minutes
 
-    SQL_FUNCTIONS = {
-        "mean": "AVG",
-        "min": "MIN",
-        "max": "MAX",
-    }
-
     # Check ID is valid
     if id == "" or id == "undefined":
         msg = "id is invalid. It must be a string that is not '' or 'undefined'."
@@ -311,6 +521,35 @@ def timeAggregatedDataFrom():
         msg = "Incorrect date format, should be {utils.DATETIME_FORMAT}, e.g.: 2018-01-03T20:00:00Z"
         return msg, 400
 
+    tags = [{
+        "ID": id,
+        "SensorSource": sensor_source,
+        "SensorModel": "H1.2+S1.0.8",
+        "time": datetime.utcnow().strftime(utils.DATETIME_FORMAT)
+    }]
+
+    # a local store has rollups, so the intervals can be put together without touching most of the raw data
+    store = unwrappedStore()
+    if isinstance(store, measurement_store.ParquetStore):
+        return rollupAggregatedDataFrom(store, id, sensor_source, start, end, function, timeInterval, tags)
+    if bq_client is None:
+        return bigqueryUnavailable()
+    return queryAggregatedDataFrom(id, sensor_source, start, end, function, timeInterval, tags)
+
+
+# timeAggregatedDataFrom from the rollups of a local (parquet) store, see rollups.py
+def rollupAggregatedDataFrom(store, id, sensor_source, start, end, function, timeInterval, tags):
+    if not timeInterval or not timeInterval.isdigit() or int(timeInterval) < 1:
+        return "timeInterval must be a positive number of minutes", 400
+    sources = measurement_store.SOURCE_NAMES if sensor_source == "all" else [sensor_source]
+    intervals = rollups.aggregateIntervals(
+        store, id, sources, utils.parseDateString(start), utils.parseDateString(end), int(timeInterval), function)
+    measurements = [{"PM2_5": value, "time": upper.strftime(utils.DATETIME_FORMAT)} for upper, value in intervals]
+    return jsonify({"data": measurements, "tags": tags})
+
+
+# timeAggregatedDataFrom with the interval join done by bigquery
+def queryAggregatedDataFrom(id, sensor_source, start, end, function, timeInterval, tags):
     # Define the BigQuery query
     tables_list = []
     if sensor_source == "AirU" or sensor_source == "all":
@@ -375,79 +614,50 @@ def timeAggregatedDataFrom():
 
     # Run the query and collect the result
     measurements = []
+    started = time.time()
     query_job = bq_client.query(query, job_config=job_config)
     rows = query_job.result()
     for row in rows:
         measurements.append({"PM2_5": row.PM2_5, "time": row.upper.strftime(utils.DATETIME_FORMAT)})
+    telemetry.recordJob(query_job, time.time() - started, len(measurements))
 
-    tags = [{
-        "ID": id,
-        "SensorSource": sensor_source,
-        "SensorModel": "H1.2+S1.0.8",
-        "time": datetime.utcnow().strftime(utils.DATETIME_FORMAT)
-    }]
     return jsonify({"data": measurements, "tags": tags})
 
 
-# submit a query for a range of values
-# Ross Nov 2020
-# this has been consolidate and generalized so that multiple api calls can use the same query code
-def submit_sensor_query(lat_lo, lat_hi, lon_lo, lon_hi, start_date, end_date):
-    query = f"""
-    SELECT *
-    FROM
-    (
-        (
-            SELECT ID, time, PM2_5, Latitude, Longitude, SensorModel, 'AirU' as SensorSource
-            FROM `{AIRU_TABLE_ID}`
-            WHERE time > @start_date AND time < @end_date
-        )
-        UNION ALL
-        (
-            SELECT ID, time, PM2_5, Latitude, Longitude, "" as SensorModel, 'PurpleAir' as SensorSource
-            FROM `{PURPLEAIR_TABLE_ID}`
-            WHERE time > @start_date AND time < @end_date
-        )
-        UNION ALL
-        (
-            SELECT ID, time, PM2_5, Latitude, Longitude, '' as SensorModel, 'DAQ' as SensorSource
-            FROM `{DAQ_TABLE_ID}`
-            WHERE time > @start_date AND time < @end_date
-        )
-    ) WHERE (Latitude <= @lat_hi) AND (Latitude >= @lat_lo) AND (Longitude <= @lon_hi) AND (Longitude >= @lon_lo) AND time > @start_date AND time < @end_date
-    ORDER BY time ASC
-    """
-
-    
-# Old code that does not compute distance correctly
-#    WHERE SQRT(POW(Latitude - @lat, 2) + POW(Longitude - @lon, 2)) <= @radius
-#    AND time > @start_date AND time < @end_date
-#    ORDER BY time ASC
-#    """
-
-    job_config = bigquery.QueryJobConfig(
-        query_parameters=[
-            # bigquery.ScalarQueryParameter("lat", "NUMERIC", lat),
-            # bigquery.ScalarQueryParameter("lon", "NUMERIC", lon),
-            # bigquery.ScalarQueryParameter("radius", "NUMERIC", radius),
-            bigquery.ScalarQueryParameter("start_date", "TIMESTAMP", start_date),
-            bigquery.ScalarQueryParameter("end_date", "TIMESTAMP", end_date),
-            bigquery.ScalarQueryParameter("lat_lo", "NUMERIC", lat_lo),
-            bigquery.ScalarQueryParameter("lat_hi", "NUMERIC", lat_hi),
-            bigquery.ScalarQueryParameter("lon_lo", "NUMERIC", lon_lo),
-            bigquery.ScalarQueryParameter("lon_hi", "NUMERIC", lon_hi),
-        ]
-    )
-
-    query_job = bq_client.query(query, job_config=job_config)
-
-    if query_job.error_result:
-        app.logger.error(query_job.error_result)
-        return "Invalid API call - check documentation.", 400
-    # Waits for query to finish
-    sensor_data = query_job.result()  
-
-    return(sensor_data)
+# per endpoint histograms of the bigquery calls' wall time, rows and bytes processed (see telemetry.py),
+# and the fetch cache counters
+@app.route("/api/metrics", methods=["GET"])
+def metrics():
+    return jsonify({
+        "queries": telemetry.metrics(),
+        "fetch_cache": sensor_store.stats() if isinstance(sensor_store, fetch_cache.FetchCache) else None,
+    })
+
+
+# copies measurements from the bigquery tables into the local parquet store, e.g.
+#   flask sync-store --start 2020-07-01T00:00:00Z --end 2020-07-07T00:00:00Z
+# --rollups-only rebuilds the rollups from what is already in the local store, without going to bigquery
+@app.cli.command("sync-store")
+@click.option("--start", required=True, help=f"first day to sync, {utils.DATETIME_FORMAT}")
+@click.option("--end", default=None, help=f"last day to sync, {utils.DATETIME_FORMAT} (default now)")
+@click.option("--rollups-only", is_flag=True, help="only rebuild the rollups from the local partitions")
+def syncStore(start, end, rollups_only):
+    store = unwrappedStore()
+    if not isinstance(store, measurement_store.ParquetStore):
+        raise click.UsageError("sync-store needs MEASUREMENT_STORE=parquet")
+    start_date = utils.parseDateString(start)
+    end_date = utils.parseDateString(end) if end else datetime.now(timezone.utc)
+    if rollups_only:
+        built = store.buildRollups(start_date, end_date)
+        click.echo(f"Rebuilt the rollups of {built} partitions in {store.root}")
+        return
+    synced = store.sync(bq_client, SOURCE_TABLE_MAP, start_date, end_date)
+    click.echo(f"Synced {synced} measurements into {store.root}")
+
+
+# the measurement store behind the fetch cache (if there is one)
+def unwrappedStore():
+    return sensor_store.store if isinstance(sensor_store, fetch_cache.FetchCache) else sensor_store
 
 
 # could do an ellipse in lat/lon around the point using something like this
@@ -460,8 +670,8 @@ def submit_sensor_query(lat_lo, lat_hi, lon_lo, lon_hi, start_date, end_date):
 # this has been modified so that it now takes an array of lats/lons
 # the radius parameter is not implemented in a precise manner -- rather it is converted to a lat-lon bounding box and all within that box are returned
 # there could be an additional culling of sensors outside the radius done here after the query - if the radius parameter needs to be precise. 
+# The result is a SensorData (one array per field, see sensor_data.py) filled straight from the query result.
 def request_model_data_local(lats, lons, radius, start_date, end_date):
-    model_data = []
     # get the latest sensor data from each sensor
     # Modified by Ross for
     ## using a bounding box in lat-lon
@@ -474,27 +684,14 @@ def request_model_data_local(lats, lons, radius, start_date, end_date):
         if not lats.shape == lons.shape:
             return "lats,lons data data size error", 400
         else:
-            num_points = lats.shape[0]
-            lat_lo, lat_hi, lon_lo, lon_hi = utils.latlonBoundingBox(lats[0], lons[0], radius)
-            for i in range(1, num_points):
-                lat_lo, lat_hi, lon_lo, lon_hi = utils.boundingBoxUnion((utils.latlonBoundingBox(lats[i], lons[i], radius)), (lat_lo, lat_hi, lon_lo, lon_hi))
+            lat_lo, lat_hi, lon_lo, lon_hi = utils.latlonBoundingBoxUnion(lats, lons, radius)
     else:
         return "lats,lons data structure misalignment in request sensor data", 400
     app.logger.info("Query bounding box is %f %f %f %f" %(lat_lo, lat_hi, lon_lo, lon_hi))
 
-   
-    rows = submit_sensor_query(lat_lo, lat_hi, lon_lo, lon_hi, start_date, end_date)
-    
-    for row in rows:
-        model_data.append({
-            "ID": str(row.ID),
-            "Latitude": row.Latitude,
-            "Longitude": row.Longitude,
-            "time": row.time,
-            "PM2_5": row.PM2_5,
-            "SensorModel": row.SensorModel,
-            "SensorSource": row.SensorSource,
-        })
+    model_data = SensorData(sensor_store.queryColumns(lat_lo, lat_hi, lon_lo, lon_hi, start_date, end_date,
+                                                      columns=measurement_store.MEASUREMENT_COLUMNS))
+    model_data['ID'] = model_data['ID'].astype(str).astype(object)
 
     return model_data
 
@@ -517,7 +714,7 @@ def request_model_data():
     start_datetime = utils.parseDateString(start_date)
     end_datetime = utils.parseDateString(end_date)
     model_data = request_model_data_local(lat, lon, radius, start_datetime, end_datetime)
-    return jsonify(model_data)
+    return jsonify(model_data.toRecords())
 
 # get estimates within a time frame for a single location
 @app.route("/api/getEstimatesForLocation", methods=['GET'])
@@ -542,16 +739,26 @@ def getEstimatesForLocation():
         msg = f"Incorrect date format, should be {utils.DATETIME_FORMAT}, e.g.: 2018-01-03T20:00:00Z"
         return msg, 400
 
-    query_start_datetime = utils.parseDateString(query_start_date)
-    query_end_datetime = utils.parseDateString(query_end_date)
+    if query_rate <= 0:
+        return 'estimatesrate must be positive.', 400
+
+    query_variance = request.args.get('variance', 'true')
+    if query_variance not in VARIANCE_OPTIONS:
+        return f"variance must be one of {VARIANCE_OPTIONS}", 400
+    query_variance = query_variance == 'true'
+
+    query_start_datetime = utils.parseDateString64(query_start_date)
+    query_end_datetime = utils.parseDateString64(query_end_date)
     query_dates = utils.interpolateQueryDates(query_start_datetime, query_end_datetime, query_rate)
-    query_elevations = np.array(elevation_interpolator(query_lon, query_lat))
+    query_elevations = elevation_interpolator.points([query_lon], [query_lat])
     query_locations = np.column_stack((np.array((query_lat)), np.array((query_lon))))
 
     app.logger.info(
-        "Query parameters: lat= %f lon= %f start_date= %s end_date=%s estimatesrate=%f hours/estimate" %(query_lat, query_lon, query_start_datetime, query_end_datetime, query_rate))
+        "Query parameters: lat= %f lon= %f start_date= %s end_date=%s estimatesrate=%f hours/estimate" % (
+            query_lat, query_lon, query_start_datetime, query_end_datetime, query_rate))
 
-    yPred, yVar, status = computeEstimatesForLocations(query_dates, query_locations, query_elevations)
+    yPred, yVar, status = computeEstimatesForLocations(query_dates, query_locations, query_elevations,
+                                                       variance=query_variance)
 
     
 # convert the arrays to lists of floats
@@ -560,11 +767,19 @@ def getEstimatesForLocation():
 # this index of the "0" in the first index of yPred and yVar has to do with how the data is stored and returned by the model.  Could be avoided with a tranpose of the returned data?
 #
     num_times = len(query_dates)
+    query_date_strings = utils.formatQueryDates(query_dates)
     estimates = []
     for i in range(num_times):
-        estimates.append(
-            {'PM2_5': (yPred[0, i]), 'variance': (yVar[0, i]), 'datetime': query_dates[i].strftime('%Y-%m-%d %H:%M:%S%z'), 'Latitude': query_lat, 'Longitude': query_lon, 'Elevation': query_elevations[0], 'Status': status[i]}
-            )
+        estimates.append({
+            'PM2_5': (yPred[0, i]),
+            'datetime': query_date_strings[i],
+            'Latitude': query_lat,
+            'Longitude': query_lon,
+            'Elevation': query_elevations[0],
+            'Status': status[i],
+        })
+        if query_variance:
+            estimates[-1]['variance'] = yVar[0, i]
 
     # estimates = [
     #     {'PM2_5': pred, 'variance': var, 'datetime': date.strftime('%Y-%m-%d %H:%M:%S%z'), 'Latitude': query_lat, 'Longitude': query_lon, 'Elevation': query_elevation}
@@ -605,8 +820,16 @@ def getEstimatesForLocations():
         msg = f"Incorrect date format, should be {utils.DATETIME_FORMAT}, e.g.: 2018-01-03T20:00:00Z"
         return msg, 400
 
-    query_start_datetime = utils.parseDateString(query_start_date)
-    query_end_datetime = utils.parseDateString(query_end_date)
+    if query_rate <= 0:
+        return 'estimatesrate must be positive.', 400
+
+    query_variance = request.args.get('variance', 'true')
+    if query_variance not in VARIANCE_OPTIONS:
+        return f"variance must be one of {VARIANCE_OPTIONS}", 400
+    query_variance = query_variance == 'true'
+
+    query_start_datetime = utils.parseDateString64(query_start_date)
+    query_end_datetime = utils.parseDateString64(query_end_date)
 
 #    print((
 #        f"Query parameters: lat={query_lats} lon={query_lons} start_date={query_start_datetime}"
@@ -618,58 +841,73 @@ def getEstimatesForLocations():
     query_dates = utils.interpolateQueryDates(query_start_datetime, query_end_datetime, query_rate)
     query_locations = np.column_stack((query_lats, query_lons))
 # note - the elevation grid is the wrong way around, so you need to put in lons first
-    query_elevations = elevation_interpolator(query_lons, query_lats)
-
-    
-    yPred, yVar = computeEstimatesForLocations(query_dates, query_locations, query_elevations)
+    query_elevations = elevation_interpolator.points(query_lons, query_lats)
+    yPred, yVar, status = computeEstimatesForLocations(query_dates, query_locations, query_elevations,
+                                                       variance=query_variance)
 
     num_times = len(query_dates)
+    query_date_strings = utils.formatQueryDates(query_dates)
     estimates = []
 
     for i in range(num_times):
-        estimates.append(
-            {'PM2_5': (yPred[:,i]).tolist(), 'variance': (yVar[:,i]).tolist(), 'datetime': query_dates[i].strftime('%Y-%m-%d %H:%M:%S%z'), 'Latitude': query_lats.tolist(), 'Longitude': query_lons.tolist(), 'Elevation': query_elevations.tolist(), 'Status': status[i]}
-            )
+        estimates.append({
+            'PM2_5': (yPred[:, i]).tolist(),
+            'datetime': query_date_strings[i],
+            'Latitude': query_lats.tolist(),
+            'Longitude': query_lons.tolist(),
+            'Elevation': query_elevations.tolist(),
+            'Status': status[i],
+        })
+        if query_variance:
+            estimates[-1]['variance'] = (yVar[:, i]).tolist()
 
     return jsonify(estimates)
 
 
-# this is a generic helper function that sets everything up and runs the model
-def computeEstimatesForLocations(query_dates, query_locations, query_elevations):
-    num_locations = query_locations.shape[0]
-    query_lats = query_locations[:,0]
-    query_lons = query_locations[:,1]
+# steps 0-2 of the estimate routes: checks that the query locations are in the bounding box, and looks up the
+# correction factors and the length scales for the query dates.  Returns (correction_factors, latlon_length_scale,
+# elevation_length_scale, time_length_scale), or an error message and code.
+def modelParameters(query_dates, query_lats, query_lons):
     query_start_datetime = query_dates[0]
     query_end_datetime = query_dates[-1]
 
-            
-    # step 0, load up the bounding box from file and check that request is within it
-    bounding_box_vertices = utils.loadBoundingBox('bounding_box.csv')
-    app.logger.info("Loaded " + str(len(bounding_box_vertices)) + " bounding box vertices.")
-
-    for i in range(num_locations):
-        if not utils.isQueryInBoundingBox(bounding_box_vertices, query_lats[i], query_lons[i]):
-            return 'The query location, {query_lats[i]},{query_lons[i]},  is outside of the bounding box.', 400
-
-    # step 1, load up correction factors from file
-    correction_factors = utils.loadCorrectionFactors('correction_factors.csv')
-    app.logger.debug(f'Loaded {len(correction_factors)} correction factors.')
+    # step 0, check that the request is within the bounding box (the configuration is loaded once, see model_config.py)
+    config = model_config.current()
+    outside = np.flatnonzero(~utils.areQueriesInBoundingBox(config['bounding_box'], query_lats, query_lons))
+    if outside.shape[0] > 0:
+        location = f'{query_lats[outside[0]]},{query_lons[outside[0]]}'
+        return f'The query location, {location},  is outside of the bounding box.', 400
 
-    # step 2, load up length scales from file
-    length_scales = utils.loadLengthScales('length_scales.csv')
-    app.logger.debug("Loaded length scales: " + str(length_scales))
+    # step 1, the correction factors, compiled into interval arrays
+    correction_factors = config['correction_factors']
 
-    length_scales = utils.getScalesInTimeRange(length_scales, query_start_datetime, query_end_datetime)
-    if len(length_scales) < 1:
+    # step 2, the length scales for the query's time range
+    length_scales = config['length_scales']
+    relevant_scales = utils.lengthScalesInTimeRange(length_scales, query_start_datetime, query_end_datetime)
+    if relevant_scales.shape[0] < 1:
         msg = (
-            f"Incorrect number of length scales({len(length_scales)}) "
+            f"Incorrect number of length scales({relevant_scales.shape[0]}) "
             f"found in between {query_start_datetime} and {query_end_datetime}"
         )
         return msg, 400
 
-    latlon_length_scale = length_scales[0]['latlon']
-    elevation_length_scale = length_scales[0]['elevation']
-    time_length_scale = length_scales[0]['time']
+    return (correction_factors, float(length_scales['latlon'][relevant_scales[0]]),
+            float(length_scales['elevation'][relevant_scales[0]]), float(length_scales['time'][relevant_scales[0]]))
+
+
+# this is a generic helper function that sets everything up and runs the model.  query_dates is a sorted
+# datetime64 array (see utils.interpolateQueryDates).  With variance=False only the estimates are computed
+# and yVar is None.
+def computeEstimatesForLocations(query_dates, query_locations, query_elevations, variance=True):
+    num_locations = query_locations.shape[0]
+    query_lats = query_locations[:,0]
+    query_lons = query_locations[:,1]
+
+    parameters = modelParameters(query_dates, query_lats, query_lons)
+    # an error message and code
+    if isinstance(parameters[0], str):
+        return parameters
+    correction_factors, latlon_length_scale, elevation_length_scale, time_length_scale = parameters
 
     app.logger.debug(f'Using length scales: latlon={latlon_length_scale} elevation={elevation_length_scale} time={time_length_scale}')
 
@@ -685,96 +923,226 @@ def computeEstimatesForLocations(query_dates, query_locations, query_elevations)
 # radius is in meters, as is the length scale and UTM.    
     radius = SPACE_KERNEL_FACTOR_PADDING*latlon_length_scale
 
+    # Query locations that are far apart (more than the radius) don't share any sensors worth the cost of
+    # putting them in one model.  Instead of one query/model over the union of all of their bounding boxes,
+    # each cluster of nearby locations gets its own (much smaller) query and model.
+    clusters = utils.clusterQueryLocations(query_lats, query_lons, radius)
+    app.logger.info(f'Split {num_locations} query locations into {len(clusters)} clusters.')
+
+    yPred = np.empty((num_locations, len(query_dates)))
+    yVar = np.empty((num_locations, len(query_dates))) if variance else None
+    cluster_status = []
+    for cluster in clusters:
+        result = computeEstimatesForCluster(
+            query_dates, query_lats[cluster], query_lons[cluster], query_elevations[cluster], radius,
+            correction_factors, latlon_length_scale, elevation_length_scale, time_length_scale, variance)
+        # an error message and code
+        if isinstance(result[0], str):
+            return result
+        yPred[cluster], status_tmp = result[0], result[2]
+        if variance:
+            yVar[cluster] = result[1]
+        cluster_status.append(status_tmp)
+
+    # one status per query time -- the clusters' statuses are joined when there is more than one
+    status = [", ".join(dict.fromkeys(time_status)) for time_status in zip(*cluster_status)]
+
+    if np.min(yPred) < MIN_ACCEPTABLE_ESTIMATE:
+        app.logger.warn("got estimate below level " + str(MIN_ACCEPTABLE_ESTIMATE))
+        
+# Here we clamp values to ensure that small negative values to do not appear
+    yPred = np.clip(yPred, a_min = 0., a_max = None)
+
+    return yPred, yVar, status
+
+
+# fetches the measurements of one cluster and screens, corrects and bins them.  Raises ValueError (from
+# the sensor registry) for measurements at invalid locations.
+def binClusterData(query_lats, query_lons, radius, start_date, end_date, correction_factors):
     sensor_data = request_model_data_local(
         query_lats,
         query_lons,
         radius=radius,
-        start_date=query_start_datetime - timedelta(hours=TIME_KERNEL_FACTOR_PADDING*time_length_scale),
-        end_date=query_end_datetime + timedelta(hours=TIME_KERNEL_FACTOR_PADDING*time_length_scale))
+        start_date=start_date,
+        end_date=end_date)
 
 
-    unique_sensors = {datum['ID'] for datum in sensor_data}
+    unique_sensors = sensor_data.uniqueIDs()
     app.logger.info(f'Loaded {len(sensor_data)} data points for {len(unique_sensors)} unique devices from bgquery.')
 
-    # step 3.5, convert lat/lon to UTM coordinates
-    try:
-        utils.convertLatLonToUTM(sensor_data)
-    except ValueError as err:
-        return f'{str(err)}', 400
+    # step 3.5 and 4, look up the UTM coordinates, elevation and sensor type (from the source) of each sensor
+    sensor_registry.join(sensor_data)
 
-    sensor_data = [datum for datum in sensor_data if datum['zone_num'] == 12]
+    sensor_data = sensor_data.select(sensor_data['zone_num'] == 12)
 
-    unique_sensors = {datum['ID'] for datum in sensor_data}
+    unique_sensors = sensor_data.uniqueIDs()
     app.logger.info((
         "After removing points with zone num != 12: "
         f"{len(sensor_data)} data points for {len(unique_sensors)} unique devices."
     ))
 
-    # Step 4, parse sensor type from the version
-    sensor_source_to_type = {'AirU': '3003', 'PurpleAir': '5003', 'DAQ': '0000'}
-# DAQ does not need a correction factor
-    for datum in sensor_data:
-        datum['type'] =  sensor_source_to_type[datum['SensorSource']]
-
-    app.logger.info(f'Fields: {sensor_data[0].keys()}')
+    app.logger.info(f'Fields: {sensor_data.columnNames()}')
 
     # step 4.5, Data Screening
 #    print('Screening data')
-    sensor_data = utils.removeInvalidSensors(sensor_data)
+    sensor_data = utils.removeInvalidSensorsColumns(sensor_data)
 
     # step 5, apply correction factors to the data
-    for datum in sensor_data:
-        datum['PM2_5'] = utils.applyCorrectionFactor(correction_factors, datum['time'], datum['PM2_5'], datum['type'])
+    utils.applyCorrectionFactorsColumns(correction_factors, sensor_data)
 
-    # step 6, add elevation values to the data
+    # step 6, add elevation values to the data (normally already there from the sensor registry)
     # NOTICE - the elevation object takes locations in the form "lon-lat"
-    for datum in sensor_data:
-        if 'Altitude' not in datum:
-            datum['Altitude'] = elevation_interpolator([datum['Longitude']],[datum['Latitude']])[0]
-
-    # This does the calculation in one step --- old method --- less efficient.  Below we break it into pieces.  Remove this once the code below (step 7) is fully tested.
-    # step 7, get estimates from model
-    # # step 8, Create Model
-    # model, time_offset = gaussian_model_utils.createModel(
-    #     sensor_data, latlon_length_scale, elevation_length_scale, time_length_scale)
-    # # step 9, Compute estimates
-    # yPred, yVar = gaussian_model_utils.estimateUsingModel(
-    #     model, query_lats, query_lons, query_elevations, query_dates, time_offset)
+    if 'Altitude' not in sensor_data:
+        utils.addElevationColumn(sensor_data, elevation_interpolator)
 
-    
-    time_padding = timedelta(hours=TIME_KERNEL_FACTOR_PADDING*time_length_scale)
-    time_sequence_length = timedelta(hours = TIME_SEQUENCE_SIZE*time_length_scale)
+    # step 7, bin all of the data into one sensors x bins matrix
+    return gaussian_model_utils.binAllSensorData(sensor_data)
+
+
+# fetches the data and runs the model for one cluster of query locations (see computeEstimatesForLocations)
+def computeEstimatesForCluster(query_dates, query_lats, query_lons, query_elevations, radius, correction_factors,
+                               latlon_length_scale, elevation_length_scale, time_length_scale, variance=True):
+    time_padding = utils.hoursToTimedelta64(TIME_KERNEL_FACTOR_PADDING*time_length_scale)
+    time_sequence_length = utils.hoursToTimedelta64(TIME_SEQUENCE_SIZE*time_length_scale)
     sensor_sequence, query_sequence = utils.chunkTimeQueryData(query_dates, time_sequence_length, time_padding)
 
-    yPred = np.empty((num_locations, 0))
-    yVar = np.empty((num_locations, 0))
+    # steps 3-7, all of the data screened, corrected and binned into one sensors x bins matrix, each chunk's model
+    # uses its window of it
+    try:
+        binned_data = fetchBinnedData(query_dates, query_lats, query_lons, radius, correction_factors, time_padding,
+                                      sensor_sequence)
+    except ValueError as err:
+        return f'{str(err)}', 400
+
+    return estimateFromBinnedData(binned_data, sensor_sequence, query_sequence, query_lats, query_lons,
+                                  query_elevations, latlon_length_scale, elevation_length_scale, time_length_scale,
+                                  variance)
+
+
+# the binned data for the query locations and dates (from the sensors within radius of the locations, over the
+# dates widened by time_padding), loaded whole or streamed.  Raises ValueError as binClusterData.
+def fetchBinnedData(query_dates, query_lats, query_lons, radius, correction_factors, time_padding, sensor_sequence):
+    # the stores take datetimes
+    start_date = measurement_store.fromDatetime64(query_dates[0] - time_padding)
+    end_date = measurement_store.fromDatetime64(query_dates[-1] + time_padding)
+    if STREAMING_PIPELINE:
+        lat_lo, lat_hi, lon_lo, lon_hi = utils.latlonBoundingBoxUnion(query_lats, query_lons, radius)
+        return streaming.streamBinnedData(
+            sensor_store, lat_lo, lat_hi, lon_lo, lon_hi, start_date, end_date, sensor_registry,
+            correction_factors, kept_bins=streaming.chunkEdgeBins(sensor_sequence), batch_size=STREAMING_BATCH_ROWS)
+    return binClusterData(query_lats, query_lons, radius, start_date, end_date, correction_factors)
+
+
+# steps 8 and 9, a model for each time chunk from its window of binned_data, and its estimates at the query
+# locations.  sensor_rows picks the sensors (rows of the data matrix) the models use, all of them by default.
+def estimateFromBinnedData(binned_data, sensor_sequence, query_sequence, query_lats, query_lons, query_elevations,
+                           latlon_length_scale, elevation_length_scale, time_length_scale, variance=True,
+                           sensor_rows=None):
+    num_locations = query_lats.shape[0]
+    num_dates = sum(len(dates) for dates in query_sequence)
+    yPred = np.empty((num_locations, num_dates))
+    yVar = np.empty((num_locations, num_dates)) if variance else None
     status = []
+    first_date = 0
     for i in range(len(query_sequence)):
-    # step 7, Create Model
-        model, time_offset, model_status = gaussian_model_utils.createModel(
-            sensor_data, latlon_length_scale, elevation_length_scale, time_length_scale, sensor_sequence[i][0], sensor_sequence[i][1], save_matrices=False)
+        last_date = first_date + len(query_sequence[i])
+    # step 8, Create Model
+        data_matrix, space_coordinates, time_coordinates, time_offset = gaussian_model_utils.windowDataMatrix(
+            binned_data, sensor_sequence[i][0], sensor_sequence[i][1])
+        if sensor_rows is not None:
+            data_matrix, space_coordinates = data_matrix[sensor_rows], space_coordinates[sensor_rows]
+        model, model_status = gaussian_model_utils.createModelFromDataMatrix(
+            data_matrix, space_coordinates, time_coordinates, latlon_length_scale, elevation_length_scale,
+            time_length_scale)
         # check to see if there is a valid model
         if (model == None):
-            yPred_tmp = np.full((query_lats.shape[0], len(query_sequence[i])), 0.0)
-            yVar_tmp = np.full((query_lats.shape[0], len(query_sequence[i])), np.nan)
-            status_estimate_tmp = [model_status for i in range(len(query_sequence[i]))]
+            yPred[:, first_date:last_date] = 0.0
+            if variance:
+                yVar[:, first_date:last_date] = np.nan
+            status = status + [model_status for i in range(len(query_sequence[i]))]
         else:
-            yPred_tmp, yVar_tmp, status_estimate_tmp = gaussian_model_utils.estimateUsingModel(
-                model, query_lats, query_lons, query_elevations, query_sequence[i], time_offset, save_matrices=True)
-        # put the estimates together into one matrix
-        yPred = np.concatenate((yPred, yPred_tmp), axis=1)
-        yVar = np.concatenate((yVar, yVar_tmp), axis=1)
-        status = status + status_estimate_tmp
-
-    if np.min(yPred) < MIN_ACCEPTABLE_ESTIMATE:
-        app.logger.warn("got estimate below level " + str(MIN_ACCEPTABLE_ESTIMATE))
-        
-# Here we clamp values to ensure that small negative values to do not appear
-    yPred = np.clip(yPred, a_min = 0., a_max = None)
+            # step 9, put this chunk's estimates in place
+            yPred[:, first_date:last_date], yVar_tmp, status_estimate_tmp = gaussian_model_utils.estimateUsingModel(
+                model, query_lats, query_lons, query_elevations, query_sequence[i], time_offset, save_matrices=True,
+                variance=variance)
+            if variance:
+                yVar[:, first_date:last_date] = yVar_tmp
+            status = status + status_estimate_tmp
+        first_date = last_date
 
     return yPred, yVar, status
 
 
+# getEstimateMap with MAP_TILE_CELLS: the data for the whole map is fetched and binned once, as for one cluster, and
+# estimateMapTiles estimates it tile by tile.  elevations is the (lats x lons) grid of mapElevations.
+def computeEstimatesForMap(query_dates, lat_vector, lon_vector, elevations, variance=True):
+    locations_lon, locations_lat = np.meshgrid(lon_vector, lat_vector)
+    query_lats = locations_lat.flatten()
+    query_lons = locations_lon.flatten()
+    parameters = modelParameters(query_dates, query_lats, query_lons)
+    # an error message and code
+    if isinstance(parameters[0], str):
+        return parameters
+    correction_factors, latlon_length_scale, elevation_length_scale, time_length_scale = parameters
 
+    radius = SPACE_KERNEL_FACTOR_PADDING*latlon_length_scale
+    time_padding = utils.hoursToTimedelta64(TIME_KERNEL_FACTOR_PADDING*time_length_scale)
+    time_sequence_length = utils.hoursToTimedelta64(TIME_SEQUENCE_SIZE*time_length_scale)
+    sensor_sequence, query_sequence = utils.chunkTimeQueryData(query_dates, time_sequence_length, time_padding)
+    try:
+        binned_data = fetchBinnedData(query_dates, query_lats, query_lons, radius, correction_factors, time_padding,
+                                      sensor_sequence)
+    except ValueError as err:
+        return f'{str(err)}', 400
+
+    yPred, yVar, status = estimateMapTiles(
+        binned_data, sensor_sequence, query_sequence, lat_vector, lon_vector, elevations,
+        MAP_TILE_RADIUS_FACTOR*latlon_length_scale, latlon_length_scale, elevation_length_scale, time_length_scale,
+        variance, MAP_TILE_CELLS, MAP_TILE_OVERLAP_CELLS)
+
+    if np.min(yPred) < MIN_ACCEPTABLE_ESTIMATE:
+        app.logger.warn("got estimate below level " + str(MIN_ACCEPTABLE_ESTIMATE))
+    yPred = np.clip(yPred, a_min=0., a_max=None)
+
+    return yPred, yVar, status
 
 
+# The estimates on a (lats x lons) grid, one tile of the grid at a time (see utils.mapTiles).  Each tile's models
+# only have the sensors of binned_data within radius of the tile, so the cost no longer grows with the sensors
+# of the whole map times its cells.  Where tiles overlap, their estimates (and variances) are blended with the
+# tiles' weights.  A tile only depends on binned_data and its own cells, so the tiles could be estimated in
+# parallel or cached.  The models of the tiles are not the model of the whole map, so the estimates are an
+# approximation of computeEstimatesForLocations (see benchmarkTiles).  Returns the estimates and variances as
+# (lats*lons) x dates, in the order of the flattened grid, and one status per date, the tiles' statuses joined.
+def estimateMapTiles(binned_data, sensor_sequence, query_sequence, lat_vector, lon_vector, elevations, radius,
+                     latlon_length_scale, elevation_length_scale, time_length_scale, variance, tile_cells,
+                     overlap_cells):
+    num_dates = sum(len(dates) for dates in query_sequence)
+    grid_shape = (lat_vector.shape[0], lon_vector.shape[0])
+    elevations = np.asarray(elevations).reshape(grid_shape)
+    yPred = np.zeros(grid_shape + (num_dates,))
+    yVar = np.zeros(grid_shape + (num_dates,)) if variance else None
+    tile_status = []
+    # the tiles in the zone of the first corner of the map, as in utils.clusterQueryLocations
+    zone_nums = utils.latlonToZones(lat_vector[:1], lon_vector[:1])[0]
+    sensor_E = binned_data['space_coordinates'][:, 0]
+    sensor_N = binned_data['space_coordinates'][:, 1]
+    for rows, columns, weights in utils.mapTiles(grid_shape[0], grid_shape[1], tile_cells, overlap_cells):
+        tile_lon, tile_lat = np.meshgrid(lon_vector[columns], lat_vector[rows])
+        E, N = utils.latlonToUTMArrays(tile_lat.ravel(), tile_lon.ravel(), force_zone_number=int(zone_nums[0]))[:2]
+        # the distance of each sensor from the tile's UTM box
+        distance_E = np.maximum(0.0, np.maximum(E.min() - sensor_E, sensor_E - E.max()))
+        distance_N = np.maximum(0.0, np.maximum(N.min() - sensor_N, sensor_N - N.max()))
+        sensor_rows = np.flatnonzero(distance_E**2 + distance_N**2 <= radius**2)
+        tile_pred, tile_var, status_tmp = estimateFromBinnedData(
+            binned_data, sensor_sequence, query_sequence, tile_lat.ravel(), tile_lon.ravel(),
+            elevations[rows, columns].ravel(), latlon_length_scale, elevation_length_scale, time_length_scale,
+            variance, sensor_rows=sensor_rows)
+        tile_shape = weights.shape + (num_dates,)
+        yPred[rows, columns] += weights[:, :, np.newaxis]*tile_pred.reshape(tile_shape)
+        if variance:
+            yVar[rows, columns] += weights[:, :, np.newaxis]*tile_var.reshape(tile_shape)
+        tile_status.append(status_tmp)
+    status = [", ".join(dict.fromkeys(date_status)) for date_status in zip(*tile_status)]
+
+    return (yPred.reshape(-1, num_dates), yVar.reshape(-1, num_dates) if variance else None, status)
@@ -0,0 +1,100 @@
+# Elevation lookups from the elevation map.
+#
+# The map used to be read with loadmat at import time and wrapped in scipy's interp2d, which is slow to set
+# up, deprecated, and only evaluates on the grid of all of the lons x all of the lats it is given, so that
+# scattered locations had to be looked up one at a time.  Here the map is converted once to a raw .npy next
+# to the .mat (redone whenever the .mat is newer), which every process memory-maps, so the gunicorn workers
+# share one copy of the grid through the page cache.  The .npy holds one (lats+1, lons+1) array: the first
+# row holds the grid longitudes, the first column the grid latitudes, the rest the elevations.
+#
+# ElevationMap interpolates either bicubically (the default) or bilinearly:
+#   cubic:  the interpolating bicubic spline, the same surface as interp2d(kind='cubic') (both fit it with
+#           FITPACK's regrid, with s=0).  The spline coefficients are computed per process when it starts.
+#   linear: bilinear interpolation straight from the memory-mapped grid.
+# Neither extrapolates: past the edges of the map both give the elevation at the nearest edge, as
+# RectBivariateSpline and interp2d do.
+#
+# map(lons, lats) has the interp2d calling convention (note - lons first, the elevation map is "lon-lat"):
+# the axes are sorted and the result is the (lats, lons) grid, with the first dimension dropped for a
+# single lat.  points(lons, lats) looks up scattered locations, one elevation per (lon, lat) pair.
+
+import logging
+import os
+import numpy as np
+from scipy import interpolate
+from scipy.io import loadmat
+
+
+ELEVATION_INTERPOLATION_KINDS = ["cubic", "linear"]
+
+
+def convertElevationMap(mat_path, npy_path):
+    data = loadmat(mat_path)
+    grid_lons = data['gridLongs'].ravel()
+    grid_lats = data['gridLats'].ravel()
+    bordered = np.full((grid_lats.shape[0] + 1, grid_lons.shape[0] + 1), np.nan)
+    bordered[0, 1:] = grid_lons
+    bordered[1:, 0] = grid_lats
+    bordered[1:, 1:] = data['elevs']
+    # several workers can start at once, so each writes its own file and the last rename wins
+    tmp_path = f'{npy_path}.{os.getpid()}.tmp.npy'
+    np.save(tmp_path, bordered)
+    os.replace(tmp_path, npy_path)
+    logging.info(f'Converted {mat_path} to {npy_path}')
+
+
+def loadElevationMap(mat_path, kind="cubic"):
+    """An ElevationMap for the map in mat_path, read from (and if needed first converted to) its .npy"""
+    npy_path = os.path.splitext(mat_path)[0] + '.npy'
+    if not os.path.exists(npy_path) or os.stat(npy_path).st_mtime < os.stat(mat_path).st_mtime:
+        convertElevationMap(mat_path, npy_path)
+    bordered = np.load(npy_path, mmap_mode='r')
+    return ElevationMap(bordered[0, 1:], bordered[1:, 0], bordered[1:, 1:], kind)
+
+
+class ElevationMap:
+    def __init__(self, grid_lons, grid_lats, elevations, kind="cubic"):
+        if kind not in ELEVATION_INTERPOLATION_KINDS:
+            raise ValueError(f"Unknown elevation interpolation {kind}, must be one of {ELEVATION_INTERPOLATION_KINDS}")
+        self.grid_lons = np.asarray(grid_lons)
+        self.grid_lats = np.asarray(grid_lats)
+        # rows are lats, columns are lons
+        self.elevations = elevations
+        self.kind = kind
+        if kind == "cubic":
+            self.spline = interpolate.RectBivariateSpline(self.grid_lats, self.grid_lons, elevations, kx=3, ky=3, s=0)
+
+    def __call__(self, lons, lats):
+        return self.map(lons, lats)
+
+    def map(self, lons, lats):
+        lons = np.sort(np.atleast_1d(np.asarray(lons, dtype=float)))
+        lats = np.sort(np.atleast_1d(np.asarray(lats, dtype=float)))
+        if self.kind == "cubic":
+            elevations = self.spline(lats, lons)
+        else:
+            lon_grid, lat_grid = np.meshgrid(lons, lats)
+            elevations = self.bilinear(lon_grid.ravel(), lat_grid.ravel()).reshape(lat_grid.shape)
+        return elevations[0] if elevations.shape[0] == 1 else elevations
+
+    def points(self, lons, lats):
+        lons = np.asarray(lons, dtype=float)
+        lats = np.asarray(lats, dtype=float)
+        if self.kind == "cubic":
+            return self.spline.ev(lats, lons)
+        return self.bilinear(lons, lats)
+
+    def bilinear(self, lons, lats):
+        # the grid cell of each location, the edge cells for locations off the map, where the clipped fractions
+        # hold the elevation at the edge
+        rows = np.clip(np.searchsorted(self.grid_lats, lats, side='right') - 1, 0, self.grid_lats.shape[0] - 2)
+        columns = np.clip(np.searchsorted(self.grid_lons, lons, side='right') - 1, 0, self.grid_lons.shape[0] - 2)
+        lat_fraction = np.clip((lats - self.grid_lats[rows]) / (self.grid_lats[rows + 1] - self.grid_lats[rows]), 0, 1)
+        lon_fraction = np.clip(
+            (lons - self.grid_lons[columns]) / (self.grid_lons[columns + 1] - self.grid_lons[columns]), 0, 1)
+        # along the longitudes at the cell's lower and upper latitude, then between the two
+        west = self.elevations[rows, columns], self.elevations[rows + 1, columns]
+        east = self.elevations[rows, columns + 1], self.elevations[rows + 1, columns + 1]
+        lower = (1 - lon_fraction) * west[0] + lon_fraction * east[0]
+        upper = (1 - lon_fraction) * west[1] + lon_fraction * east[1]
+        return (1 - lat_fraction) * lower + lat_fraction * upper
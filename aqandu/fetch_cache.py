@@ -0,0 +1,223 @@
+# An incremental cache in front of a measurement store.
+#
+# People page the map back and forth through adjacent and overlapping time ranges, and every estimate
+# refetches the whole padded window even when nearly all of it was fetched a few seconds earlier.
+# This cache splits the world into lat-lon cells and keeps, for each cell, the measurements already
+# fetched together with the time intervals they cover.  A query only goes to the store for the time
+# slices that are missing from at least one of the cells it touches, the new rows are merged into the
+# cells in time order, and the answer is then assembled from the cells.
+#
+# Measurements keep trickling into the tables for a while after they are taken (DAQ in particular can be
+# hours late), so nothing newer than FETCH_CACHE_SETTLE is remembered -- that part of a query is always
+# fetched fresh.  Cells are evicted least recently used first once the cache grows past its memory cap.
+
+from collections import OrderedDict
+from datetime import datetime, timezone
+import threading
+import numpy as np
+from aqandu import measurement_store
+
+
+# degrees.  About 5.5 km north-south, comparable to the 4300 m spatial length scale.
+CELL_SIZE = 0.05
+# a rough per-row cost (arrays plus the python strings for the ID etc.), used for the memory cap
+BYTES_PER_ROW = 200
+ONE_MICROSECOND = np.timedelta64(1, "us")
+
+
+# intervals are closed [lo, hi] pairs of datetime64, kept sorted and non-overlapping
+def subtractIntervals(intervals, lo, hi):
+    """The parts of [lo, hi] that are not covered by intervals"""
+    missing = []
+    for covered_lo, covered_hi in intervals:
+        if covered_hi < lo:
+            continue
+        if covered_lo > hi:
+            break
+        if covered_lo > lo:
+            missing.append((lo, covered_lo - ONE_MICROSECOND))
+        lo = covered_hi + ONE_MICROSECOND
+        if lo > hi:
+            return missing
+    missing.append((lo, hi))
+    return missing
+
+
+def addInterval(intervals, lo, hi):
+    """Union [lo, hi] into intervals (touching intervals are joined)"""
+    merged = []
+    for covered_lo, covered_hi in intervals:
+        if covered_hi + ONE_MICROSECOND < lo or covered_lo > hi + ONE_MICROSECOND:
+            merged.append((covered_lo, covered_hi))
+        else:
+            lo = min(lo, covered_lo)
+            hi = max(hi, covered_hi)
+    merged.append((lo, hi))
+    merged.sort()
+    return merged
+
+
+def unionIntervals(interval_lists):
+    union = []
+    for intervals in interval_lists:
+        for lo, hi in intervals:
+            union = addInterval(union, lo, hi)
+    return union
+
+
+def inIntervals(times, intervals):
+    mask = np.zeros(times.shape[0], dtype=bool)
+    for lo, hi in intervals:
+        mask |= (times >= lo) & (times <= hi)
+    return mask
+
+
+class CacheCell:
+    def __init__(self):
+        self.intervals = []
+        self.data = None
+        self.rows = 0
+
+    def merge(self, column_data):
+        if self.data is None:
+            self.data = column_data
+        else:
+            self.data = measurement_store.concatenateColumns([self.data, column_data],
+                                                             measurement_store.MEASUREMENT_COLUMNS)
+        self.rows = self.data["time"].shape[0]
+
+
+class FetchCache:
+    def __init__(self, store, max_bytes=128 * 1024 * 1024, settle=np.timedelta64(3, "h"), cell_size=CELL_SIZE):
+        self.store = store
+        self.max_bytes = max_bytes
+        self.settle = settle
+        self.cell_size = cell_size
+        self.cells = OrderedDict()
+        self.lock = threading.Lock()
+        self.counters = {
+            "hits": 0,        # answered without going to the store
+            "partial_hits": 0,  # some of the time range had to be fetched
+            "misses": 0,      # nothing usable was cached
+            "fetches": 0,     # queries sent to the store
+            "rows_fetched": 0,
+            "rows_served": 0,
+            "evictions": 0,
+        }
+
+    def cellRange(self, lo, hi):
+        return range(int(np.floor(lo / self.cell_size)), int(np.floor(hi / self.cell_size)) + 1)
+
+    def cellKeys(self, lats, lons):
+        return np.floor(lats / self.cell_size).astype(np.int64), np.floor(lons / self.cell_size).astype(np.int64)
+
+    def fetch(self, lat_lo, lat_hi, lon_lo, lon_hi, lo, hi):
+        column_data = self.store.queryColumns(lat_lo, lat_hi, lon_lo, lon_hi,
+                                              measurement_store.fromDatetime64(lo),
+                                              measurement_store.fromDatetime64(hi),
+                                              columns=measurement_store.MEASUREMENT_COLUMNS)
+        with self.lock:
+            self.counters["fetches"] += 1
+            self.counters["rows_fetched"] += column_data["time"].shape[0]
+        return column_data
+
+    def queryColumns(self, lat_lo, lat_hi, lon_lo, lon_hi, start_date, end_date, columns=None):
+        columns = measurement_store.checkColumns(columns)
+        start = measurement_store.toDatetime64(start_date)
+        end = measurement_store.toDatetime64(end_date)
+        horizon = measurement_store.toDatetime64(datetime.now(timezone.utc)) - self.settle
+        # the store query excludes both end points, so the cached part is the closed range below
+        cache_lo = start + ONE_MICROSECOND
+        cache_hi = min(end - ONE_MICROSECOND, horizon)
+
+        lat_cells = self.cellRange(lat_lo, lat_hi)
+        lon_cells = self.cellRange(lon_lo, lon_hi)
+        keys = [(lat_cell, lon_cell) for lat_cell in lat_cells for lon_cell in lon_cells]
+        # fetches are done over whole cells so that everything fetched can be kept
+        box = (lat_cells[0] * self.cell_size, (lat_cells[-1] + 1) * self.cell_size,
+               lon_cells[0] * self.cell_size, (lon_cells[-1] + 1) * self.cell_size)
+
+        pieces = []
+        if cache_lo <= cache_hi:
+            with self.lock:
+                missing = [subtractIntervals(self.cellFor(key).intervals, cache_lo, cache_hi) for key in keys]
+            gaps = unionIntervals(missing)
+            self.countOutcome(gaps, cache_lo, cache_hi)
+
+            for gap_lo, gap_hi in gaps:
+                column_data = self.fetch(*box, gap_lo - ONE_MICROSECOND, gap_hi + ONE_MICROSECOND)
+                self.storeGap(keys, column_data, gap_lo, gap_hi)
+
+            with self.lock:
+                for key in keys:
+                    cell = self.cellFor(key)
+                    if cell.data is not None:
+                        pieces.append(measurement_store.selectInBox(cell.data, lat_lo, lat_hi, lon_lo, lon_hi,
+                                                                    start_date, end_date))
+                    self.cells.move_to_end(key)
+                self.evict()
+
+        # the unsettled tail is never cached
+        if cache_hi < end - ONE_MICROSECOND:
+            tail_start = max(start, cache_hi)
+            pieces.append(self.fetch(lat_lo, lat_hi, lon_lo, lon_hi, tail_start, end))
+
+        column_data = measurement_store.concatenateColumns(pieces, measurement_store.MEASUREMENT_COLUMNS)
+        with self.lock:
+            self.counters["rows_served"] += column_data["time"].shape[0]
+        return {name: column_data[name] for name in columns}
+
+    def query(self, lat_lo, lat_hi, lon_lo, lon_hi, start_date, end_date, columns=None):
+        columns = measurement_store.checkColumns(columns)
+        column_data = self.queryColumns(lat_lo, lat_hi, lon_lo, lon_hi, start_date, end_date, columns)
+        return measurement_store.columnsToRows(column_data, columns)
+
+    # batches come straight from the store -- they are for queries too long to hold in memory, let alone cache
+    def queryBatches(self, lat_lo, lat_hi, lon_lo, lon_hi, start_date, end_date, columns=None,
+                     batch_size=measurement_store.BATCH_ROWS):
+        return self.store.queryBatches(lat_lo, lat_hi, lon_lo, lon_hi, start_date, end_date, columns, batch_size)
+
+    # must hold the lock
+    def cellFor(self, key):
+        if key not in self.cells:
+            self.cells[key] = CacheCell()
+        return self.cells[key]
+
+    def storeGap(self, keys, column_data, gap_lo, gap_hi):
+        lat_keys, lon_keys = self.cellKeys(column_data["Latitude"], column_data["Longitude"])
+        times = column_data["time"]
+        with self.lock:
+            for key in keys:
+                cell = self.cellFor(key)
+                # another request may have filled part of this gap in the meantime, only add what is still missing
+                missing = subtractIntervals(cell.intervals, gap_lo, gap_hi)
+                mask = (lat_keys == key[0]) & (lon_keys == key[1]) & inIntervals(times, missing)
+                if np.any(mask):
+                    cell.merge({name: values[mask] for name, values in column_data.items()})
+                cell.intervals = addInterval(cell.intervals, gap_lo, gap_hi)
+
+    def countOutcome(self, gaps, lo, hi):
+        with self.lock:
+            if len(gaps) == 0:
+                self.counters["hits"] += 1
+            elif len(gaps) == 1 and gaps[0] == (lo, hi):
+                self.counters["misses"] += 1
+            else:
+                self.counters["partial_hits"] += 1
+
+    # must hold the lock
+    def evict(self):
+        total_rows = sum(cell.rows for cell in self.cells.values())
+        while self.cells and total_rows * BYTES_PER_ROW > self.max_bytes:
+            key, cell = self.cells.popitem(last=False)
+            total_rows -= cell.rows
+            self.counters["evictions"] += 1
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats["cells"] = len(self.cells)
+            stats["rows_cached"] = sum(cell.rows for cell in self.cells.values())
+        stats["bytes_cached"] = stats["rows_cached"] * BYTES_PER_ROW
+        stats["max_bytes"] = self.max_bytes
+        return stats
@@ -13,9 +13,21 @@ import torch.nn as nn
 import numpy as np
 import math
 import scipy
+import scipy.fft
 
 
 JITTER = 1e-3
+# the time structured model treats kernel values below this (relative to the variance) as 0
+TOEPLITZ_CUTOFF = 1e-16
+# the most elements of the intermediate arrays of the time structured variance, which is done in blocks of query times
+STRUCTURED_BLOCK_ELEMENTS = 2**20
+# the fewest times for the time structured solve, which also needs STRUCTURED_TIMES_PER_SENSOR times per sensor:
+# below that the eigen decomposition of the temporal kernel, O(times^3), is cheaper than the corner correction of
+# the variance, O(corner times * times * sensors) per query time (see benchmark.py circulant)
+STRUCTURED_MIN_TIMES = 512
+STRUCTURED_TIMES_PER_SENSOR = 4
+# the rows of the dense test kernel whose variances are computed at once (factored=False)
+VARIANCE_BLOCK_ROWS = 256
 
 # this does an eigen analysis of a symmetric circulant matrix using an FFT
 #def symeigCirculant(data_first_row, eigenvectors=True):
@@ -26,37 +38,22 @@ JITTER = 1e-3
 # efficient matrix multiply with diagonal matrix -- I cannot believe torch doesn't have this.
 def diagMultTorchLeft(diag_vector, matrix):
     rows = diag_vector.shape[0]
-    cols = matrix.shape[1]
 #    print(diag_vector.shape)
 #    print(matrix.shape)
     if (rows != matrix.shape[0]):
         print("RunTimeError: bad entries for diagonal matrix multiply")
         return torch.zeros([0])
 
-    result = torch.zeros([rows,cols],dtype=torch.float64)
-    for i in range(rows):
-        result[i, :] = diag_vector[i]*matrix[i, :]
-#    print(result.shape)
-    return result
+    return (diag_vector.view(-1, 1) * matrix).to(torch.float64)
 
-# used for plugging kernels into other operations associated with circulant kernel matrices
+# used for plugging kernels into other operations associated with circulant kernel matrices (works on arrays)
 def gaussKernel(x):
-    return(math.exp(-(x**2/2.0)))
+    return np.exp(-(x**2/2.0))
 
 # just fills up an array with kernel values, relative to the zero position and wrapping boundary conditions (circulant
 def buildKernelArray(size, kernel, bandwidth=1.0):
-    array = np.zeros(size)
-    if (size % 2) != 0:
-        for i in range((size-1)//2):
-            array[i] = kernel(float(i)/bandwidth)
-        for i in range((size+1)//2):
-            array[size-(i+1)] = kernel(float((i+1))/bandwidth)
-    else:
-        for i in range((size)//2):
-            array[i] = kernel(float(i)/bandwidth)
-        for i in range((size)//2):
-            array[size-(i+1)] = kernel(float((i+1))/bandwidth)
-    return(array)
+    distances = np.arange(size)
+    return kernel(np.minimum(distances, size - distances)/float(bandwidth))
 
 
 # convenience function for getting a circulant matrix
@@ -99,16 +96,10 @@ def circulantMatrixEigen(vector):
 # This works and has been tested
 def symCirculantMatrixEigen(vector):
     v_fft = np.real(scipy.fft.fft(vector))
-#    print("fft")
-#    print(v_fft)
     size = vector.shape[0]
-    array = np.zeros([size, size])
-    for i in range(size):
-        this_vector = np.exp(-2j * np.pi * i * np.arange(size)/(size))
-        if i <= size//2:
-            array[:,i] = np.real(this_vector)
-        else:
-            array[:,i] = np.imag(this_vector)
+    phases = -2 * np.pi * np.outer(np.arange(size), np.arange(size))/size
+    # the real parts of the first half of the fourier vectors, the imaginary parts of the second half
+    array = np.where(np.arange(size) <= size//2, np.cos(phases), np.sin(phases))
 #crazy normalization of the high-freq vector for special, even case
     if (size % 2) == 0:
         array[:,size//2] *= np.sqrt(0.5)
@@ -120,6 +111,78 @@ def symCirculantMatrixEigen(vector):
     return(v_fft, array)
 
 
+# The time structured model.  On a regular time grid the temporal kernel K is a symmetric Toeplitz matrix, given by
+# its first column.  Its circulant approximation C (the same matrix, wrapped around at the far corners) has the
+# fourier vectors as eigenvectors, so it is diagonalized by FFTs.  K - C is only nonzero in the two corner blocks
+# of the first and last m times, within a few time length scales of each other around the wrap (m is where the
+# kernel drops below TOEPLITZ_CUTOFF).  So every a*K + n*I is a*C + n*I, which the FFTs invert, plus a rank 2m
+# correction, which the Woodbury identity takes care of -- the solves are exact, without any padding of the data.
+
+# the circulant approximation of a symmetric Toeplitz matrix, as its first column
+def circulantApproximation(first_column):
+    size = first_column.shape[0]
+    distances = np.arange(size)
+    return first_column[np.minimum(distances, size - distances)]
+
+
+# the scale of each real FFT coefficient in the real, orthonormal fourier basis
+def realFourierScales(size):
+    scales = np.full(size//2 + 1, np.sqrt(2.0/size))
+    scales[0] = np.sqrt(1.0/size)
+    if (size % 2) == 0:
+        scales[-1] = np.sqrt(1.0/size)
+    return scales
+
+
+# the coordinates of the rows of matrix in the real, orthonormal fourier basis (the eigenvectors of every symmetric
+# circulant matrix of that size): the cosines in the order of the real FFT, then the sines
+def realFourier(matrix):
+    size = matrix.shape[-1]
+    spectrum = scipy.fft.rfft(matrix, axis=-1)
+    sines = -spectrum.imag[..., 1:(size + 1)//2]*np.sqrt(2.0/size)
+    return np.concatenate([spectrum.real*realFourierScales(size), sines], axis=-1)
+
+
+# the rows back from their realFourier coordinates
+def inverseRealFourier(coordinates):
+    size = coordinates.shape[-1]
+    num_cosines = size//2 + 1
+    spectrum = coordinates[..., :num_cosines]/realFourierScales(size) + 0j
+    spectrum[..., 1:(size + 1)//2] -= 1j*coordinates[..., num_cosines:]/np.sqrt(2.0/size)
+    return scipy.fft.irfft(spectrum, n=size, axis=-1)
+
+
+# the eigenvalues of a symmetric circulant matrix, given by its first column, in the order of realFourier
+def realFourierEigenvalues(first_column):
+    size = first_column.shape[0]
+    eigenvalues = np.real(scipy.fft.rfft(first_column))
+    return np.concatenate([eigenvalues, eigenvalues[1:(size + 1)//2]])
+
+
+# the times (the first and last m) and the matrix of the correction K - C between them, None for a series too
+# short for the corners to be apart
+def toeplitzCorrection(first_column):
+    size = first_column.shape[0]
+    corner = int(np.sum(first_column > TOEPLITZ_CUTOFF*first_column[0]))
+    if 2*corner >= size:
+        return None
+    times = np.concatenate([np.arange(corner), np.arange(size - corner, size)])
+    distances = np.abs(times[:, None] - times[None, :])
+    correction = first_column[distances] - circulantApproximation(first_column)[distances]
+    return times, correction
+
+
+# the interval of regularly spaced time coordinates (a column), None if they aren't
+def regularTimeStep(time_coordinates):
+    times = np.asarray(time_coordinates).ravel()
+    if times.shape[0] < 2:
+        return None
+    steps = np.diff(times)
+    if steps[0] <= 0 or not np.allclose(steps, steps[0], rtol=1e-9, atol=0.0):
+        return None
+    return steps[0]
+
+
 ####  end of code to support circulant matrices
 
 def kronecker(A, B):
@@ -128,6 +191,13 @@ def kronecker(A, B):
     return AB
 
 
+# torch.symeig is deprecated (and removed) in later versions of torch, which have torch.linalg.eigh instead
+def symmetricEigen(matrix):
+    if hasattr(torch, 'linalg') and hasattr(torch.linalg, 'eigh'):
+        return torch.linalg.eigh(matrix)
+    return torch.symeig(matrix, eigenvectors=True)
+
+
 # torch repeat
 def tile(a, dim, n_tile):
     init_dim = a.size(dim)
@@ -155,6 +225,21 @@ def combinations(A, B):
 # enough to allow circular/cyclic boundary conditions.  In that case, the fft is used to decompose the time part of the matrix.  If structured=False, then it does not assume this
 # and needs to do a full SVD on that big matrix.   The structured case should be much faster for longer time intervals.
 #
+# The model is solved in factored form (factored=True, the default).  The kernel of the data is
+# signal_variance*(K_t (x) K_s) + noise_variance*I, whose eigenvectors are V_t (x) V_s and eigenvalues
+# signal_variance*(l_t (x) l_s) + noise_variance, from the eigen decompositions of the temporal and spatial kernels.
+# With vec() stacking the columns of a sensors x times matrix, (A (x) B) vec(X) = vec(B X A^T), so the solve,
+# the prediction and the variance are all products of the small factors and the (S*T)^2 matrices are never
+# built -- memory is O(S^2 + T^2) rather than O(S^2 T^2).  factored=False is the original dense solve, kept for
+# benchmark.py.
+#
+# With time_structured the factored solve doesn't decompose the temporal kernel at all: the time series are solved
+# exactly with FFTs, the wrap-around of the circulant being corrected at the corners (see updateStructured), and
+# the time coordinates only have to be regular (otherwise it falls back to the eigen decomposition).  It only pays
+# off for long series (STRUCTURED_MIN_TIMES), such as a whole period solved as one model.  The estimate routes'
+# time chunks (about 240 bins) are below that: solving a long range chunk by chunk with the eigen decomposition is
+# cheaper than solving it as one structured model, once the variances are wanted.
+#
 # Also fixed problems in the kernel calculation (missing factor of 2)
 # Put in lots of print statements that are commented out, that were used for debugging.
 # Tested/debugged the case where query is multiple spatial locations -- this will be used in getEstimateForLocations and getEstimateMap in the API code
@@ -163,7 +248,7 @@ def combinations(A, B):
 class gaussian_model(nn.Module):
     def __init__(self, space_coordinates, time_coordinates, stData,
                  latlon_length_scale=4300., elevation_length_scale=30., time_length_scale=0.25,
-                 noise_variance=0.1, signal_variance=1., time_structured=True):
+                 noise_variance=0.1, signal_variance=1., time_structured=True, factored=True):
         # space_coordinates musth a matrix of [number of space_coordinates x (lat,long,elevation)]
         # in UTM or any meter coordinate.
         # time_coordinates musth a matrix of [number of time_coordinates x 1] in hour formate
@@ -180,6 +265,7 @@ class gaussian_model(nn.Module):
         self.log_signal_variance = nn.Parameter(torch.log(torch.tensor(signal_variance)))
         # this says whether or not you can use the FFT for time
         self.time_structured = time_structured
+        self.factored = factored
         # for reporting purposes
         self.measurements = stData.numel()
 
@@ -209,16 +295,18 @@ class gaussian_model(nn.Module):
                                           torch.exp(self.log_elevation_length_scale))
         spatial_kernel = latlon_kernel * elevation_kernel + torch.eye(latlon_kernel.size(0)) * JITTER
 
-        eigen_value_s, eigen_vector_s = torch.symeig(spatial_kernel, eigenvectors=True)
-        
-        if not self.time_structured:
+        eigen_value_s, eigen_vector_s = symmetricEigen(spatial_kernel)
+
+        if self.factored:
+            self.updateFactored(eigen_value_s, eigen_vector_s)
+        elif not self.time_structured:
             temporal_kernel = self.SE_kernel(
                 self.time_coordinates,
                 self.time_coordinates,
                 torch.exp(self.log_time_length_scale)
                 ) + torch.eye(self.time_coordinates.size(0)) * JITTER
             # np.savetxt('temp_kernel_unstructured.csv', (temporal_kernel).detach().numpy(), delimiter = ';')
-            eigen_value_t, eigen_vector_t = torch.symeig(temporal_kernel, eigenvectors=True)
+            eigen_value_t, eigen_vector_t = symmetricEigen(temporal_kernel)
             eigen_vector_st = kronecker(eigen_vector_t, eigen_vector_s)
             eigen_value_st = kronecker(eigen_value_t.view(-1, 1), eigen_value_s.view(-1, 1)).view(-1)
             eigen_value_st_plus_noise_inverse = 1. / (self.log_signal_variance.exp()*eigen_value_st + torch.exp(self.log_noise_variance))
@@ -264,54 +352,178 @@ class gaussian_model(nn.Module):
 #            
 #            eigen_value_st = torch.from_numpy(np.real(eigen_value_st_np))
 #            print("done conversion to torch")
-            
 
 #        self.sigma_inverse = sigma_inverse
 #        self.alpha = sigma_inverse @ self.stData.transpose(-2, -1).reshape(-1, 1)
 #        self.eigen_value_st = eigen_value_st
 
-    def forward(self, test_space_coordinates, test_time_coordinates):
-        with torch.no_grad():
-            test_latlon_kernel = self.SE_kernel(test_space_coordinates[:, 0:2], self.space_coordinates[:, 0:2],
-                                                 torch.exp(self.log_latlon_length_scale))
-            test_elevation_kernel = self.SE_kernel(test_space_coordinates[:, 2:3], self.space_coordinates[:, 2:3],
-                                                   torch.exp(self.log_elevation_length_scale))
-            test_spatial_kernel = test_latlon_kernel * test_elevation_kernel
-
-            test_temporal_kernel = self.SE_kernel(test_time_coordinates, self.time_coordinates,
-                                                  torch.exp(self.log_time_length_scale))
-
-            test_st_kernel = self.log_signal_variance.exp()*kronecker(test_temporal_kernel, test_spatial_kernel)
-            # alpha is the kernel inverse times the measurements that were taken already
-            #        self.alpha = sigma_inverse @ self.stData.transpose(-2, -1).reshape(-1, 1)
-            if self.time_structured==True:
-                sigma_diag = diagMultTorchLeft(self.eigen_value_st_plus_noise_inverse, ((self.eigen_vector_st).transpose(-2, -1)@self.stData.transpose(-2, -1).reshape(-1, 1)))
+    def temporalEigen(self):
+        temporal_kernel = self.SE_kernel(self.time_coordinates, self.time_coordinates,
+                                         torch.exp(self.log_time_length_scale))
+        temporal_kernel = temporal_kernel + torch.eye(self.time_coordinates.size(0)) * JITTER
+        return symmetricEigen(temporal_kernel)
+
+    def updateFactored(self, eigen_value_s, eigen_vector_s):
+        self.eigen_value_s, self.eigen_vector_s = eigen_value_s, eigen_vector_s
+        # the structured solve needs a regular time grid -- if some bins had no data at all, or the series is too
+        # short, time is decomposed like space
+        self.time_step = None
+        num_times = self.time_coordinates.size(0)
+        min_times = max(STRUCTURED_MIN_TIMES, STRUCTURED_TIMES_PER_SENSOR*eigen_value_s.size(0))
+        if self.time_structured and num_times >= min_times:
+            self.time_step = regularTimeStep(self.time_coordinates)
+        if self.time_step is not None:
+            time_length_scale = float(self.log_time_length_scale.detach().exp())
+            first_column = gaussKernel(np.arange(num_times)*self.time_step/time_length_scale)
+            first_column[0] += JITTER
+            self.toeplitz_correction = toeplitzCorrection(first_column)
+            if self.toeplitz_correction is not None:
+                self.updateStructured(first_column)
+                return
+            self.time_step = None
+        eigen_value_t, eigen_vector_t = self.temporalEigen()
+        self.eigen_value_t, self.eigen_vector_t = eigen_value_t, eigen_vector_t
+        # the eigenvalues of the data kernel as a sensors x times matrix (the nll wants them flat, in vec order)
+        eigen_value_st = eigen_value_s.view(-1, 1) * eigen_value_t.view(1, -1)
+        self.eigen_value_st = eigen_value_st.transpose(-2, -1).reshape(-1)
+        data_eigen_value_st = self.log_signal_variance.exp()*eigen_value_st + torch.exp(self.log_noise_variance)
+        self.eigen_value_st_plus_noise_inverse = 1. / data_eigen_value_st
+        # alpha = sigma_inverse vec(Y) = vec(V_s ((V_s^T Y V_t) / eigenvalues) V_t^T)
+        projected_data = eigen_vector_s.transpose(-2, -1) @ self.stData @ eigen_vector_t
+        projected_alpha = projected_data * self.eigen_value_st_plus_noise_inverse
+        self.alpha_matrix = eigen_vector_s @ projected_alpha @ eigen_vector_t.transpose(-2, -1)
+        self.alpha = self.alpha_matrix.transpose(-2, -1).reshape(-1, 1)
+
+    # the factored solve with time on a regular grid (time_structured).  In the spatial eigenvectors the data
+    # kernel is one system per row, a[i]*K_t + noise_variance*I with a = signal_variance*l_s, each of which is
+    # M[i] + U (a[i]*Z) U^T: M[i] = a[i]*C + noise_variance*I is diagonal in the fourier basis, U picks the corner
+    # times and Z is the correction between them (see toeplitzCorrection).  By Woodbury
+    #   (M + U (aZ) U^T)^-1 x = M^-1 (x - U W U^T M^-1 x),  W = (I + aZ U^T M^-1 U)^-1 aZ
+    # This is done in numpy, so it doesn't train.
+    def updateStructured(self, first_column):
+        signal_variance = float(self.log_signal_variance.detach().exp())
+        noise_variance = float(self.log_noise_variance.detach().exp())
+        eigen_value_s = self.eigen_value_s.detach().numpy()
+        eigen_vector_s = self.eigen_vector_s.detach().numpy()
+        corner_times, correction = self.toeplitz_correction
+        scales = signal_variance*eigen_value_s
+
+        self.fourier_eigen_value_t = realFourierEigenvalues(circulantApproximation(first_column))
+        # M^-1 in the fourier basis, sensor eigenvectors x fourier vectors
+        self.circulant_inverse = 1.0/(scales[:, None]*self.fourier_eigen_value_t[None, :] + noise_variance)
+        # the rows of the fourier basis at the corner times, and U^T M^-1 U for each sensor eigenvector
+        num_times = first_column.shape[0]
+        num_corners = corner_times.shape[0]
+        self.corner_fourier = realFourier(np.eye(num_times)[corner_times])
+        corner_products = (self.corner_fourier[:, None, :]*self.corner_fourier[None, :, :]).reshape(-1, num_times)
+        corner_inverse = (corner_products @ self.circulant_inverse.T).T.reshape(-1, num_corners, num_corners)
+        scaled_correction = scales[:, None, None]*correction[None, :, :]
+        self.woodbury = np.linalg.solve(np.eye(num_corners) + scaled_correction @ corner_inverse, scaled_correction)
+
+        projected_data = realFourier(eigen_vector_s.T @ self.stData.detach().numpy())
+        corner_values = (projected_data*self.circulant_inverse) @ self.corner_fourier.T
+        corrected = projected_data - np.einsum('iuv,iv->iu', self.woodbury, corner_values) @ self.corner_fourier
+        self.alpha_matrix = torch.from_numpy(eigen_vector_s @ inverseRealFourier(corrected*self.circulant_inverse))
+        self.alpha = self.alpha_matrix.transpose(-2, -1).reshape(-1, 1)
+
+        # the likelihood uses the eigenvalues of the circulant approximation
+        self.eigen_value_t = torch.from_numpy(self.fourier_eigen_value_t)
+        self.eigen_value_st = kronecker(self.eigen_value_t.view(-1, 1), self.eigen_value_s.view(-1, 1)).view(-1)
+
+    # the diagonals of K*_t (a[i]*K_t + noise_variance*I)^-1 K*_t^T for each sensor eigenvector i, as (test times x
+    # sensor eigenvectors), using the same Woodbury form as updateStructured
+    def structuredTemporalVariances(self, test_temporal_kernel):
+        test_fourier = realFourier(test_temporal_kernel.numpy())
+        num_corners = self.corner_fourier.shape[0]
+        block_width = num_corners*max(test_fourier.shape[1], self.circulant_inverse.shape[0])
+        block_rows = max(1, STRUCTURED_BLOCK_ELEMENTS//block_width)
+        variances = (test_fourier**2) @ self.circulant_inverse.T
+        for first in range(0, test_fourier.shape[0], block_rows):
+            block = test_fourier[first:first + block_rows]
+            # U^T M^-1 k for each sensor eigenvector, test time and corner time
+            block_products = (block[:, None, :]*self.corner_fourier[None, :, :]).reshape(-1, block.shape[1])
+            corner_values = (block_products @ self.circulant_inverse.T).T.reshape(-1, block.shape[0], num_corners)
+            corrections = np.sum(np.matmul(corner_values, self.woodbury)*corner_values, axis=2)
+            variances[first:first + block_rows] -= corrections.T
+        return torch.from_numpy(variances)
+
+    # the mean and variance at all of the test locations x test times, from the spatial and temporal test kernels
+    def forwardFactored(self, test_spatial_kernel, test_temporal_kernel, variance=True):
+        # the parameters are single precision, and the variance squares this
+        signal_variance = self.log_signal_variance.exp().to(test_spatial_kernel.dtype)
+        # test_st_kernel @ alpha = signal_variance * vec(K*_s alpha K*_t^T)
+        yPred = signal_variance * (test_spatial_kernel @ self.alpha_matrix @ test_temporal_kernel.transpose(-2, -1))
+        if not variance:
+            return yPred, None
+        # the diagonal of test_st_kernel @ sigma_inverse @ test_st_kernel^T: with A = K*_s V_s and B = K*_t V_t,
+        # the row of test_st_kernel @ (V_t (x) V_s) for (time j, location i) is signal_variance * (B[j] (x) A[i])
+        spatial_projection = test_spatial_kernel @ self.eigen_vector_s
+        if self.time_step is not None:
+            temporal_variances = self.structuredTemporalVariances(test_temporal_kernel)
+            explained = (spatial_projection**2) @ temporal_variances.transpose(-2, -1)
+        else:
+            temporal_projection = test_temporal_kernel @ self.eigen_vector_t
+            explained = ((spatial_projection**2) @ self.eigen_value_st_plus_noise_inverse
+                         @ (temporal_projection**2).transpose(-2, -1))
+        yVar = signal_variance - signal_variance**2 * explained
+        return yPred, yVar
+
+    # the original, on the dense (S*T) x (S*T) matrices (factored=False)
+    def forwardDense(self, test_spatial_kernel, test_temporal_kernel, variance=True):
+        test_st_kernel = self.log_signal_variance.exp()*kronecker(test_temporal_kernel, test_spatial_kernel)
+        # alpha is the kernel inverse times the measurements that were taken already
+        #        self.alpha = sigma_inverse @ self.stData.transpose(-2, -1).reshape(-1, 1)
+        if self.time_structured==True:
+            sigma_diag = diagMultTorchLeft(self.eigen_value_st_plus_noise_inverse, ((self.eigen_vector_st).transpose(-2, -1)@self.stData.transpose(-2, -1).reshape(-1, 1)))
 #                print("done with sigma_diag")
-                yPred = (test_st_kernel@self.eigen_vector_st)@sigma_diag
+            yPred = (test_st_kernel@self.eigen_vector_st)@sigma_diag
 #                print("done with yPred")
-                yVar = torch.zeros(test_st_kernel.size(0))
-                test_times_eigen = test_st_kernel@ self.eigen_vector_st
-                # for i in range(test_st_kernel.size(0)):
-                #     yVar[i] = self.log_signal_variance.exp() - test_times_eigen[i:i+1, :] @diagMultTorchLeft(self.eigen_value_st_plus_noise_inverse, test_times_eigen[i:i+1, :] .t())
+            yVar = torch.zeros(test_st_kernel.size(0))
+            test_times_eigen = test_st_kernel@ self.eigen_vector_st
+            # for i in range(test_st_kernel.size(0)):
+            #     yVar[i] = self.log_signal_variance.exp() - test_times_eigen[i:i+1, :] @diagMultTorchLeft(self.eigen_value_st_plus_noise_inverse, test_times_eigen[i:i+1, :] .t())
 #                yVar = torch.diagonal(self.log_signal_variance.exp()*torch.eye(test_st_kernel.size(0)) - test_times_eigen@diagMultTorchLeft(self.eigen_value_st_plus_noise_inverse, test_times_eigen.t()))
-                yVar = self.log_signal_variance.exp()*torch.ones(test_st_kernel.size(0)) - torch.einsum("ij,ji->i", test_times_eigen, diagMultTorchLeft(self.eigen_value_st_plus_noise_inverse, test_times_eigen.t()))
+            yVar = self.log_signal_variance.exp()*torch.ones(test_st_kernel.size(0)) - torch.einsum("ij,ji->i", test_times_eigen, diagMultTorchLeft(self.eigen_value_st_plus_noise_inverse, test_times_eigen.t()))
 #                print(test_times_eigen.shape)
 #                print(diagMultTorchLeft(self.eigen_value_st_plus_noise_inverse, test_times_eigen.t()))
 
 #                print("done with yVar")
 
-                yPred = yPred.view(test_time_coordinates.size(0), test_space_coordinates.size(0)).transpose(-2, -1)
-                yVar = yVar.view(test_time_coordinates.size(0), test_space_coordinates.size(0)).transpose(-2, -1)
+            yPred = yPred.view(test_temporal_kernel.size(0), test_spatial_kernel.size(0)).transpose(-2, -1)
+            yVar = yVar.view(test_temporal_kernel.size(0), test_spatial_kernel.size(0)).transpose(-2, -1)
 
-            else:
-                yPred = test_st_kernel @ self.alpha
+        else:
+            yPred = test_st_kernel @ self.alpha
+            yPred = yPred.view(test_temporal_kernel.size(0), test_spatial_kernel.size(0)).transpose(-2, -1)
+            if not variance:
+                return yPred, None
+
+            # the diagonal of test_st_kernel @ sigma_inverse @ test_st_kernel^T, a block of rows at a time
+            yVar = torch.empty(test_st_kernel.size(0), dtype=test_st_kernel.dtype)
+            for first in range(0, test_st_kernel.size(0), VARIANCE_BLOCK_ROWS):
+                block = test_st_kernel[first:first + VARIANCE_BLOCK_ROWS]
+                explained = ((block @ self.sigma_inverse) * block).sum(dim=1)
+                yVar[first:first + VARIANCE_BLOCK_ROWS] = self.log_signal_variance.exp() - explained
+
+            yVar = yVar.view(test_temporal_kernel.size(0), test_spatial_kernel.size(0)).transpose(-2, -1)
+        return yPred, (yVar if variance else None)
+
+    # variance=False skips the variance (yVar is None), for callers that only want the mean
+    def forward(self, test_space_coordinates, test_time_coordinates, variance=True):
+        with torch.no_grad():
+            test_latlon_kernel = self.SE_kernel(test_space_coordinates[:, 0:2], self.space_coordinates[:, 0:2],
+                                                 torch.exp(self.log_latlon_length_scale))
+            test_elevation_kernel = self.SE_kernel(test_space_coordinates[:, 2:3], self.space_coordinates[:, 2:3],
+                                                   torch.exp(self.log_elevation_length_scale))
+            test_spatial_kernel = test_latlon_kernel * test_elevation_kernel
 
-                yVar = torch.zeros(test_st_kernel.size(0))
-                for i in range(test_st_kernel.size(0)):
-                    yVar[i] = self.log_signal_variance.exp() - test_st_kernel[i:i + 1, :] @ self.sigma_inverse @ test_st_kernel[i:i + 1, :].t()
+            test_temporal_kernel = self.SE_kernel(test_time_coordinates, self.time_coordinates,
+                                                  torch.exp(self.log_time_length_scale))
 
-                yPred = yPred.view(test_time_coordinates.size(0), test_space_coordinates.size(0)).transpose(-2, -1)
-                yVar = yVar.view(test_time_coordinates.size(0), test_space_coordinates.size(0)).transpose(-2, -1)
+            if self.factored:
+                yPred, yVar = self.forwardFactored(test_spatial_kernel, test_temporal_kernel, variance)
+            else:
+                yPred, yVar = self.forwardDense(test_spatial_kernel, test_temporal_kernel, variance)
 
             status_string = str(self.measurements) + " measurements"
             status = [status_string for i in range(test_time_coordinates.size(0))]
@@ -9,6 +9,8 @@ import logging
 
 
 JANUARY1ST = datetime(2000, 1, 1, 0, 0, 0, 0, pytz.timezone('UTC'))
+# the same instant for the (naive UTC) datetime64 times in a SensorData
+JANUARY1ST64 = numpy.datetime64('2000-01-01T00:00:00', 'us')
 TIME_COORDINATE_BIN_NUMBER_KEY = 'time_coordinate_bin_number'
 
 ##  These are indices into the sensor map
@@ -48,8 +50,9 @@ def getTimeCoordinateBin(datetime, time_offset=0):
     return bin_number - time_offset
 
 
+# dates is a datetime64 array (see utils.interpolateQueryDates), binned like the sensor data
 def convertToTimeCoordinatesVector(dates, time_offset):
-    return [getTimeCoordinateBin(date, time_offset=time_offset) for date in dates]
+    return binHours(timeBinIndices(numpy.asarray(dates, dtype='datetime64[us]'))) - time_offset
 
 
 def createTimeVector(sensor_data, time_lo_bound = -1.0, time_hi_bound = -1.0):
@@ -85,6 +88,19 @@ def createTimeVector(sensor_data, time_lo_bound = -1.0, time_hi_bound = -1.0):
     return time_coordinates, lowest_bin_number
 
 
+# whether time bounds (datetimes or datetime64) are given, -1.0 for either one means no bounds
+def hasTimeBounds(time_lo_bound, time_hi_bound):
+    return not any(isinstance(bound, float) and bound == -1.0 for bound in (time_lo_bound, time_hi_bound))
+
+
+# which measurements of a SensorData fall within the (optional) time bounds
+def timeBoundsMask(sensor_data, time_lo_bound=-1.0, time_hi_bound=-1.0):
+    if not hasTimeBounds(time_lo_bound, time_hi_bound):
+        return numpy.full(len(sensor_data), True)
+    times = sensor_data['time']
+    return (times >= utils.toDatetime64(time_lo_bound)) & (times <= utils.toDatetime64(time_hi_bound))
+
+
 # organize the measurement data into time bins for each sensor
 def assignTimeData(sensor_data, device_location_map, time_offset, time_lo_bound = -1.0, time_hi_bound = -1.0):
 # This loads the device_location_map with a set of bins, and each bin contains all of the measurements associated with that bin and that device.  Later we will average these or choose one of them (median)
@@ -158,6 +174,133 @@ def createSpaceVector2(sensor_data, time_array_size):
     return space_coordinates, device_location_map
 
 
+# integer time bins: the number of whole NUM_MINUTES_PER_BIN periods since JANUARY1ST
+def timeBinIndices(times):
+    return (times - JANUARY1ST64) // numpy.timedelta64(NUM_MINUTES_PER_BIN, 'm')
+
+
+# the time coordinates (hours since JANUARY1ST) of integer time bins.  The same float arithmetic as
+# getTimeCoordinateBin, so the coordinates match it exactly -- only the bins are found in integers here,
+# where getTimeCoordinateBin rounds seconds to float minutes first.
+def binHours(bins):
+    return (bins * NUM_MINUTES_PER_BIN).astype(float) / 60
+
+
+# The binning stage in one go, instead of createTimeVector, createSpaceVector2, assignTimeData and
+# computeTimeArrays.  Every measurement gets an integer bin, and the median of each (sensor, bin) goes
+# straight into the sensors x bins data matrix (-1 where a sensor has nothing in a bin).  The medians are
+# of all of the readings in the bin -- the sets the old version collected them in dropped repeated values.
+# Rows are sensors in order of first appearance, at the location of their first measurement, and the
+# columns are the bins that have any measurement, with the same (hour) time coordinates and time offset
+# as createTimeVector.  Returns data_matrix, space_coordinates, time_coordinates, time_offset.
+def binSensorData(sensor_data, time_lo_bound=-1.0, time_hi_bound=-1.0):
+    ids, codes = sensor_data.sensorCodes()
+    unique_codes, first_index = numpy.unique(codes, return_index=True)
+    space_coordinates = numpy.column_stack((sensor_data['utm_x'][first_index],
+                                            sensor_data['utm_y'][first_index],
+                                            sensor_data['Altitude'][first_index])).astype(float)
+
+    in_range = timeBoundsMask(sensor_data, time_lo_bound, time_hi_bound)
+    bins = timeBinIndices(sensor_data['time'][in_range])
+    if bins.shape[0] == 0:
+        return numpy.full((ids.shape[0], 0), -1.0), space_coordinates, numpy.empty((0, 1)), None
+    bin_numbers, columns = numpy.unique(bins, return_inverse=True)
+    bin_hours = binHours(bin_numbers)
+    time_offset = bin_hours[0]
+    time_coordinates = numpy.expand_dims(bin_hours - time_offset, axis=1)
+
+    data_matrix = numpy.full((ids.shape[0], bin_numbers.shape[0]), -1.0)
+    cells, medians = binMedians(codes[in_range] * bin_numbers.shape[0] + columns.reshape(-1),
+                                sensor_data['PM2_5'][in_range].astype(float))
+    data_matrix.flat[cells] = medians
+    return data_matrix, space_coordinates, time_coordinates, time_offset
+
+
+# The data matrix of all of the measurements, built once so that every time chunk can take its window of
+# it (windowDataMatrix, which gives the same as binSensorData with the chunk's bounds) instead of binning
+# the data again.  Also keeps, for each bin, which measurements are
+# in it, so that the bins cut by a chunk's time bounds can be redone with just the measurements inside.
+def binAllSensorData(sensor_data):
+    ids, codes = sensor_data.sensorCodes()
+    unique_codes, first_index = numpy.unique(codes, return_index=True)
+    space_coordinates = numpy.column_stack((sensor_data['utm_x'][first_index],
+                                            sensor_data['utm_y'][first_index],
+                                            sensor_data['Altitude'][first_index])).astype(float)
+
+    bin_numbers, columns = numpy.unique(timeBinIndices(sensor_data['time']), return_inverse=True)
+    columns = columns.reshape(-1)
+    values = sensor_data['PM2_5'].astype(float)
+    data_matrix = numpy.full((ids.shape[0], bin_numbers.shape[0]), -1.0)
+    cells, medians = binMedians(codes * bin_numbers.shape[0] + columns, values)
+    data_matrix.flat[cells] = medians
+
+    by_column = numpy.argsort(columns, kind='stable')
+    return {
+        'data_matrix': data_matrix,
+        'space_coordinates': space_coordinates,
+        'bin_numbers': bin_numbers,
+        'bin_hours': binHours(bin_numbers),
+        'by_column': by_column,
+        'column_starts': numpy.searchsorted(columns[by_column], numpy.arange(bin_numbers.shape[0] + 1)),
+        'codes': codes,
+        'times': sensor_data['time'],
+        'values': values,
+    }
+
+
+# the median of the values of each distinct cell (any integer label), as statistics.median.  Sorted by
+# (cell, value), the median is the middle value of each cell's run, or the mean of the two middle ones.
+# Returns the cells and their medians.
+def binMedians(cells, values):
+    if cells.shape[0] == 0:
+        return cells, values
+    order = numpy.lexsort((values, cells))
+    cells = cells[order]
+    values = values[order]
+    starts = numpy.flatnonzero(numpy.concatenate(([True], cells[1:] != cells[:-1])))
+    counts = numpy.diff(numpy.append(starts, cells.shape[0]))
+    return cells[starts], (values[starts + (counts - 1) // 2] + values[starts + counts // 2]) / 2
+
+
+# The data matrix of the measurements within the time bounds, from the matrix of binAllSensorData.  The bins
+# inside the bounds are a slice of its columns, only the (at most two) bins the bounds cut through are
+# recomputed from their measurements inside the bounds, and dropped if there aren't any.  The result is
+# a copy, the gap filling works in place and the windows of neighbouring chunks overlap.  Returns
+# data_matrix, space_coordinates, time_coordinates, time_offset, as binSensorData.
+def windowDataMatrix(binned, time_lo_bound=-1.0, time_hi_bound=-1.0):
+    bin_numbers = binned['bin_numbers']
+    if not hasTimeBounds(time_lo_bound, time_hi_bound):
+        first, last = 0, bin_numbers.shape[0]
+        data_matrix = binned['data_matrix'].copy()
+        keep = numpy.full(last - first, True)
+    else:
+        bounds = numpy.array([utils.toDatetime64(time_lo_bound), utils.toDatetime64(time_hi_bound)])
+        edge_bins = timeBinIndices(bounds)
+        first = numpy.searchsorted(bin_numbers, edge_bins[0])
+        last = max(first, numpy.searchsorted(bin_numbers, edge_bins[1], side='right'))
+        data_matrix = binned['data_matrix'][:, first:last].copy()
+        keep = numpy.full(last - first, True)
+        for column in sorted({first, last - 1}) if last > first else []:
+            if bin_numbers[column] != edge_bins[0] and bin_numbers[column] != edge_bins[1]:
+                continue
+            in_bin = binned['by_column'][binned['column_starts'][column]:binned['column_starts'][column + 1]]
+            times = binned['times'][in_bin]
+            in_bin = in_bin[(times >= bounds[0]) & (times <= bounds[1])]
+            rows, medians = binMedians(binned['codes'][in_bin], binned['values'][in_bin])
+            data_matrix[:, column - first] = -1.0
+            data_matrix[rows, column - first] = medians
+            keep[column - first] = in_bin.shape[0] > 0
+    if not numpy.all(keep):
+        data_matrix = data_matrix[:, keep]
+
+    bin_hours = binned['bin_hours'][first:last][keep]
+    if bin_hours.shape[0] == 0:
+        return data_matrix, binned['space_coordinates'], numpy.empty((0, 1)), None
+    time_offset = bin_hours[0]
+    time_coordinates = numpy.expand_dims(bin_hours - time_offset, axis=1)
+    return data_matrix, binned['space_coordinates'], time_coordinates, time_offset
+
+
 # used for debugging - you can use the "save_matrices" flag to get intermediate data to files. 
 def saveMatrixToFile(matrix, filename):
     with open(filename, 'w') as output_file:
@@ -169,45 +312,52 @@ def saveMatrixToFile(matrix, filename):
 
 # goal is to fill in zero/bad elements in between two values
 # only do short distances, e.g.  1 > <  SENSOR_INTERPOLATE_DISTANCE (missing bins)
+#
+# Works a row at a time, with one np.interp per row, and gives exactly what the element by element original
+# (interpolateBadElementsLoop in benchmark.py) gives.  That walks along the row keeping the position of the last
+# value it interpolated from, and only moves it on when it interpolates, so:
+#   - within a run of good values it moves two at a time, and the values it steps over are replaced by the
+#     line between their neighbours
+#   - after a run it interpolates across the gap to the next run if that is < SENSOR_INTERPOLATE_DISTANCE
+#     from where it is, and the next run starts over
+#   - otherwise the row has failed and it doesn't move again, so nothing further along is interpolated
+#   - a gap < SENSOR_INTERPOLATE_DISTANCE at the start is filled with the first good value, and one at the end
+#     (counted from where it stopped) with the value it stopped at
 def interpolateBadElements(matrix, bad_value = 0):
     num_interp_fails = 0
+    num_columns = matrix.shape[1]
     for row in matrix:
-        prevValueIndex = None
-        this_fail = False
-        for i in range(row.shape[0]):
-            if row[i] != bad_value:
-                if prevValueIndex is None:
-                    prevValueIndex = i
-                    # this takes care of the boundary at the beginning of the time sequence
-                    if (i > 0) and (i < SENSOR_INTERPOLATE_DISTANCE):
-                        row[0:i] = row[i]
-                else:
-                    curValueIndex = i
-                    distance = curValueIndex - prevValueIndex
-                    if (distance > 1):
-                        if (distance < SENSOR_INTERPOLATE_DISTANCE):
-                        # interpolate zeros between prev and cur
-                            terp = numpy.interp(range(prevValueIndex + 1, curValueIndex), [prevValueIndex, curValueIndex], [row[prevValueIndex], row[curValueIndex]])
-                            row[prevValueIndex + 1:curValueIndex] = terp
-                            prevValueIndex = curValueIndex
-                        else:
-                            this_fail = True
-        if this_fail:
+        good = numpy.flatnonzero(row != bad_value)
+        if good.shape[0] == 0:
+            if row[-1] == bad_value:
+                logging.debug("got full row of bad indices?" + str(row))
+            continue
+        # runs of good values, and where the walk leaves each of them (an even number of steps in)
+        breaks = numpy.flatnonzero(numpy.diff(good) > 1)
+        run_starts = good[numpy.concatenate(([0], breaks + 1))]
+        run_ends = good[numpy.concatenate((breaks, [good.shape[0] - 1]))]
+        run_leaves = run_ends - (run_ends - run_starts) % 2
+        gaps_ok = (run_starts[1:] - run_leaves[:-1]) < SENSOR_INTERPOLATE_DISTANCE
+        num_active = run_starts.shape[0] if numpy.all(gaps_ok) else numpy.argmin(gaps_ok) + 1
+        if num_active < run_starts.shape[0]:
             num_interp_fails += 1
+
+        # the values the walk interpolates from, and everything in between them gets interpolated
+        anchors = numpy.concatenate([numpy.arange(start, leave + 1, 2) for start, leave
+                                     in zip(run_starts[:num_active].tolist(), run_leaves[:num_active].tolist())])
+        between = numpy.setdiff1d(numpy.arange(anchors[0], anchors[-1] + 1), anchors, assume_unique=True)
+        if between.shape[0] > 0:
+            row[between] = numpy.interp(between, anchors, row[anchors])
+
+        # this takes care of the boundary at the beginning of the time sequence
+        if (good[0] > 0) and (good[0] < SENSOR_INTERPOLATE_DISTANCE):
+            row[0:good[0]] = row[good[0]]
         # take care of bad values and end of time range
-        if row[-1] == bad_value:
-            curValueIndex = row.shape[0]-1
-            if (prevValueIndex != None):
-                distance = curValueIndex - prevValueIndex
-                if (distance < SENSOR_INTERPOLATE_DISTANCE):            
-                    row[prevValueIndex+1: curValueIndex+1] = row[prevValueIndex]
-            else:
-                logging.debug("got full row of bad indices?" + str(row))
-        if (float(num_interp_fails)/matrix.shape[0]) > FRACTION_SIGNIFICANT_FAILS:
-            logging.warn("got %d interp failures out of %d sensors", num_interp_fails, matrix.shape[0])
-            # saveMatrixToFile(matrix, 'failed_interp_matrix.txt')            
-                
-        
+        if row[-1] == bad_value and (num_columns - 1 - anchors[-1]) < SENSOR_INTERPOLATE_DISTANCE:
+            row[anchors[-1] + 1:] = row[anchors[-1]]
+    if matrix.shape[0] > 0 and (float(num_interp_fails)/matrix.shape[0]) > FRACTION_SIGNIFICANT_FAILS:
+        logging.warn("got %d interp failures out of %d sensors", num_interp_fails, matrix.shape[0])
+
 
 def trimBadEdgeElements(matrix, time_coordinates, bad_value=-1):
     # record index of edge values for each row
@@ -316,6 +466,19 @@ def setupDataMatrix2(sensor_data, space_coordinates, time_coordinates, device_lo
 #            data_matrix[space_index,i] = time_data_array[i,0]
         data_matrix[space_index,:] = time_data_array
 
+    data_matrix, space_coordinates = cleanDataMatrix(data_matrix, space_coordinates)
+
+# for debugging report id of last sensor in matrix - to get raw data
+    # print("ID of last sensor is")
+    # print(space_coordinates[space_coordinates.shape[0]-1, :])
+    # print(getSensorIDByMatrixPosition(sensor_data, space_coordinates, (space_coordinates.shape[0]-1)))
+
+    return data_matrix, space_coordinates, time_coordinates
+
+
+# the clean up half of setupDataMatrix2: fill short gaps, drop the sensors with too little data and fill in
+# what is still missing from the time slice averages
+def cleanDataMatrix(data_matrix, space_coordinates):
 # check to make sure we have data        
     if (data_matrix.size > 0):
         # saveMatrixToFile(data_matrix, '1matrix.txt')
@@ -339,13 +502,7 @@ def setupDataMatrix2(sensor_data, space_coordinates, time_coordinates, device_lo
         # saveMatrixToFile(data_matrix, '4matrix_filled_bad.txt')
         # numpy.savetxt('4filled_bad.csv', data_matrix, delimiter=',')
 
-
-# for debugging report id of last sensor in matrix - to get raw data
-    # print("ID of last sensor is")
-    # print(space_coordinates[space_coordinates.shape[0]-1, :])
-    # print(getSensorIDByMatrixPosition(sensor_data, space_coordinates, (space_coordinates.shape[0]-1)))
-
-    return data_matrix, space_coordinates, time_coordinates
+    return data_matrix, space_coordinates
 
 
 
@@ -358,15 +515,8 @@ def fillInMissingReadings(data_matrix, bad_value = 0.):
         logging.warn("WARNING: got time slice with too few data sensor values with value " + str(float(numpy.min(data_counts))/float(data_matrix.shape[0])) + " and index "  + str(numpy.nonzero((data_counts/data_matrix.shape[0]) < 0.75)))
     sum_tmp = numpy.sum(numpy.multiply(data_matrix,data_mask), 0)
     time_averages = numpy.divide(sum_tmp, data_counts, out=numpy.zeros_like(sum_tmp), where=(data_counts!=0))
-    for idx in numpy.ndindex(data_matrix.shape):
-        if data_matrix[idx] == bad_value:
-            data_matrix[idx] = time_averages[idx[1]]
-    # it = numpy.nditer(data_matrix, flags=['multi_index'], op_flags=['readwrite'])
-    # for data_value in it:
-    #     if data_value == bad_value:
-    #         print("got bad value at " + str(it.multi_index) + " filling in with " + str(time_averages[it.multi_index[1]]))
-    #         data_value = time_averages[it.multi_index[1]]
-    # it.close()
+    # every bad value gets the average of its time slice (column)
+    data_matrix[~data_mask] = numpy.broadcast_to(time_averages, data_matrix.shape)[~data_mask]
     return data_matrix
 
 
@@ -391,15 +541,21 @@ def computeTimeArrays(sensor_data, device_location_map, time_coordinates):
 # Nov 2020 : This has been modified so that it takes bounds on the times considered.  This is for use in breaking up long time sequences into smaller chunks for efficiency
 def createModel(sensor_data, latlon_length_scale, elevation_length_scale, time_length_scale, time_lo_bound = -1.0, time_hi_bound = -1.0, save_matrices=False):
 
-    time_coordinates, time_offset = createTimeVector(sensor_data, time_lo_bound, time_hi_bound)
-##    space_coordinates, device_location_map = createSpaceVector(sensor_data)
-# this builds up the first instance of the device_location_map
-# sucessive calls will process and fill in the time data
-    space_coordinates, device_location_map = createSpaceVector2(sensor_data, time_coordinates.shape[0])
-    assignTimeData(sensor_data, device_location_map, time_offset, time_lo_bound, time_hi_bound)
-    computeTimeArrays(sensor_data, device_location_map, time_coordinates)
-#    data_matrix, space_coordinates, time_coordinates = setupDataMatrix(sensor_data, space_coordinates, time_coordinates, device_location_map)
-    data_matrix, space_coordinates, time_coordinates = setupDataMatrix2(sensor_data, space_coordinates, time_coordinates, device_location_map)
+    # sensor_data is a SensorData (see sensor_data.py).  binSensorData does what createTimeVector,
+    # createSpaceVector2, assignTimeData, computeTimeArrays and the first half of setupDataMatrix2 used to do
+    data_matrix, space_coordinates, time_coordinates, time_offset = binSensorData(sensor_data, time_lo_bound,
+                                                                                  time_hi_bound)
+    model, status = createModelFromDataMatrix(data_matrix, space_coordinates, time_coordinates,
+                                              latlon_length_scale, elevation_length_scale, time_length_scale)
+    return model, time_offset, status
+
+
+# the second half of createModel, for a data matrix that has been binned but not cleaned up yet (e.g. a time
+# chunk's window from windowDataMatrix).  time_structured solves the time part of the model with FFTs when the
+# bins are regular (see gaussian_model.py)
+def createModelFromDataMatrix(data_matrix, space_coordinates, time_coordinates, latlon_length_scale,
+                              elevation_length_scale, time_length_scale, time_structured=True):
+    data_matrix, space_coordinates = cleanDataMatrix(data_matrix, space_coordinates)
 
     if (data_matrix.size > 0):
         space_coordinates = torch.tensor(space_coordinates)     # convert data to pytorch tensor
@@ -407,10 +563,11 @@ def createModel(sensor_data, latlon_length_scale, elevation_length_scale, time_l
         data_matrix = torch.tensor(data_matrix)   # convert data to pytorch tensor
 
         model = gaussian_model.gaussian_model(space_coordinates, time_coordinates, data_matrix,
-                                                  latlon_length_scale=float(latlon_length_scale),
-                                                  elevation_length_scale=float(elevation_length_scale),
-                                                  time_length_scale=float(time_length_scale),
-                                                  noise_variance=36.0, signal_variance=400.0, time_structured=False)
+                                              latlon_length_scale=float(latlon_length_scale),
+                                              elevation_length_scale=float(elevation_length_scale),
+                                              time_length_scale=float(time_length_scale),
+                                              noise_variance=36.0, signal_variance=400.0,
+                                              time_structured=time_structured)
         status = ""
     else:
         model = None
@@ -424,11 +581,12 @@ def createModel(sensor_data, latlon_length_scale, elevation_length_scale, time_l
         # numpy.savetxt('time_scale.csv', numpy.full([1], time_length_scale), delimiter=',')
         # numpy.savetxt('elevation_scale.csv', numpy.full([1], elevation_length_scale), delimiter=',')
 
-    return model, time_offset, status
+    return model, status
 
 
 # Ross changed this to do the formatting in the api_routes call instead of here
-def estimateUsingModel(model, lats, lons, elevations, query_dates, time_offset, save_matrices=False):
+# variance=False only estimates the mean, yVar is None
+def estimateUsingModel(model, lats, lons, elevations, query_dates, time_offset, save_matrices=False, variance=True):
 
     # converts from absolute dates to the local time coordinate system (in hours).  time_offset is the date of the first bin in the sensor data
     time_coordinates = convertToTimeCoordinatesVector(query_dates, time_offset)
@@ -467,11 +625,12 @@ def estimateUsingModel(model, lats, lons, elevations, query_dates, time_offset,
         # numpy.savetxt('query_space_coords.csv', space_coordinates, delimiter=',')
         # numpy.savetxt('query_time_coords.csv', query_time, delimiter=',')
     
-    yPred, yVar, status = model(query_space, query_time)
+    yPred, yVar, status = model(query_space, query_time, variance=variance)
     yPred = numpy.maximum(yPred.numpy(), 0.0)
-    yVar = yVar.numpy()
-    if numpy.amin(yVar) < 0.0:
-        logging.warn("Got negative values in variance, suggesting a numerical problem")
+    if variance:
+        yVar = yVar.numpy()
+        if numpy.amin(yVar) < 0.0:
+            logging.warn("Got negative values in variance, suggesting a numerical problem")
 
     return yPred, yVar, status
 
@@ -0,0 +1,132 @@
+# The latest reading of every live sensor, kept in memory for /api/liveSensors.
+#
+# The route used to run a GROUP BY ID, max(time) self-join per source table on every cache miss, and since
+# the cache is per process every worker repeated it about once a minute.  Here a background thread keeps a
+# table of the newest reading per (source, ID).  Each poll only asks the store for measurements newer than
+# the high-water mark (the newest time seen so far, less LATE_ARRIVAL_MARGIN for rows that land a little
+# late), and the whole table is reloaded every FULL_RELOAD_INTERVAL so that very late rows are not missed.
+# Requests are answered from the table, filtered down to the sensors that reported inside their source's
+# live window.  The age of the table is reported with every answer so that callers can tell how stale it is.
+
+from datetime import datetime, timezone
+import logging
+import threading
+import time
+import numpy as np
+from aqandu import measurement_store
+
+
+# how recently a sensor has to have reported to be "live" (the windows the old queries used)
+LIVE_WINDOWS = {
+    "AirU": np.timedelta64(1, "h"),
+    "PurpleAir": np.timedelta64(1, "h"),
+    "DAQ": np.timedelta64(3, "h"),
+}
+LATE_ARRIVAL_MARGIN = np.timedelta64(10, "m")
+FULL_RELOAD_INTERVAL = 3600
+# the live sensors aren't limited to a region
+WORLD_BOX = (-90.0, 90.0, -180.0, 180.0)
+
+
+class LiveSnapshot:
+    def __init__(self, store, poll_seconds=30, max_age_seconds=180):
+        self.store = store
+        self.poll_seconds = poll_seconds
+        self.max_age_seconds = max_age_seconds
+        self.lock = threading.Lock()
+        self.latest = {}
+        self.high_water = None
+        self.refreshed_at = None
+        self.reloaded_at = None
+        self.thread = None
+        self.stop_event = threading.Event()
+
+    def start(self):
+        """Start the background refresher (once), which also does the first load -- until then isFresh() is False"""
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.thread = threading.Thread(target=self.run, name="live-snapshot", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def run(self):
+        self.refresh()
+        while not self.stop_event.wait(self.poll_seconds):
+            self.refresh()
+
+    def refresh(self):
+        now = measurement_store.toDatetime64(datetime.now(timezone.utc))
+        full_reload = self.high_water is None or time.time() - self.reloaded_at >= FULL_RELOAD_INTERVAL
+        if full_reload:
+            since = now - max(LIVE_WINDOWS.values())
+        else:
+            since = self.high_water - LATE_ARRIVAL_MARGIN
+        try:
+            column_data = self.store.queryColumns(*WORLD_BOX,
+                                                  measurement_store.fromDatetime64(since),
+                                                  measurement_store.fromDatetime64(now),
+                                                  columns=measurement_store.MEASUREMENT_COLUMNS)
+        except Exception:
+            logging.exception("Live sensor snapshot refresh failed")
+            return False
+
+        latest = {} if full_reload else dict(self.latest)
+        # newest last, so later rows replace earlier ones
+        order = np.argsort(column_data["time"], kind="stable")
+        for index in order:
+            key = (column_data["SensorSource"][index], str(column_data["ID"][index]))
+            reading_time = column_data["time"][index]
+            if key not in latest or latest[key]["time64"] <= reading_time:
+                latest[key] = {
+                    "time64": reading_time,
+                    "ID": key[1],
+                    "Latitude": float(column_data["Latitude"][index]),
+                    "Longitude": float(column_data["Longitude"][index]),
+                    "time": measurement_store.fromDatetime64(reading_time),
+                    "PM2_5": float(column_data["PM2_5"][index]),
+                    "SensorModel": column_data["SensorModel"][index],
+                    "SensorSource": key[0],
+                }
+
+        # drop the sensors that have gone quiet
+        for key in [key for key, reading in latest.items() if reading["time64"] < now - LIVE_WINDOWS[key[0]]]:
+            del latest[key]
+
+        with self.lock:
+            self.latest = latest
+            if column_data["time"].shape[0] > 0:
+                newest = column_data["time"].max()
+                self.high_water = newest if self.high_water is None else max(self.high_water, newest)
+            elif self.high_water is None:
+                self.high_water = since
+            self.refreshed_at = time.time()
+            if full_reload:
+                self.reloaded_at = self.refreshed_at
+        logging.debug(f"Live sensor snapshot has {len(latest)} sensors ({column_data['time'].shape[0]} new rows)")
+        return True
+
+    def age(self):
+        """Seconds since the last successful refresh, None before the first one"""
+        if self.refreshed_at is None:
+            return None
+        return time.time() - self.refreshed_at
+
+    def isFresh(self):
+        age = self.age()
+        return age is not None and age <= self.max_age_seconds
+
+    def sensors(self, sensor_source):
+        """The latest reading of each live sensor of sensor_source ("all" for every source), as dicts"""
+        now = measurement_store.toDatetime64(datetime.now(timezone.utc))
+        with self.lock:
+            readings = list(self.latest.values())
+        if sensor_source != "all":
+            readings = [reading for reading in readings if reading["SensorSource"] == sensor_source]
+        return [
+            {name: value for name, value in reading.items() if name != "time64"}
+            for reading in readings
+            if reading["time64"] >= now - LIVE_WINDOWS[reading["SensorSource"]]
+        ]
@@ -0,0 +1,681 @@
+# Storage backends for the sensor measurements that feed the modeling routes.
+#
+# BigQuery is the source of truth, but a round trip per estimate request dominates the latency of the
+# estimate routes.  Every store here answers the same question -- all measurements inside a lat-lon box
+# and strictly inside a time range, ordered by time -- and hands back rows with attribute access
+# (row.ID, row.time, ...), just like the bigquery row iterator, so callers don't care which one they use.
+# queryColumns gives the same answer as one dict of numpy arrays, and queryBatches as a sequence of such
+# dicts of at most batch_size measurements each, which never holds more than a batch (or, for the local
+# stores, a day) of the answer in memory at once.
+#
+#   BigQueryStore - one query per source table, with only the requested columns selected.  The three
+#                   queries run side by side and their time ordered results are merged as they arrive.
+#   ParquetStore  - a local copy of the AirU/PurpleAir/DAQ tables, one parquet file per source per day.
+#                   Days outside the query are never opened (partition pruning) and only the requested
+#                   columns are read (column projection).  Kept up to date with sync().
+#                   sync() also maintains count/sum/min/max rollups per sensor at 5 minute, hourly and
+#                   daily resolution, which the time aggregated route is assembled from (see rollups.py).
+#   FakeStore     - in-process, deterministic synthetic sensors.  Lets the whole estimate pipeline run
+#                   (and be benchmarked) without network access or credentials.
+#
+# The store used by the app is picked with the MEASUREMENT_STORE environment variable (see createStore).
+
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+import heapq
+import itertools
+import logging
+import os
+import queue
+import threading
+import time
+import weakref
+import numpy as np
+from aqandu import telemetry
+
+
+SOURCE_NAMES = ["AirU", "PurpleAir", "DAQ"]
+MEASUREMENT_COLUMNS = ["ID", "time", "PM2_5", "Latitude", "Longitude", "SensorModel", "SensorSource"]
+# the columns that are actually stored per source -- SensorSource is implied by the table
+STORED_COLUMNS = ["ID", "time", "PM2_5", "Latitude", "Longitude", "SensorModel"]
+STORE_KINDS = ["bigquery", "parquet", "fake"]
+
+# the time column is kept as UTC datetime64 with microsecond resolution (the resolution of BigQuery TIMESTAMP)
+TIME_DTYPE = "datetime64[us]"
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+EMPTY_DTYPES = {"ID": object, "time": TIME_DTYPE, "PM2_5": float, "Latitude": float, "Longitude": float,
+                "SensorModel": object, "SensorSource": object}
+
+# rollups of PM2_5 per sensor per time bucket, coarsest first: (name, bucket length in minutes)
+# "rows" counts all measurements, "count" only the ones with a PM2_5 value (as AVG/MIN/MAX do in SQL)
+ROLLUP_LEVELS = [("1d", 1440), ("1h", 60), ("5min", 5)]
+ROLLUP_COLUMNS = ["ID", "time", "rows", "count", "sum", "min", "max"]
+UNIX_EPOCH64 = np.datetime64(0, "us")
+
+# the per-source queries of all requests share this pool.  The bigquery client is safe to share between
+# threads and keeps its own pool of connections.
+QUERY_THREADS = 12
+# the default number of measurements per batch from queryBatches
+BATCH_ROWS = 50000
+# the pages of a query result read ahead of the consumer (see streamPages), and how often a reader that is
+# waiting for the consumer checks whether it has gone away
+STREAM_PAGES_AHEAD = 4
+STREAM_PUT_SECONDS = 1.0
+query_pool = ThreadPoolExecutor(max_workers=QUERY_THREADS, thread_name_prefix="source-query")
+
+Measurement = namedtuple("Measurement", MEASUREMENT_COLUMNS)
+_row_types = {tuple(MEASUREMENT_COLUMNS): Measurement}
+
+
+def rowType(columns):
+    """Row class (a namedtuple) for a projection of the measurement columns"""
+    columns = tuple(columns)
+    if columns not in _row_types:
+        _row_types[columns] = namedtuple("Measurement", columns)
+    return _row_types[columns]
+
+
+def toDatetime64(date):
+    """Convert a (timezone aware) datetime into a naive UTC datetime64"""
+    if date.tzinfo is not None:
+        date = date.astimezone(timezone.utc).replace(tzinfo=None)
+    return np.datetime64(date, "us")
+
+
+def fromDatetime64(date):
+    """Convert a naive UTC datetime64 back into a timezone aware datetime, like the ones bigquery returns"""
+    return EPOCH + timedelta(microseconds=int(date.astype("datetime64[us]").astype(np.int64)))
+
+
+def checkColumns(columns):
+    if columns is None:
+        return list(MEASUREMENT_COLUMNS)
+    unknown = [column for column in columns if column not in MEASUREMENT_COLUMNS]
+    if unknown:
+        raise ValueError(f"Unknown measurement columns {unknown}, must be in {MEASUREMENT_COLUMNS}")
+    return list(columns)
+
+
+# all of the local stores keep data as a dict of equal length numpy arrays (one per column)
+# this does the bounding box / time range selection on those arrays
+def selectInBox(column_data, lat_lo, lat_hi, lon_lo, lon_hi, start_date, end_date):
+    times = column_data["time"]
+    lats = column_data["Latitude"]
+    lons = column_data["Longitude"]
+    in_time = (times > toDatetime64(start_date)) & (times < toDatetime64(end_date))
+    mask = in_time & (lats >= lat_lo) & (lats <= lat_hi) & (lons >= lon_lo) & (lons <= lon_hi)
+    return {name: values[mask] for name, values in column_data.items()}
+
+
+def concatenateColumns(column_data_list, columns):
+    if len(column_data_list) == 0:
+        return {name: np.array([], dtype=EMPTY_DTYPES[name]) for name in columns}
+    merged = {name: np.concatenate([data[name] for data in column_data_list]) for name in columns}
+    # same ordering as the bigquery query (ORDER BY time ASC)
+    order = np.argsort(merged["time"], kind="stable")
+    return {name: values[order] for name, values in merged.items()}
+
+
+def columnsToRows(column_data, columns):
+    Row = rowType(columns)
+    values = []
+    for name in columns:
+        if name == "time":
+            values.append([fromDatetime64(date) for date in column_data[name]])
+        else:
+            values.append(column_data[name].tolist())
+    return [Row(*row) for row in zip(*values)]
+
+
+def rowsToColumns(rows, columns):
+    values = {name: [] for name in columns}
+    for row in rows:
+        for name in columns:
+            values[name].append(getattr(row, name))
+    column_data = {}
+    for name in columns:
+        if name == "time":
+            column_data[name] = np.array([toDatetime64(date) for date in values[name]], dtype=TIME_DTYPE)
+        else:
+            column_data[name] = np.array(values[name], dtype=EMPTY_DTYPES[name])
+    return column_data
+
+
+# rows from a row iterator as column dicts of at most batch_size rows each
+def batchRows(rows, columns, batch_size):
+    rows = iter(rows)
+    while True:
+        batch = list(itertools.islice(rows, batch_size))
+        if not batch:
+            return
+        yield rowsToColumns(batch, columns)
+
+
+def sliceColumns(column_data, batch_size):
+    num_rows = next(iter(column_data.values())).shape[0]
+    for start in range(0, num_rows, batch_size):
+        yield {name: values[start:start + batch_size] for name, values in column_data.items()}
+
+
+def arrowToColumns(table, columns):
+    column_data = {}
+    for name in columns:
+        values = table.column(name).to_numpy()
+        if name == "time":
+            column_data[name] = values.astype(TIME_DTYPE)
+        else:
+            column_data[name] = values.astype(EMPTY_DTYPES[name])
+    return column_data
+
+
+# sums the rollup entries (one per measurement, or finer rollup rows) that share a sensor and a bucket
+def reduceRollup(ids, buckets, bucket_minutes, rows, counts, sums, mins, maxs):
+    if buckets.shape[0] == 0:
+        return {"ID": np.array([], dtype=object), "time": np.array([], dtype=TIME_DTYPE),
+                "rows": np.array([], dtype=np.int64), "count": np.array([], dtype=np.int64),
+                "sum": np.array([], dtype=float), "min": np.array([], dtype=float), "max": np.array([], dtype=float)}
+    unique_ids, codes = np.unique(ids.astype(str), return_inverse=True)
+    order = np.lexsort((buckets, codes))
+    codes = codes[order]
+    buckets = buckets[order]
+    starts = np.flatnonzero(np.concatenate(([True], (codes[1:] != codes[:-1]) | (buckets[1:] != buckets[:-1]))))
+    return {
+        "ID": unique_ids[codes[starts]].astype(object),
+        "time": UNIX_EPOCH64 + buckets[starts] * np.timedelta64(bucket_minutes, "m"),
+        "rows": np.add.reduceat(rows[order], starts),
+        "count": np.add.reduceat(counts[order], starts),
+        "sum": np.add.reduceat(sums[order], starts),
+        # fmin/fmax skip the missing values, the result is only nan when there is no value at all
+        "min": np.fmin.reduceat(mins[order], starts),
+        "max": np.fmax.reduceat(maxs[order], starts),
+    }
+
+
+def timeBuckets(times, bucket_minutes):
+    """Index of the bucket (counted from the unix epoch) each time falls in"""
+    return (times.astype(TIME_DTYPE) - UNIX_EPOCH64) // np.timedelta64(bucket_minutes, "m")
+
+
+def rollupColumns(column_data, bucket_minutes):
+    """count/sum/min/max of PM2_5 per sensor per bucket_minutes bucket, from measurement columns"""
+    values = column_data["PM2_5"].astype(float)
+    valid = ~np.isnan(values)
+    return reduceRollup(column_data["ID"], timeBuckets(column_data["time"], bucket_minutes), bucket_minutes,
+                        np.ones(values.shape[0], dtype=np.int64), valid.astype(np.int64),
+                        np.where(valid, values, 0.0), values, values)
+
+
+def coarsenRollup(rollup, bucket_minutes):
+    """Combine the rows of a finer rollup into coarser bucket_minutes buckets"""
+    return reduceRollup(rollup["ID"], timeBuckets(rollup["time"], bucket_minutes), bucket_minutes,
+                        rollup["rows"], rollup["count"], rollup["sum"], rollup["min"], rollup["max"])
+
+
+def streamRows(name, run_job):
+    """Start run_job() (which submits a bigquery query job) on the query pool right away, and return
+    a generator over its rows that yields each page as soon as it has been read"""
+    pages = streamPages(name, run_job, lambda rows: ((page, len(page)) for page in map(list, rows.pages)))
+    return (row for page in pages for row in page)
+
+
+def streamColumns(name, run_job, columns):
+    """Like streamRows, but a generator over column dicts, one per page of the result (needs pyarrow)"""
+    import pyarrow
+
+    def arrowPages(rows):
+        # RowIterator.to_arrow_iterable is missing from older versions of the bigquery client
+        batches = rows.to_arrow_iterable() if hasattr(rows, "to_arrow_iterable") else rows.to_arrow().to_batches()
+        for batch in batches:
+            page = arrowToColumns(pyarrow.Table.from_batches([batch]), columns)
+            yield page, page["time"].shape[0]
+
+    return streamPages(name, run_job, arrowPages)
+
+
+# puts item on the bounded queue of streamPages, False when the consumer has gone away instead
+def putPage(pages, item, stopped):
+    while not stopped.is_set():
+        try:
+            pages.put(item, timeout=STREAM_PUT_SECONDS)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+# the pages of streamPages until the None at the end, raising the reader's error if there is one
+def generatePages(pages, stopped):
+    try:
+        while True:
+            page = pages.get()
+            if page is None:
+                return
+            if isinstance(page, Exception):
+                raise page
+            yield page
+    finally:
+        stopped.set()
+
+
+# runs the job and reads its result on the query pool, and returns a generator over the pages.  readPages(result)
+# yields (page, number of rows) for each page of the result.  The reader stays at most STREAM_PAGES_AHEAD pages
+# ahead of the consumer, so a result is never held in memory whole, and it stops reading when the generator is
+# closed or dropped before the end.
+def streamPages(name, run_job, readPages):
+    pages = queue.Queue(maxsize=STREAM_PAGES_AHEAD)
+    stopped = threading.Event()
+    # the pool threads are outside of the request, so find out who is asking here
+    endpoint = telemetry.currentEndpoint()
+
+    def readAll():
+        started = time.time()
+        num_rows = 0
+        try:
+            query_job = run_job()
+            rows = query_job.result()
+            logging.info("%s: query done in %.2f s", name, time.time() - started)
+            for page, page_rows in readPages(rows):
+                num_rows += page_rows
+                if not putPage(pages, page, stopped):
+                    logging.info("%s: stopped reading after %d rows, the result was closed", name, num_rows)
+                    return
+        except Exception as error:
+            telemetry.recordError(endpoint)
+            putPage(pages, error, stopped)
+            return
+        logging.info("%s: %d rows in %.2f s", name, num_rows, time.time() - started)
+        telemetry.recordJob(query_job, time.time() - started, num_rows, endpoint)
+        putPage(pages, None, stopped)
+
+    generator = generatePages(pages, stopped)
+    # a generator that is dropped without ever being started doesn't run its finally
+    weakref.finalize(generator, stopped.set)
+    query_pool.submit(readAll)
+    return generator
+
+
+# merges streams of column dicts, each in time order, into one stream of column dicts in time order (ties in
+# stream order, like heapq.merge of the rows).  The rows before the earliest last time of the chunks at hand
+# can't be preceded by anything still unread, so those are sent, and then the stream with that chunk is read on.
+def mergeColumnStreams(streams, columns):
+    streams = [iter(stream) for stream in streams]
+    buffers = [{name: np.array([], dtype=EMPTY_DTYPES[name]) for name in columns} for stream in streams]
+    # (last buffered time, stream index) of the streams that aren't done yet
+    heap = []
+
+    def readOn(index):
+        for chunk in streams[index]:
+            if chunk["time"].shape[0] > 0:
+                buffers[index] = {name: np.concatenate([buffers[index][name], chunk[name]]) for name in columns}
+                heapq.heappush(heap, (buffers[index]["time"][-1], index))
+                return
+
+    def takeBefore(before):
+        taken = []
+        for index, buffer in enumerate(buffers):
+            split = buffer["time"].shape[0] if before is None else np.searchsorted(buffer["time"], before)
+            taken.append({name: values[:split] for name, values in buffer.items()})
+            buffers[index] = {name: values[split:] for name, values in buffer.items()}
+        # the pieces are runs in time order, which the stable sort in concatenateColumns just merges
+        return concatenateColumns([piece for piece in taken if piece["time"].shape[0] > 0], columns)
+
+    for index in range(len(streams)):
+        readOn(index)
+    while heap:
+        before, index = heapq.heappop(heap)
+        merged = takeBefore(before)
+        if merged["time"].shape[0] > 0:
+            yield merged
+        readOn(index)
+    merged = takeBefore(None)
+    if merged["time"].shape[0] > 0:
+        yield merged
+
+
+# the per-source select expressions.  PurpleAir and DAQ don't have a sensor model.
+def sourceSelectList(source, columns):
+    expressions = []
+    for column in columns:
+        if column == "SensorSource":
+            expressions.append(f"'{source}' as SensorSource")
+        elif column == "SensorModel" and source != "AirU":
+            expressions.append("'' as SensorModel")
+        else:
+            expressions.append(column)
+    return ", ".join(expressions)
+
+
+class BigQueryStore:
+    def __init__(self, client, source_table_map):
+        self.client = client
+        self.source_table_map = source_table_map
+
+    def sourceJob(self, source, lat_lo, lat_hi, lon_lo, lon_hi, start_date, end_date, columns):
+        # imported here so the local stores don't need the bigquery libraries
+        from google.cloud import bigquery
+
+        query = f"""
+    SELECT {sourceSelectList(source, columns)}
+    FROM `{self.source_table_map[source]}`
+    WHERE (Latitude <= @lat_hi) AND (Latitude >= @lat_lo) AND (Longitude <= @lon_hi) AND (Longitude >= @lon_lo)
+        AND time > @start_date AND time < @end_date
+    ORDER BY time ASC
+    """
+
+        job_config = bigquery.QueryJobConfig(
+            query_parameters=[
+                bigquery.ScalarQueryParameter("start_date", "TIMESTAMP", start_date),
+                bigquery.ScalarQueryParameter("end_date", "TIMESTAMP", end_date),
+                bigquery.ScalarQueryParameter("lat_lo", "NUMERIC", lat_lo),
+                bigquery.ScalarQueryParameter("lat_hi", "NUMERIC", lat_hi),
+                bigquery.ScalarQueryParameter("lon_lo", "NUMERIC", lon_lo),
+                bigquery.ScalarQueryParameter("lon_hi", "NUMERIC", lon_hi),
+            ]
+        )
+
+        return self.client.query(query, job_config=job_config)
+
+    def query(self, lat_lo, lat_hi, lon_lo, lon_hi, start_date, end_date, columns=None):
+        columns = checkColumns(columns)
+        # the time is needed to merge the sources, even if it isn't returned
+        query_columns = list(dict.fromkeys(columns + ["time"]))
+        streams = [
+            streamRows(f"{source} query",
+                       lambda source=source: self.sourceJob(source, lat_lo, lat_hi, lon_lo, lon_hi,
+                                                            start_date, end_date, query_columns))
+            for source in SOURCE_NAMES
+        ]
+        # lazily, so the first rows can be used while the slower sources are still being read
+        merged = heapq.merge(*streams, key=lambda row: row.time)
+        if query_columns == columns:
+            return merged
+        Row = rowType(columns)
+        return (Row(*[getattr(row, name) for name in columns]) for row in merged)
+
+    def queryColumns(self, lat_lo, lat_hi, lon_lo, lon_hi, start_date, end_date, columns=None):
+        columns = checkColumns(columns)
+        query_columns = list(dict.fromkeys(columns + ["time"]))
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            return rowsToColumns(self.query(lat_lo, lat_hi, lon_lo, lon_hi, start_date, end_date, columns), columns)
+
+        # goes straight from the result pages to arrays, without building a row object per measurement, and
+        # merges the sources' pages as they come in
+        streams = [
+            streamColumns(f"{source} query",
+                          lambda source=source: self.sourceJob(source, lat_lo, lat_hi, lon_lo, lon_hi,
+                                                               start_date, end_date, query_columns),
+                          query_columns)
+            for source in SOURCE_NAMES
+        ]
+        chunks = list(mergeColumnStreams(streams, query_columns))
+        if len(chunks) == 0:
+            return concatenateColumns([], columns)
+        return {name: np.concatenate([chunk[name] for chunk in chunks]) for name in columns}
+
+    def queryBatches(self, lat_lo, lat_hi, lon_lo, lon_hi, start_date, end_date, columns=None, batch_size=BATCH_ROWS):
+        # straight from the merged result pages, so only the pages being read and one batch are in memory
+        columns = checkColumns(columns)
+        return batchRows(self.query(lat_lo, lat_hi, lon_lo, lon_hi, start_date, end_date, columns), columns, batch_size)
+
+
+class ParquetStore:
+    # files are laid out as <root>/<source>/<YYYY-MM-DD>.parquet, one file per UTC day
+    def __init__(self, root):
+        # pyarrow is only needed for this store, so don't make the whole app depend on it
+        import pyarrow
+        import pyarrow.parquet
+        self.pyarrow = pyarrow
+        self.parquet = pyarrow.parquet
+        self.root = root
+
+    def partitionPath(self, source, day):
+        return os.path.join(self.root, source, day.strftime("%Y-%m-%d") + ".parquet")
+
+    def partitionDays(self, start_date, end_date):
+        day = start_date.astimezone(timezone.utc).date()
+        last_day = end_date.astimezone(timezone.utc).date()
+        while day <= last_day:
+            yield day
+            day = day + timedelta(days=1)
+
+    def readPartition(self, source, day, columns, sensor_id=None):
+        path = self.partitionPath(source, day)
+        if not os.path.exists(path):
+            return None
+        stored = [column for column in columns if column in STORED_COLUMNS]
+        filters = [("ID", "=", sensor_id)] if sensor_id is not None else None
+        table = self.parquet.read_table(path, columns=stored, filters=filters)
+        column_data = arrowToColumns(table, stored)
+        if "SensorSource" in columns:
+            column_data["SensorSource"] = np.full(table.num_rows, source, dtype=object)
+        return column_data
+
+    def queryColumns(self, lat_lo, lat_hi, lon_lo, lon_hi, start_date, end_date, columns=None):
+        columns = checkColumns(columns)
+        read_columns = list(dict.fromkeys(columns + ["time", "Latitude", "Longitude"]))
+        selected = []
+        for source in SOURCE_NAMES:
+            for day in self.partitionDays(start_date, end_date):
+                column_data = self.readPartition(source, day, read_columns)
+                if column_data is not None:
+                    selected.append(selectInBox(column_data, lat_lo, lat_hi, lon_lo, lon_hi, start_date, end_date))
+        column_data = concatenateColumns(selected, read_columns)
+        return {name: column_data[name] for name in columns}
+
+    def queryBatches(self, lat_lo, lat_hi, lon_lo, lon_hi, start_date, end_date, columns=None, batch_size=BATCH_ROWS):
+        # a day at a time, the days are in order and each day's sources are merged by time
+        columns = checkColumns(columns)
+        read_columns = list(dict.fromkeys(columns + ["time", "Latitude", "Longitude"]))
+        for day in self.partitionDays(start_date, end_date):
+            selected = []
+            for source in SOURCE_NAMES:
+                column_data = self.readPartition(source, day, read_columns)
+                if column_data is not None:
+                    selected.append(selectInBox(column_data, lat_lo, lat_hi, lon_lo, lon_hi, start_date, end_date))
+            column_data = concatenateColumns(selected, read_columns)
+            yield from sliceColumns({name: column_data[name] for name in columns}, batch_size)
+
+    def query(self, lat_lo, lat_hi, lon_lo, lon_hi, start_date, end_date, columns=None):
+        columns = checkColumns(columns)
+        column_data = self.queryColumns(lat_lo, lat_hi, lon_lo, lon_hi, start_date, end_date, columns)
+        return columnsToRows(column_data, columns)
+
+    # copy whole UTC days from the bigquery tables into the local store.  Days that are already
+    # there are rewritten, so re-running a sync for the current day picks up newer measurements.
+    def sync(self, client, source_table_map, start_date, end_date, sources=SOURCE_NAMES):
+        from google.cloud import bigquery
+
+        synced = 0
+        for source in sources:
+            os.makedirs(os.path.join(self.root, source), exist_ok=True)
+            for day in self.partitionDays(start_date, end_date):
+                day_start = datetime(day.year, day.month, day.day, tzinfo=timezone.utc)
+                query = f"""
+                    SELECT {sourceSelectList(source, STORED_COLUMNS)}
+                    FROM `{source_table_map[source]}`
+                    WHERE time >= @day_start AND time < @day_end
+                    ORDER BY time ASC
+                """
+                job_config = bigquery.QueryJobConfig(
+                    query_parameters=[
+                        bigquery.ScalarQueryParameter("day_start", "TIMESTAMP", day_start),
+                        bigquery.ScalarQueryParameter("day_end", "TIMESTAMP", day_start + timedelta(days=1)),
+                    ]
+                )
+                started = time.time()
+                query_job = client.query(query, job_config=job_config)
+                table = query_job.result().to_arrow()
+                telemetry.recordJob(query_job, time.time() - started, table.num_rows)
+                self.writePartition(source, day, table)
+                self.writeRollups(source, day, arrowToColumns(table, STORED_COLUMNS))
+                logging.info("Synced %d %s measurements for %s", table.num_rows, source, day)
+                synced += table.num_rows
+        return synced
+
+    def writePartition(self, source, day, table):
+        pa = self.pyarrow
+        schema = pa.schema([
+            ("ID", pa.string()),
+            ("time", pa.timestamp("us", tz="UTC")),
+            ("PM2_5", pa.float64()),
+            ("Latitude", pa.float64()),
+            ("Longitude", pa.float64()),
+            ("SensorModel", pa.string()),
+        ])
+        table = table.select(STORED_COLUMNS).cast(schema)
+        self.writeTable(table, self.partitionPath(source, day))
+
+    def writeTable(self, table, path):
+        # write next to the final file and rename, so a query never sees a half written partition
+        tmp_path = path + ".tmp"
+        self.parquet.write_table(table, tmp_path)
+        os.replace(tmp_path, path)
+
+    # rollups live in <root>/<source>/rollup_<level>/, one file per day, except for the daily rollup
+    # which is one file per month (a day of it is just one row per sensor)
+    def rollupPath(self, source, level, day):
+        name = day.strftime("%Y-%m") if level == "1d" else day.strftime("%Y-%m-%d")
+        return os.path.join(self.root, source, "rollup_" + level, name + ".parquet")
+
+    def rollupDays(self, level, days):
+        """The distinct days (first of the month for the daily rollup) whose files hold the given days"""
+        if level == "1d":
+            days = [day.replace(day=1) for day in days]
+        return sorted(set(days))
+
+    def readRollup(self, source, level, day, sensor_id=None):
+        path = self.rollupPath(source, level, day)
+        if not os.path.exists(path):
+            return None
+        filters = [("ID", "=", sensor_id)] if sensor_id is not None else None
+        table = self.parquet.read_table(path, columns=ROLLUP_COLUMNS, filters=filters)
+        column_data = {name: table.column(name).to_numpy() for name in ROLLUP_COLUMNS}
+        column_data["ID"] = column_data["ID"].astype(object)
+        column_data["time"] = column_data["time"].astype(TIME_DTYPE)
+        return column_data
+
+    def writeRollups(self, source, day, column_data):
+        """(Re)build the rollups of one day of one source from its measurements"""
+        pa = self.pyarrow
+        schema = pa.schema([
+            ("ID", pa.string()),
+            ("time", pa.timestamp("us", tz="UTC")),
+            ("rows", pa.int64()),
+            ("count", pa.int64()),
+            ("sum", pa.float64()),
+            ("min", pa.float64()),
+            ("max", pa.float64()),
+        ])
+        # the coarser rollups are built from the finer ones rather than from the measurements again
+        rollup = None
+        for level, minutes in reversed(ROLLUP_LEVELS):
+            rollup = rollupColumns(column_data, minutes) if rollup is None else coarsenRollup(rollup, minutes)
+            os.makedirs(os.path.dirname(self.rollupPath(source, level, day)), exist_ok=True)
+            if level == "1d":
+                # replace this day's rows in the month file
+                month = self.readRollup(source, level, day)
+                if month is not None:
+                    day_start = np.datetime64(day, "us")
+                    keep = (month["time"] < day_start) | (month["time"] >= day_start + np.timedelta64(1, "D"))
+                    rollup = concatenateColumns([{name: values[keep] for name, values in month.items()}, rollup],
+                                                ROLLUP_COLUMNS)
+            table = pa.Table.from_arrays([pa.array(rollup[name]) for name in ROLLUP_COLUMNS],
+                                         names=ROLLUP_COLUMNS).cast(schema)
+            self.writeTable(table, self.rollupPath(source, level, day))
+
+    def buildRollups(self, start_date, end_date, sources=SOURCE_NAMES):
+        """Rebuild the rollups from the local partitions, e.g. for partitions synced before rollups existed"""
+        built = 0
+        for source in sources:
+            for day in self.partitionDays(start_date, end_date):
+                column_data = self.readPartition(source, day, STORED_COLUMNS)
+                if column_data is not None:
+                    self.writeRollups(source, day, column_data)
+                    built += 1
+        return built
+
+
+# Deterministic synthetic sensors for running offline.  Sensors are scattered over a fixed region and
+# report on a regular period; each reading is a smooth regional pattern plus a per-sensor offset and
+# some pseudo-random noise, and the same (sensor, time) always gives the same value.
+class FakeStore:
+    def __init__(self, num_sensors=200, lat_lo=40.45, lat_hi=41.1, lon_lo=-112.15, lon_hi=-111.7,
+                 period_minutes=2, seed=0):
+        random = np.random.RandomState(seed)
+        self.num_sensors = num_sensors
+        self.period = np.timedelta64(int(period_minutes * 60 * 1000000), "us")
+        self.ids = np.array([f"FAKE{index:05d}" for index in range(num_sensors)], dtype=object)
+        self.lats = random.uniform(lat_lo, lat_hi, num_sensors)
+        self.lons = random.uniform(lon_lo, lon_hi, num_sensors)
+        self.sources = np.array(random.choice(SOURCE_NAMES, num_sensors, p=[0.3, 0.6, 0.1]), dtype=object)
+        self.models = np.where(self.sources == "AirU", "H1.2+S1.0.8", "").astype(object)
+        self.offsets = random.uniform(-3.0, 3.0, num_sensors)
+        # sensors don't all report at the same instant
+        self.phases = random.randint(0, int(period_minutes * 60), num_sensors).astype("timedelta64[s]")
+
+    def readings(self, sensor_indices, times):
+        hours = (times - np.datetime64("2000-01-01T00:00:00", "us")) / np.timedelta64(1, "h")
+        regional = 12.0 + 8.0 * np.sin(2.0 * np.pi * hours / 24.0) + 4.0 * np.sin(2.0 * np.pi * hours / 97.0)
+        spatial = 5.0 * np.cos(self.lats[sensor_indices] * 40.0) * np.sin(self.lons[sensor_indices] * 40.0)
+        noise = np.sin(hours * 7919.0 + sensor_indices * 104729.0)
+        return np.maximum(regional + spatial + self.offsets[sensor_indices] + noise, 0.0)
+
+    def queryColumns(self, lat_lo, lat_hi, lon_lo, lon_hi, start_date, end_date, columns=None):
+        columns = checkColumns(columns)
+        start = toDatetime64(start_date)
+        end = toDatetime64(end_date)
+        in_lats = (self.lats >= lat_lo) & (self.lats <= lat_hi)
+        in_box = np.nonzero(in_lats & (self.lons >= lon_lo) & (self.lons <= lon_hi))[0]
+        first_tick = (start - np.datetime64(0, "us")) // self.period
+        last_tick = (end - np.datetime64(0, "us")) // self.period + 1
+        ticks = np.datetime64(0, "us") + np.arange(first_tick, last_tick + 1) * self.period
+        sensor_indices = np.repeat(in_box, ticks.shape[0])
+        times = np.tile(ticks, in_box.shape[0]) + np.repeat(self.phases[in_box], ticks.shape[0])
+        keep = (times > start) & (times < end)
+        sensor_indices = sensor_indices[keep]
+        times = times[keep]
+        order = np.argsort(times, kind="stable")
+        sensor_indices = sensor_indices[order]
+        times = times[order].astype(TIME_DTYPE)
+        column_data = {
+            "ID": self.ids[sensor_indices],
+            "time": times,
+            "PM2_5": self.readings(sensor_indices, times),
+            "Latitude": self.lats[sensor_indices],
+            "Longitude": self.lons[sensor_indices],
+            "SensorModel": self.models[sensor_indices],
+            "SensorSource": self.sources[sensor_indices],
+        }
+        return {name: column_data[name] for name in columns}
+
+    def queryBatches(self, lat_lo, lat_hi, lon_lo, lon_hi, start_date, end_date, columns=None, batch_size=BATCH_ROWS):
+        # a day at a time.  queryColumns leaves out both ends of its range, so every day after the first
+        # is asked for from a microsecond before its start.
+        start = toDatetime64(start_date)
+        end = toDatetime64(end_date)
+        edges = np.arange(start.astype("datetime64[D]") + 1, end.astype("datetime64[D]") + 1).astype(TIME_DTYPE)
+        edges = np.concatenate(([start], edges[edges < end], [end]))
+        for piece in range(edges.shape[0] - 1):
+            piece_start = edges[piece] if piece == 0 else edges[piece] - np.timedelta64(1, "us")
+            column_data = self.queryColumns(lat_lo, lat_hi, lon_lo, lon_hi, fromDatetime64(piece_start),
+                                            fromDatetime64(edges[piece + 1]), columns)
+            yield from sliceColumns(column_data, batch_size)
+
+    def query(self, lat_lo, lat_hi, lon_lo, lon_hi, start_date, end_date, columns=None):
+        columns = checkColumns(columns)
+        column_data = self.queryColumns(lat_lo, lat_hi, lon_lo, lon_hi, start_date, end_date, columns)
+        return columnsToRows(column_data, columns)
+
+
+def createStore(kind, client=None, source_table_map=None, path=None):
+    """Build the measurement store named by kind (one of STORE_KINDS)"""
+    if kind == "bigquery":
+        return BigQueryStore(client, source_table_map)
+    elif kind == "parquet":
+        return ParquetStore(path)
+    elif kind == "fake":
+        return FakeStore()
+    raise ValueError(f"Unknown measurement store {kind}, must be one of {STORE_KINDS}")
@@ -0,0 +1,77 @@
+# The model configuration files, loaded once and kept in the compiled form the estimate routes use.
+#
+# computeEstimatesForLocations used to read and parse bounding_box.csv, correction_factors.csv and
+# length_scales.csv on every request, and build a matplotlib Path for every query point.  Here they are
+# loaded into a snapshot: the bounding box as a prebuilt Path (utils.areQueriesInBoundingBox checks all of
+# the query points against it at once), the correction factors compiled into interval arrays
+# (utils.compileCorrectionFactors) and the length scales as arrays of their date ranges.
+#
+# current() looks at the files' modification times (at most every CHECK_INTERVAL seconds) and reloads
+# them when one has changed.  requestReload() forces a reload on the next call, __init__ hooks it up to
+# SIGHUP.  A snapshot is never changed once it is built, so a request keeps the one it started with.  When a
+# reload fails (a file that is half written, say) the error is logged and the previous snapshot stays.
+
+import logging
+import os
+import threading
+import time
+from aqandu import utils
+
+
+CHECK_INTERVAL = 5
+
+
+class ModelConfig:
+    def __init__(self, bounding_box_path, correction_factors_path, length_scales_path, check_interval=CHECK_INTERVAL):
+        self.paths = {
+            'bounding_box': bounding_box_path,
+            'correction_factors': correction_factors_path,
+            'length_scales': length_scales_path,
+        }
+        self.check_interval = check_interval
+        self.lock = threading.Lock()
+        self.snapshot = None
+        self.modification_times = None
+        self.checked_at = None
+        self.reload_requested = False
+
+    def load(self):
+        bounding_box_vertices = utils.loadBoundingBox(self.paths['bounding_box'])
+        correction_factors = utils.loadCorrectionFactors(self.paths['correction_factors'])
+        length_scales = utils.loadLengthScales(self.paths['length_scales'])
+        logging.info(f'Loaded {len(bounding_box_vertices)} bounding box vertices, {len(correction_factors)} '
+                     f'correction factors and {len(length_scales)} length scales')
+        return {
+            'bounding_box_vertices': bounding_box_vertices,
+            'bounding_box': utils.boundingBoxPath(bounding_box_vertices),
+            'correction_factors': utils.compileCorrectionFactors(correction_factors),
+            'length_scales': utils.compileLengthScales(length_scales),
+        }
+
+    def modificationTimes(self):
+        return {name: os.stat(path).st_mtime_ns for name, path in self.paths.items()}
+
+    def requestReload(self):
+        # only sets a flag, so that it is safe to call from a signal handler
+        self.reload_requested = True
+
+    def current(self):
+        """The current configuration snapshot, (re)loaded first if the files have changed"""
+        with self.lock:
+            now = time.time()
+            if self.snapshot is not None and not self.reload_requested and now - self.checked_at < self.check_interval:
+                return self.snapshot
+            self.checked_at = now
+            reload_requested = self.reload_requested
+            self.reload_requested = False
+            try:
+                # read before loading, so that a file that changes during the load is loaded again next time
+                modification_times = self.modificationTimes()
+                if self.snapshot is None or reload_requested or modification_times != self.modification_times:
+                    self.snapshot = self.load()
+                    self.modification_times = modification_times
+            except Exception:
+                if self.snapshot is None:
+                    raise
+                logging.exception('Reloading the model configuration failed, keeping the previous one')
+            return self.snapshot
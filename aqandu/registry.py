@@ -0,0 +1,164 @@
+# Per-sensor facts that don't change from one request to the next.
+#
+# The estimate routes need the UTM coordinates, UTM zone, elevation and type of every measurement, and
+# the screening stage needs to know which 5003 sensors sit at the same place.  All of these depend only
+# on the sensor and where it is, so the registry keeps one entry per (SensorSource, ID, Latitude,
+# Longitude) -- a sensor that is moved gets a new entry -- and computes them once, when the entry is
+# first seen.  join() then adds them to a SensorData as columns by indexing the entry arrays with each
+# measurement's entry number.
+#
+# Entries:
+#   SensorSource, ID, Latitude, Longitude  the key
+#   utm_x, utm_y, zone_num                 from utm.from_latlon (utils.latlonToUTMArrays)
+#   Altitude                               from the elevation map (the name the model stage reads)
+#   type                                   '3003' (AirU), '5003' (PurpleAir) or '0000' (DAQ)
+#   location_group                         entries at exactly the same UTM coordinates share a group number,
+#                                          which is what the 5003 co-location pairing compares
+#
+# The registry is saved to an .npz file whenever it grows, and loaded again at startup (unless it was
+# built with a different elevation map).  Every worker process has its own registry, so before saving one
+# adds the entries the others have saved since; two workers that save at the same moment can still drop
+# each other's latest entries from the file, which they will then add again the next time they grow.
+
+import logging
+import os
+import threading
+import numpy as np
+from aqandu import utils
+
+
+SENSOR_SOURCE_TO_TYPE = {'AirU': '3003', 'PurpleAir': '5003', 'DAQ': '0000'}
+KEY_COLUMNS = ['SensorSource', 'ID', 'Latitude', 'Longitude']
+ENTRY_COLUMNS = KEY_COLUMNS + ['utm_x', 'utm_y', 'zone_num', 'Altitude', 'type', 'location_group']
+JOINED_COLUMNS = ['utm_x', 'utm_y', 'zone_num', 'Altitude', 'type', 'location_group']
+ENTRY_DTYPES = {'SensorSource': str, 'ID': str, 'Latitude': float, 'Longitude': float, 'utm_x': float,
+                'utm_y': float, 'zone_num': np.int64, 'Altitude': float, 'type': str, 'location_group': np.int64}
+
+
+class SensorRegistry:
+    def __init__(self, elevation_interpolator, path=None, elevation_map_spec=''):
+        self.elevation_interpolator = elevation_interpolator
+        self.path = path
+        self.elevation_map_spec = elevation_map_spec
+        self.lock = threading.Lock()
+        self.entries = {name: np.array([], dtype=ENTRY_DTYPES[name]) for name in ENTRY_COLUMNS}
+        self.index = {}
+        if path and os.path.exists(path):
+            self.load()
+
+    def __len__(self):
+        return self.entries['ID'].shape[0]
+
+    def loadSaved(self):
+        # the entries in the file, or None when it was built with another elevation map
+        with np.load(self.path) as saved:
+            if str(saved['elevation_map_spec']) != self.elevation_map_spec:
+                return None
+            return {name: saved[name] for name in ENTRY_COLUMNS}
+
+    def load(self):
+        entries = self.loadSaved()
+        if entries is None:
+            logging.info(f'Not using the sensor registry in {self.path}, it was built with another elevation map')
+            return
+        self.entries = entries
+        self.index = {key: entry for entry, key in enumerate(self.entryKeys(self.entries))}
+        logging.info(f'Loaded {len(self)} sensor registry entries from {self.path}')
+
+    def mergeSaved(self):
+        # must hold the lock.  Adds the entries other processes have saved that this one hasn't seen.
+        saved = self.loadSaved() if os.path.exists(self.path) else None
+        if saved is None:
+            return
+        saved_keys = list(self.entryKeys(saved))
+        rows = [row for row, key in enumerate(saved_keys) if key not in self.index]
+        if rows:
+            self.appendEntries({name: saved[name][rows] for name in ENTRY_COLUMNS}, [saved_keys[row] for row in rows])
+            logging.info(f'Merged {len(rows)} sensors saved by other processes into the sensor registry')
+
+    def save(self):
+        # must hold the lock.  A failed save is logged, it must not fail the request that grew the registry.
+        # The temporary file is per process, as several workers can save at once.  np.savez adds .npz to names
+        # that don't have it.
+        tmp_path = f'{self.path}.{os.getpid()}.tmp.npz'
+        try:
+            self.mergeSaved()
+            np.savez(tmp_path, elevation_map_spec=np.array(self.elevation_map_spec), **self.entries)
+            os.replace(tmp_path, self.path)
+        except Exception:
+            logging.exception(f'Saving the sensor registry to {self.path} failed')
+
+    @staticmethod
+    def entryKeys(columns):
+        return zip(*[columns[name].tolist() for name in KEY_COLUMNS])
+
+    def register(self, keys):
+        """Entry numbers for (SensorSource, ID, Latitude, Longitude) keys, adding the ones not seen before.
+        Raises ValueError (from utm) for locations that aren't valid latitudes and longitudes."""
+        with self.lock:
+            new_keys = [key for key in dict.fromkeys(keys) if key not in self.index]
+            if new_keys:
+                self.addEntries(new_keys)
+            return np.array([self.index[key] for key in keys], dtype=np.int64)
+
+    def addEntries(self, keys):
+        # must hold the lock
+        new = {name: [] for name in ENTRY_COLUMNS}
+        for source, sensor_id, lat, lon in keys:
+            for name, value in zip(KEY_COLUMNS + ['type', 'location_group'],
+                                   [source, sensor_id, lat, lon, SENSOR_SOURCE_TO_TYPE.get(source, ''), -1]):
+                new[name].append(value)
+        new['utm_x'], new['utm_y'], new['zone_num'], zone_let = utils.latlonToUTMArrays(new['Latitude'],
+                                                                                        new['Longitude'])
+        # NOTICE - the elevation object takes locations in the form "lon-lat"
+        new['Altitude'] = self.elevation_interpolator.points(new['Longitude'], new['Latitude'])
+        self.appendEntries(new, keys)
+        logging.info(f'Added {len(keys)} sensors to the sensor registry, which now has {len(self)}')
+        if self.path:
+            self.save()
+
+    def appendEntries(self, new, keys):
+        # must hold the lock.  new has the ENTRY_COLUMNS of the keys, the location groups are renumbered.
+        entries = {name: np.concatenate((self.entries[name], np.asarray(new[name], dtype=ENTRY_DTYPES[name])))
+                   for name in ENTRY_COLUMNS}
+        # group numbers in order of the coordinates, so they only depend on the set of locations
+        locations = np.column_stack((entries['utm_x'], entries['utm_y']))
+        entries['location_group'] = np.unique(locations, axis=0, return_inverse=True)[1].reshape(-1)
+        first = len(self)
+        self.entries = entries
+        for offset, key in enumerate(keys):
+            self.index[key] = first + offset
+
+    def join(self, sensor_data):
+        """Add the registry columns (JOINED_COLUMNS) to sensor_data, returns the entry number of each measurement"""
+        num_rows = len(sensor_data)
+        if num_rows == 0:
+            for name in JOINED_COLUMNS:
+                sensor_data[name] = np.array([], dtype=ENTRY_DTYPES[name])
+            return np.array([], dtype=np.int64)
+        # the distinct keys, found by sorting on integer codes for the sensor and the bits of the location
+        ids, id_codes = sensor_data.sensorCodes()
+        source_codes = np.full(num_rows, len(SENSOR_SOURCE_TO_TYPE), dtype=np.int64)
+        for source_index, source in enumerate(SENSOR_SOURCE_TO_TYPE):
+            source_codes[sensor_data['SensorSource'] == source] = source_index
+        lat_bits = np.ascontiguousarray(sensor_data['Latitude'], dtype=float).view(np.int64)
+        lon_bits = np.ascontiguousarray(sensor_data['Longitude'], dtype=float).view(np.int64)
+        order = np.lexsort((lon_bits, lat_bits, source_codes, id_codes))
+        sorted_keys = (id_codes[order], source_codes[order], lat_bits[order], lon_bits[order])
+        changes = np.zeros(num_rows, dtype=bool)
+        changes[0] = True
+        for values in sorted_keys:
+            changes[1:] |= values[1:] != values[:-1]
+        starts = order[changes]
+        row_groups = np.empty(num_rows, dtype=np.int64)
+        row_groups[order] = np.cumsum(changes) - 1
+
+        keys = list(zip(sensor_data['SensorSource'][starts].tolist(), ids[id_codes[starts]].tolist(),
+                        sensor_data['Latitude'][starts].tolist(), sensor_data['Longitude'][starts].tolist()))
+        row_entries = self.register(keys)[row_groups]
+        entries = self.entries
+        for name in JOINED_COLUMNS:
+            sensor_data[name] = entries[name][row_entries]
+        # type is compared with python strings later on
+        sensor_data['type'] = sensor_data['type'].astype(object)
+        return row_entries
@@ -0,0 +1,147 @@
+# Time aggregated sensor data assembled from the rollups kept by the parquet store.
+#
+# /api/timeAggregatedDataFrom splits [start, end] into intervals of timeInterval minutes and returns the
+# mean/min/max of one sensor in each of them.  On bigquery that is a join of a generated interval table
+# against the union of all source tables.  Here each interval is covered, left to right, by the coarsest
+# rollup bucket (day, hour, 5 minutes) that is aligned at that point and still fits inside the interval;
+# only the bits that aren't on a 5 minute boundary (at most the first and last few minutes of an interval)
+# are read from the raw measurements.  The rollup rows are then summed per interval.
+#
+# Intervals are as in the SQL: the k-th starts at start + k*timeInterval, there is one for every whole
+# timeInterval between start and end plus one (so the last one can run past end), each is labelled with
+# its last second, and intervals without any measurement are left out.
+
+import numpy as np
+from aqandu import measurement_store
+
+
+AGGREGATE_FUNCTIONS = ["mean", "min", "max"]
+ONE_SECOND = np.timedelta64(1, "s")
+MICROSECONDS_PER_MINUTE = 60 * 1000000
+
+
+def intervalStarts(start, end, interval_minutes):
+    interval = np.timedelta64(interval_minutes, "m")
+    # TIMESTAMP_DIFF(end, start, MINUTE) and DIV both round toward zero
+    minutes = int((end - start) / np.timedelta64(1, "m"))
+    last = int(minutes / interval_minutes)
+    if minutes < 0 and last < 0:
+        return np.array([], dtype=measurement_store.TIME_DTYPE)
+    return start + np.arange(last + 1) * interval
+
+
+# splits every interval into rollup buckets and raw (sub 5 minute) segments.  Done on plain integer
+# microseconds since the epoch, numpy datetime64 scalars are slow to do arithmetic on one at a time.
+def planIntervals(starts, interval_minutes):
+    interval = interval_minutes * MICROSECONDS_PER_MINUTE
+    lengths = [(level, minutes * MICROSECONDS_PER_MINUTE) for level, minutes in measurement_store.ROLLUP_LEVELS]
+    finest = lengths[-1][1]
+    buckets = {level: [] for level, length in lengths}
+    raw_segments = []
+    for lower in (starts - measurement_store.UNIX_EPOCH64).astype(np.int64).tolist():
+        upper = lower + interval
+        position = lower
+        while position < upper:
+            for level, length in lengths:
+                if position % length == 0 and position + length <= upper:
+                    buckets[level].append(position)
+                    position = position + length
+                    break
+            else:
+                next_position = min(upper, (position // finest + 1) * finest)
+                raw_segments.append((position, next_position))
+                position = next_position
+    return ({level: toTimes(values) for level, values in buckets.items()},
+            toTimes(raw_segments).reshape(-1, 2))
+
+
+def toTimes(microseconds):
+    return measurement_store.UNIX_EPOCH64 + np.array(microseconds, dtype=np.int64).ravel().astype("timedelta64[us]")
+
+
+def segmentDays(times):
+    return sorted({time.astype("datetime64[D]").item() for time in times})
+
+
+def aggregateIntervals(store, sensor_id, sources, start_date, end_date, interval_minutes, function):
+    """[(interval label, value)] for one sensor, from the rollups of a ParquetStore"""
+    start = measurement_store.toDatetime64(start_date)
+    end = measurement_store.toDatetime64(end_date)
+    interval = np.timedelta64(interval_minutes, "m")
+    starts = intervalStarts(start, end, interval_minutes)
+    if starts.shape[0] == 0:
+        return []
+    buckets, raw_segments = planIntervals(starts, interval_minutes)
+
+    pieces = rollupPieces(store, sensor_id, sources, buckets) + rawPieces(store, sensor_id, sources, raw_segments)
+    rows, values = bucketPieces(pieces, start, interval, starts.shape[0], function)
+    labels = starts + interval - ONE_SECOND
+    return [(measurement_store.fromDatetime64(labels[index]), float(values[index]))
+            for index in np.flatnonzero(rows > 0)]
+
+
+# the (rollup, times) rows of the planned buckets, from each level's rollups
+def rollupPieces(store, sensor_id, sources, buckets):
+    pieces = []
+    for level, minutes in measurement_store.ROLLUP_LEVELS:
+        needed = buckets[level]
+        if needed.shape[0] == 0:
+            continue
+        for source in sources:
+            for day in store.rollupDays(level, segmentDays(needed)):
+                rollup = store.readRollup(source, level, day, sensor_id)
+                if rollup is None:
+                    continue
+                # needed is sorted (the intervals are in order and each is covered left to right)
+                found = np.minimum(np.searchsorted(needed, rollup["time"]), needed.shape[0] - 1)
+                keep = needed[found] == rollup["time"]
+                pieces.append(({name: values[keep] for name, values in rollup.items()}, rollup["time"][keep]))
+    return pieces
+
+
+# the raw measurements inside the raw segments, as (rollup, times) with one rollup row per measurement.
+# They are assigned to intervals by their own times, just like the rollup rows by their bucket's.
+def rawPieces(store, sensor_id, sources, raw_segments):
+    pieces = []
+    if raw_segments.shape[0] == 0:
+        return pieces
+    edges = raw_segments.ravel()
+    for source in sources:
+        for day in segmentDays(edges[::2]):
+            column_data = store.readPartition(source, day, ["time", "PM2_5"], sensor_id)
+            if column_data is None:
+                continue
+            times = column_data["time"]
+            # inside a segment when an odd number of edges are at or before the time
+            keep = np.searchsorted(edges, times, side="right") % 2 == 1
+            pieces.append((rawRollup(column_data["PM2_5"][keep]), times[keep]))
+    return pieces
+
+
+# sums the pieces up per interval, returns the number of rows and the value of function in each interval
+def bucketPieces(pieces, start, interval, num_intervals, function):
+    rows = np.zeros(num_intervals, dtype=np.int64)
+    counts = np.zeros(num_intervals, dtype=np.int64)
+    sums = np.zeros(num_intervals)
+    mins = np.full(num_intervals, np.nan)
+    maxs = np.full(num_intervals, np.nan)
+    for rollup, times in pieces:
+        index = (times - start) // interval
+        np.add.at(rows, index, rollup["rows"])
+        np.add.at(counts, index, rollup["count"])
+        np.add.at(sums, index, rollup["sum"])
+        np.fmin.at(mins, index, rollup["min"])
+        np.fmax.at(maxs, index, rollup["max"])
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        values = {"mean": sums / counts, "min": mins, "max": maxs}[function]
+    # the SQL returns 0 when none of the measurements in the interval has a value
+    return rows, np.where(counts > 0, values, 0.0)
+
+
+# the raw measurements as rollup entries (one per measurement)
+def rawRollup(values):
+    values = values.astype(float)
+    valid = ~np.isnan(values)
+    return {"rows": np.ones(values.shape[0], dtype=np.int64), "count": valid.astype(np.int64),
+            "sum": np.where(valid, values, 0.0), "min": values, "max": values}
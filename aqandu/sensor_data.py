@@ -0,0 +1,66 @@
+# Columnar container for the sensor measurements used by the model.
+#
+# The query result used to be turned into one python dict per measurement, and every later stage added a
+# few more keys to each dict.  For a day of regional data that is hundreds of thousands of dicts.  Here
+# each field is a single numpy array instead (one entry per measurement), the stages in utils and
+# gaussian_model_utils work on whole columns, and filtering is done with boolean masks.
+#
+# Columns straight from the query:
+#   ID, SensorModel, SensorSource (object arrays of str), time (datetime64[us], UTC),
+#   PM2_5, Latitude, Longitude (float)
+# Columns added by the processing stages:
+#   utm_x, utm_y, zone_num, type, Altitude, ...
+
+import numpy as np
+from aqandu import measurement_store
+
+
+class SensorData:
+    def __init__(self, columns):
+        self.columns = dict(columns)
+        lengths = {values.shape[0] for values in self.columns.values()}
+        if len(lengths) > 1:
+            raise ValueError(f"Sensor data columns have different lengths {lengths}")
+        self.size = lengths.pop() if lengths else 0
+
+    @classmethod
+    def fromRows(cls, rows, columns=measurement_store.MEASUREMENT_COLUMNS):
+        return cls(measurement_store.rowsToColumns(rows, columns))
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def __setitem__(self, name, values):
+        values = np.asarray(values)
+        if values.shape[0] != self.size:
+            raise ValueError(f"Column {name} has length {values.shape[0]}, expected {self.size}")
+        self.columns[name] = values
+
+    def __contains__(self, name):
+        return name in self.columns
+
+    def columnNames(self):
+        return list(self.columns.keys())
+
+    def select(self, selection):
+        """A new SensorData with only the measurements picked by a boolean mask or an index array"""
+        return SensorData({name: values[selection] for name, values in self.columns.items()})
+
+    def uniqueIDs(self):
+        return np.unique(self.columns["ID"].astype(str))
+
+    # IDs in order of first appearance (the order the old per-dict code discovered devices in) and,
+    # for each measurement, the index of its ID in that list
+    # (a dict lookup per measurement is several times faster than sorting the ID strings)
+    def sensorCodes(self):
+        code_of = {}
+        codes = np.fromiter((code_of.setdefault(sensor_id, len(code_of)) for sensor_id in self.columns["ID"].tolist()),
+                            dtype=np.int64, count=self.size)
+        return np.array([str(sensor_id) for sensor_id in code_of], dtype=str), codes
+
+    def toRecords(self, columns=measurement_store.MEASUREMENT_COLUMNS):
+        """The old list-of-dicts form, e.g. for returning through jsonify"""
+        return [row._asdict() for row in measurement_store.columnsToRows(self.columns, columns)]
@@ -0,0 +1,251 @@
+# The estimate routes' data preparation in one pass over the measurements, for queries too long to hold.
+#
+# The usual pipeline has the whole query in memory as a SensorData, and the screening, correction and
+# binning stages each go over all of it.  Here the store hands the measurements over in time order, in
+# batches of at most BATCH_ROWS (queryBatches), and each batch is joined with the sensor registry (UTM
+# coordinates, elevation, type), restricted to UTM zone 12, corrected, and binned.  Because the batches come
+# in time order, every bin before the last one of a batch is complete, and its readings are reduced right
+# away to the median of each (sensor, bin) cell -- the data matrix entry -- and, for the screening, to an
+# aggregate of each (sensor, day):
+#   count, sum      of the raw (uncorrected) readings, for the daily average
+#   first, last     stream position and sensor registry entry of the first and last measurement
+# Only the readings of the unfinished bin, and of the bins the chunk bounds cut through (which
+# windowDataMatrix recomputes from their measurements), are kept.  So memory grows with the number of
+# cells (16 bytes each), not with the number of measurements.
+#
+# The daily screening (the rules of removeInvalidSensorsColumns) is a second pass, over the day aggregates:
+# the 350 ug/m3 rule on the daily averages, then the 5003 pairing by the first and last entries of the
+# days that rule leaves.  Bins never straddle midnight, so removing a day of a sensor removes whole cells.
+# The result is binAllSensorData of the screened and corrected measurements, except that the daily sums
+# are added up in another order (so can differ in the last bit).
+
+import logging
+import numpy as np
+from aqandu import gaussian_model_utils, measurement_store, utils
+from aqandu.sensor_data import SensorData
+
+
+# cells are labelled bin * CELL_SPAN + sensor code
+CELL_SPAN = 2**32
+DAY_FIELDS = ['days', 'codes', 'counts', 'sums', 'first_positions', 'first_entries', 'last_positions',
+              'last_entries']
+ROW_FIELDS = ['codes', 'bins', 'times', 'raw', 'values', 'positions', 'entries']
+
+
+# the days since the epoch of integer time bins (the day a bin starts in has all of it)
+def binDays(bins):
+    starts = gaussian_model_utils.JANUARY1ST64 + bins * np.timedelta64(gaussian_model_utils.NUM_MINUTES_PER_BIN, 'm')
+    return (starts - utils.EPOCH64) // np.timedelta64(1, 'D')
+
+
+# the positions where the runs of equal values of a sorted array start
+def runStarts(values):
+    if values.shape[0] == 0:
+        return np.zeros(0, dtype=np.int64)
+    return np.flatnonzero(np.concatenate(([True], values[1:] != values[:-1])))
+
+
+def concatenateParts(parts, dtype=np.int64):
+    return np.concatenate(parts) if parts else np.array([], dtype=dtype)
+
+
+# the bins that the sensor time bounds of the chunks (from chunkTimeQueryData) fall in
+def chunkEdgeBins(sensor_time_sequence):
+    bounds = np.array(sensor_time_sequence, dtype=measurement_store.TIME_DTYPE).ravel()
+    return np.unique(gaussian_model_utils.timeBinIndices(bounds))
+
+
+class StreamingBinner:
+    def __init__(self, sensor_registry, correction_factors, kept_bins=()):
+        self.sensor_registry = sensor_registry
+        self.correction_factors = correction_factors
+        self.kept_bins = np.asarray(kept_bins, dtype=np.int64)
+        # sensor codes in order of first appearance, as SensorData.sensorCodes
+        self.code_of = {}
+        self.num_rows = 0
+        self.cells = {'labels': [], 'medians': []}
+        self.days = {name: [] for name in DAY_FIELDS}
+        self.kept_rows = {name: [] for name in ROW_FIELDS}
+        self.pending = None
+
+    def add(self, column_data):
+        """Take the next batch of measurements (a column dict, later in time than the ones before it).
+        Raises ValueError (from the sensor registry) for locations that aren't valid."""
+        sensor_data = SensorData(column_data)
+        sensor_data['ID'] = sensor_data['ID'].astype(str).astype(object)
+        entries = self.sensor_registry.join(sensor_data)
+        in_zone = sensor_data['zone_num'] == 12
+        sensor_data = sensor_data.select(in_zone)
+        num_rows = len(sensor_data)
+        if num_rows == 0:
+            return
+
+        code_of = self.code_of
+        rows = {
+            'codes': np.fromiter(
+                (code_of.setdefault(sensor_id, len(code_of)) for sensor_id in sensor_data['ID'].tolist()),
+                dtype=np.int64, count=num_rows),
+            'bins': gaussian_model_utils.timeBinIndices(sensor_data['time']),
+            'times': sensor_data['time'],
+            'raw': sensor_data['PM2_5'].astype(float),
+            'positions': self.num_rows + np.arange(num_rows),
+            'entries': entries[in_zone],
+        }
+        self.num_rows += num_rows
+        utils.applyCorrectionFactorsColumns(self.correction_factors, sensor_data)
+        rows['values'] = sensor_data['PM2_5'].astype(float)
+
+        if self.pending is not None:
+            if rows['bins'].min() < self.pending['bins'][0]:
+                raise ValueError('Streamed measurements are not in time order')
+            rows = {name: np.concatenate((self.pending[name], rows[name])) for name in ROW_FIELDS}
+        kept = np.isin(rows['bins'], self.kept_bins)
+        if np.any(kept):
+            # only the new rows, the pending ones were looked at with their own batch
+            kept[:rows['codes'].shape[0] - num_rows] = False
+            for name in ROW_FIELDS:
+                self.kept_rows[name].append(rows[name][kept])
+
+        # every bin but the last one is complete
+        complete = rows['bins'] < rows['bins'].max()
+        self.addCells({name: values[complete] for name, values in rows.items()})
+        self.pending = {name: values[~complete] for name, values in rows.items()}
+
+    def addCells(self, rows):
+        if rows['codes'].shape[0] == 0:
+            return
+        cell_labels, medians = gaussian_model_utils.binMedians(rows['bins'] * CELL_SPAN + rows['codes'], rows['values'])
+        self.cells['labels'].append(cell_labels)
+        self.cells['medians'].append(medians)
+
+        # and the screening's aggregates of each (sensor, day), the rows are in stream order
+        day_labels = binDays(rows['bins']) * CELL_SPAN + rows['codes']
+        order = np.argsort(day_labels, kind='stable')
+        starts = runStarts(day_labels[order])
+        ends = np.append(starts[1:], order.shape[0])
+        first = order[starts]
+        last = order[ends - 1]
+        days = {
+            'days': day_labels[first] // CELL_SPAN,
+            'codes': day_labels[first] % CELL_SPAN,
+            'counts': ends - starts,
+            'sums': np.add.reduceat(rows['raw'][order], starts),
+            'first_positions': rows['positions'][first],
+            'first_entries': rows['entries'][first],
+            'last_positions': rows['positions'][last],
+            'last_entries': rows['entries'][last],
+        }
+        for name in DAY_FIELDS:
+            self.days[name].append(days[name])
+
+    def finish(self):
+        """The screened data matrix, in the form binAllSensorData returns (windowDataMatrix takes it), except
+        that only the measurements of the kept bins are in codes, times and values"""
+        if self.pending is not None:
+            self.addCells(self.pending)
+            self.pending = None
+        ids = np.array([str(sensor_id) for sensor_id in self.code_of], dtype=str)
+        num_ids = max(ids.shape[0], 1)
+        entries = self.sensor_registry.entries
+
+        # the aggregates of the same (sensor, day) from different batches, added up
+        days = {name: concatenateParts(self.days.pop(name)) for name in DAY_FIELDS}
+        keys = days['days'] * num_ids + days['codes']
+        order = np.lexsort((days['first_positions'], keys))
+        starts = runStarts(keys[order])
+        ends = np.append(starts[1:], order.shape[0])
+        day_keys = keys[order][starts]
+        day_averages = np.add.reduceat(days['sums'][order], starts) / np.add.reduceat(days['counts'][order], starts)
+        first = order[starts]
+        last = order[ends - 1]
+        days = {
+            'codes': day_keys % num_ids,
+            'first_positions': days['first_positions'][first],
+            'first_entries': days['first_entries'][first],
+            'last_positions': days['last_positions'][last],
+            'last_entries': days['last_entries'][last],
+        }
+
+        # sensor is invalid if its average reading for any day exceeds 350 ug/m3
+        keys_to_remove = utils.highDayKeys(day_keys, day_averages, num_ids)
+        logging.info('Removing these days from data due to exceeding 350 ug/m3 avg: '
+                     f'{utils.dayKeysToTuples(keys_to_remove, ids, num_ids)}')
+        keep = ~np.isin(day_keys, keys_to_remove)
+
+        # 5003 sensors are invalid if Raw 24-hour average PM2.5 levels are > 5 ug/m3
+        # AND the two sensors differ by more than 16%
+        partners = self.match5003Sensors(days, keep, num_ids)
+        keys_to_remove = utils.disagreeingDayKeys(day_keys, day_averages, partners, num_ids)
+        logging.info((
+            "Removing these days from data due to pair of 5003 sensors with both > 5 "
+            "daily reading and smaller is 16% different reading from larger : "
+            f"{utils.dayKeysToTuples(keys_to_remove, ids, num_ids)}"
+        ))
+        keep &= ~np.isin(day_keys, keys_to_remove)
+        days = {name: values[keep] for name, values in days.items()}
+        day_keys = day_keys[keep]
+
+        # rows are the sensors left, in order of first appearance, at the location of their first measurement
+        order = np.lexsort((days['first_positions'], days['codes']))
+        firsts = order[runStarts(days['codes'][order])]
+        firsts = firsts[np.argsort(days['first_positions'][firsts])]
+        row_of_code = np.full(num_ids, -1, dtype=np.int64)
+        row_of_code[days['codes'][firsts]] = np.arange(firsts.shape[0])
+        first_entries = days['first_entries'][firsts]
+        space_coordinates = np.column_stack((entries['utm_x'][first_entries], entries['utm_y'][first_entries],
+                                             entries['Altitude'][first_entries])).astype(float)
+
+        cell_labels = concatenateParts(self.cells.pop('labels'))
+        medians = concatenateParts(self.cells.pop('medians'), float)
+        cell_codes = cell_labels % CELL_SPAN
+        cell_bins = cell_labels // CELL_SPAN
+        kept = np.isin(binDays(cell_bins) * num_ids + cell_codes, day_keys)
+        bin_numbers, columns = np.unique(cell_bins[kept], return_inverse=True)
+        data_matrix = np.full((firsts.shape[0], bin_numbers.shape[0]), -1.0)
+        data_matrix[row_of_code[cell_codes[kept]], columns.reshape(-1)] = medians[kept]
+
+        kept_rows = {name: concatenateParts(values) for name, values in self.kept_rows.items()}
+        kept = np.isin(binDays(kept_rows['bins']) * num_ids + kept_rows['codes'], day_keys)
+        kept_rows = {name: values[kept] for name, values in kept_rows.items()}
+        row_columns = np.searchsorted(bin_numbers, kept_rows['bins'])
+        by_column = np.argsort(row_columns, kind='stable')
+        logging.info(
+            f'Streamed {self.num_rows} measurements into {medians.shape[0]} cells of {firsts.shape[0]} sensors')
+        return {
+            'data_matrix': data_matrix,
+            'space_coordinates': space_coordinates,
+            'bin_numbers': bin_numbers,
+            'bin_hours': gaussian_model_utils.binHours(bin_numbers),
+            'by_column': by_column,
+            'column_starts': np.searchsorted(row_columns[by_column], np.arange(bin_numbers.shape[0] + 1)),
+            'codes': row_of_code[kept_rows['codes']],
+            'times': kept_rows['times'].astype(measurement_store.TIME_DTYPE),
+            'values': kept_rows['values'].astype(float),
+        }
+
+    # utils.match5003Sensors on the sensor days: a sensor is where its last day (of the ones kept) says, and
+    # comes in the order of its first day
+    def match5003Sensors(self, days, keep, num_ids):
+        entries = self.sensor_registry.entries
+        days_5003 = np.flatnonzero(keep & (entries['type'][days['last_entries']] == '5003'))
+        codes = days['codes'][days_5003]
+        if codes.shape[0] == 0:
+            return np.full(num_ids, -1, dtype=np.int64)
+        by_first = days_5003[np.lexsort((days['first_positions'][days_5003], codes))]
+        by_last = days_5003[np.lexsort((days['last_positions'][days_5003], codes))]
+        sorted_codes = days['codes'][by_first]
+        starts = runStarts(sorted_codes)
+        ends = np.append(starts[1:], sorted_codes.shape[0])
+        xs = entries['location_group'][days['last_entries'][by_last[ends - 1]]].astype(float)
+        return utils.pair5003Sensors(sorted_codes[starts], days['first_positions'][by_first[starts]], xs,
+                                     np.zeros(xs.shape[0]), num_ids)
+
+
+def streamBinnedData(store, lat_lo, lat_hi, lon_lo, lon_hi, start_date, end_date, sensor_registry,
+                     correction_factors, kept_bins=(), batch_size=measurement_store.BATCH_ROWS):
+    """binAllSensorData of the screened and corrected measurements in the box, from batches of the store"""
+    binner = StreamingBinner(sensor_registry, correction_factors, kept_bins)
+    for column_data in store.queryBatches(lat_lo, lat_hi, lon_lo, lon_hi, start_date, end_date,
+                                          columns=measurement_store.MEASUREMENT_COLUMNS, batch_size=batch_size):
+        binner.add(column_data)
+    return binner.finish()
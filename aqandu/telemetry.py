@@ -0,0 +1,97 @@
+# Telemetry for the bigquery calls, so we can see which queries drive the latency and the bill.
+#
+# Every query job records its wall time (from submitting the job to having read the last row), the rows
+# returned, the bytes processed (what we are billed for) and whether bigquery answered it from its own
+# result cache.  Calls are grouped by the endpoint that triggered them, and each measure is kept as a
+# histogram with fixed bucket bounds.  The whole thing is served as JSON by /api/metrics.
+
+import bisect
+import threading
+import flask
+
+
+WALL_TIME_BOUNDS = [0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0]
+ROWS_BOUNDS = [10, 100, 1000, 10000, 100000, 1000000]
+BYTES_BOUNDS = [10**6, 10**7, 10**8, 10**9, 10**10, 10**11]
+
+
+class Histogram:
+    def __init__(self, bounds):
+        self.bounds = bounds
+        # counts[i] is the number of values <= bounds[i] (and > bounds[i-1]), the last one is everything bigger
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+
+    def summary(self):
+        buckets = [{"le": bound, "count": count} for bound, count in zip(self.bounds, self.counts)]
+        buckets.append({"le": "inf", "count": self.counts[-1]})
+        return {"count": self.count, "sum": self.total, "buckets": buckets}
+
+
+class EndpointStats:
+    def __init__(self):
+        self.queries = 0
+        self.cache_hits = 0
+        self.errors = 0
+        self.wall_time = Histogram(WALL_TIME_BOUNDS)
+        self.rows = Histogram(ROWS_BOUNDS)
+        self.bytes_processed = Histogram(BYTES_BOUNDS)
+
+    def summary(self):
+        return {
+            "queries": self.queries,
+            "cache_hits": self.cache_hits,
+            "errors": self.errors,
+            "wall_time_seconds": self.wall_time.summary(),
+            "rows": self.rows.summary(),
+            "bytes_processed": self.bytes_processed.summary(),
+        }
+
+
+lock = threading.Lock()
+endpoint_stats = {}
+
+
+def currentEndpoint():
+    """The endpoint handling the current request, or the name of the thread outside of a request"""
+    if flask.has_request_context():
+        return flask.request.endpoint or flask.request.path
+    return "thread:" + threading.current_thread().name
+
+
+def statsFor(endpoint):
+    # must hold the lock
+    if endpoint not in endpoint_stats:
+        endpoint_stats[endpoint] = EndpointStats()
+    return endpoint_stats[endpoint]
+
+
+def recordQuery(endpoint, wall_time, rows, bytes_processed, cache_hit):
+    with lock:
+        stats = statsFor(endpoint)
+        stats.queries += 1
+        stats.cache_hits += 1 if cache_hit else 0
+        stats.wall_time.observe(wall_time)
+        stats.rows.observe(rows)
+        stats.bytes_processed.observe(bytes_processed or 0)
+
+
+def recordJob(query_job, wall_time, rows, endpoint=None):
+    """Record a finished bigquery job"""
+    recordQuery(endpoint or currentEndpoint(), wall_time, rows, query_job.total_bytes_processed, query_job.cache_hit)
+
+
+def recordError(endpoint=None):
+    with lock:
+        statsFor(endpoint or currentEndpoint()).errors += 1
+
+
+def metrics():
+    with lock:
+        return {endpoint: stats.summary() for endpoint, stats in sorted(endpoint_stats.items())}
@@ -10,6 +10,9 @@ import logging
 
 
 DATETIME_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+# sensor data times are naive UTC datetime64 (see sensor_data.py)
+EPOCH64 = np.datetime64('1970-01-01T00:00:00', 'us')
+CORRECTED_SENSOR_TYPES = ['1003', '3003', '5003']
 
 
 def validateDate(dateString):
@@ -24,42 +27,46 @@ def parseDateString(datetime_string):
     """Parse date string into a datetime object"""
     return datetime.strptime(datetime_string, DATETIME_FORMAT).replace(tzinfo=timezone.utc)
 
+
+# the same as a (naive UTC) datetime64, which is what the estimate routes work in
+def parseDateString64(datetime_string):
+    return toDatetime64(parseDateString(datetime_string))
+
+
+# a number of hours as a timedelta64, rounded to the microsecond as timedelta(hours=hours) rounds it
+def hoursToTimedelta64(hours):
+    return np.timedelta64(timedelta(hours=hours), 'us')
+
+
 #  this breaks the time part of the  eatimation/data into pieces to speed up computation
-# sequence_size_mins
-# assumes query_dates are sorted
+# assumes query_dates are sorted.  query_dates is a datetime64 array, the sizes are timedelta or timedelta64.
+# The query is split into num_short_queries pieces of equal length, each piece's query dates are a slice of
+# query_dates (pieces without any query dates are left out), and each gets the sensor data time range of
+# its first and last date widened by time_padding.
 def chunkTimeQueryData(query_dates, time_sequence_size, time_padding):
-    # Careful.  Is the padding in date-time or just integer minutes.
+    query_dates = np.asarray(query_dates, dtype='datetime64[us]')
+    time_sequence_size = np.timedelta64(time_sequence_size, 'us')
+    time_padding = np.timedelta64(time_padding, 'us')
     start_date = query_dates[0]
     end_date = query_dates[-1]
     query_length = (end_date - start_date)
-#    query_length_mins = query_length.total_seconds()/60
     num_short_queries = int(query_length/time_sequence_size)
 # cover the special corner case where the time series is shorter than the specified chunk size
-    if (num_short_queries == 0):
-        query_time_sequence = []
-        query_time_sequence.append(query_dates)
+    if (num_short_queries <= 1):
+        query_time_sequence = [query_dates]
     else:
-        short_query_length = query_length/num_short_queries
-        time_index = 0
-        query_time_sequence = []
-        for i in range(0,num_short_queries - 1):
-            query_time_sequence.append([])
-            while query_dates[time_index] < start_date + (i+1)*short_query_length:
-                query_time_sequence[-1].append(query_dates[time_index])
-                time_index += 1
-# put the last sequence in place
-        query_time_sequence.append([])
-        for i in range(time_index,len(query_dates)):
-            query_time_sequence[-1].append(query_dates[time_index])
-            time_index += 1
+        # divided as timedeltas, which round to the nearest microsecond
+        short_query_length = np.timedelta64(query_length.item() / num_short_queries, 'us')
+        boundaries = start_date + np.arange(1, num_short_queries) * short_query_length
+        query_time_sequence = np.split(query_dates, np.searchsorted(query_dates, boundaries))
+        query_time_sequence = [dates for dates in query_time_sequence if dates.shape[0] > 0]
 
 # now build the endpoints we will need for the sensor data that feeds the estimates of each of these ranges of queries (they overlap)
-    sensor_time_sequence = []
-    for i in range(len(query_time_sequence)):
-        sensor_time_sequence.append([query_time_sequence[i][0] - time_padding, query_time_sequence[i][-1] + time_padding])
+    sensor_time_sequence = [[dates[0] - time_padding, dates[-1] + time_padding] for dates in query_time_sequence]
 
     return sensor_time_sequence, query_time_sequence
 
+
 # Load up elevation grid
 # BE CAREFUL - this object, given the way the data is saved, seems to talk "lxbon-lat" order
 def setupElevationInterpolator(filename):
@@ -120,7 +127,25 @@ def loadLengthScales(filename):
         return length_scales
 
 
-def isQueryInBoundingBox(bounding_box_vertices, query_lat, query_lon):
+# the start and end dates of the length scales as arrays, so the ones for a query can be picked out at once
+def compileLengthScales(scales):
+    compiled = {
+        'start_dates': np.array([toDatetime64(scale['start_date']) for scale in scales], dtype='datetime64[us]'),
+        'end_dates': np.array([toDatetime64(scale['end_date']) for scale in scales], dtype='datetime64[us]'),
+    }
+    for name in ['latlon', 'elevation', 'time']:
+        compiled[name] = np.array([scale[name] for scale in scales], dtype=float)
+    return compiled
+
+
+# getScalesInTimeRange on compiled length scales, returns the indices of the relevant ones
+def lengthScalesInTimeRange(compiled_scales, start_time, end_time):
+    start_time = toDatetime64(start_time)
+    end_time = toDatetime64(end_time)
+    return np.flatnonzero((start_time < compiled_scales['end_dates']) & (end_time >= compiled_scales['start_dates']))
+
+
+def boundingBoxPath(bounding_box_vertices):
     verts = [(0, 0)] * len(bounding_box_vertices)
     for elem in bounding_box_vertices:
         verts[elem[0]] = (elem[2], elem[1])
@@ -129,8 +154,16 @@ def isQueryInBoundingBox(bounding_box_vertices, query_lat, query_lon):
     codes = [Path.MOVETO]
     codes += [Path.LINETO] * (len(verts) - 2)
     codes += [Path.CLOSEPOLY]
-    boundingBox = Path(verts, codes)
-    return boundingBox.contains_point((query_lon, query_lat))
+    return Path(verts, codes)
+
+
+def isQueryInBoundingBox(bounding_box_vertices, query_lat, query_lon):
+    return boundingBoxPath(bounding_box_vertices).contains_point((query_lon, query_lat))
+
+
+# isQueryInBoundingBox for arrays of query locations, with a path built once by boundingBoxPath
+def areQueriesInBoundingBox(bounding_box_path, query_lats, query_lons):
+    return bounding_box_path.contains_points(np.column_stack((query_lons, query_lats)))
 
 
 def removeInvalidSensors(sensor_data):
@@ -204,6 +237,136 @@ def removeInvalidSensors(sensor_data):
     return sensor_data
 
 
+# same rules as removeInvalidSensors, but on a SensorData (whole columns at a time)
+def removeInvalidSensorsColumns(sensor_data):
+    # sensor is invalid if its average reading for any day exceeds 350 ug/m3
+    ids, codes = sensor_data.sensorCodes()
+    num_ids = max(ids.shape[0], 1)
+    days = (sensor_data['time'] - EPOCH64) // np.timedelta64(1, 'D')
+    sensor_data['daysSinceEpoch'] = days
+    # one integer key per (day, sensor), so neighbouring days of a sensor are key -/+ num_ids
+    keys = days * num_ids + codes
+    day_keys, day_counts, day_readings = groupSums(keys, sensor_data['PM2_5'])
+    day_averages = day_readings / day_counts
+
+    # get days that had higher than 350 avg reading
+    keys_to_remove = highDayKeys(day_keys, day_averages, num_ids)
+    logging.info('Removing these days from data due to exceeding 350 ug/m3 avg: '
+                 f'{dayKeysToTuples(keys_to_remove, ids, num_ids)}')
+    keep = ~np.isin(keys, keys_to_remove)
+    sensor_data = sensor_data.select(keep)
+    keys = keys[keep]
+
+    # 5003 sensors are invalid if Raw 24-hour average PM2.5 levels are > 5 ug/m3
+    # AND the two sensors differ by more than 16%
+    partners = match5003Sensors(sensor_data, keys % num_ids, num_ids)
+    keys_to_remove = disagreeingDayKeys(day_keys, day_averages, partners, num_ids)
+    logging.info((
+        "Removing these days from data due to pair of 5003 sensors with both > 5 "
+        "daily reading and smaller is 16% different reading from larger : "
+        f"{dayKeysToTuples(keys_to_remove, ids, num_ids)}"
+    ))
+    sensor_data = sensor_data.select(~np.isin(keys, keys_to_remove))
+
+    # * Otherwise just average the two readings and correct as normal.
+    return sensor_data
+
+
+# The two screening rules on the daily averages of each (day, sensor) key (day_keys sorted, as from
+# groupSums).  Each returns the keys of the days to remove, with the days either side of them.
+def highDayKeys(day_keys, day_averages, num_ids):
+    bad_keys = day_keys[day_averages > 350]
+    return np.concatenate((bad_keys, bad_keys + num_ids, bad_keys - num_ids))
+
+
+# partners is the co-located 5003 sensor of each sensor code (-1 for none), from match5003Sensors
+def disagreeingDayKeys(day_keys, day_averages, partners, num_ids):
+    # the day of the partner sensor for every (day, sensor) that has a partner
+    day_codes = day_keys % num_ids
+    has_partner = partners[day_codes] >= 0
+    keys1 = day_keys[has_partner]
+    keys2 = keys1 - day_codes[has_partner] + partners[day_codes[has_partner]]
+    positions = np.minimum(np.searchsorted(day_keys, keys2), day_keys.shape[0] - 1)
+    found = day_keys[positions] == keys2
+    keys1 = keys1[found]
+    keys2 = keys2[found]
+    reading1 = day_averages[has_partner][found]
+    reading2 = day_averages[positions[found]]
+    maximum = np.maximum(reading1, reading2)
+    minimum = np.minimum(reading1, reading2)
+    disagree = minimum > 5
+    disagree[disagree] = np.abs(reading1 - reading2)[disagree] / maximum[disagree] > 0.16
+    keys1 = keys1[disagree]
+    keys2 = keys2[disagree]
+    return np.concatenate((keys1, keys1 + num_ids, keys1 - num_ids, keys2, keys2 + num_ids, keys2 - num_ids))
+
+
+# the distinct keys (sorted) with the number of values and the sum of the values for each.  The keys of a
+# query are a few days times the sensors, so they are usually counted straight into a dense table (linear
+# time), only a sparse spread of keys is sorted.
+def groupSums(keys, values):
+    if keys.shape[0] == 0:
+        return keys, np.zeros(0, dtype=np.int64), np.zeros(0)
+    lowest = keys.min()
+    span = keys.max() - lowest + 1
+    if span <= 4 * keys.shape[0]:
+        counts = np.bincount(keys - lowest, minlength=span)
+        sums = np.bincount(keys - lowest, weights=values, minlength=span)
+        present = np.flatnonzero(counts)
+        return present + lowest, counts[present], sums[present]
+    unique_keys, key_index = np.unique(keys, return_inverse=True)
+    key_index = key_index.reshape(-1)
+    return unique_keys, np.bincount(key_index), np.bincount(key_index, weights=values)
+
+
+# Co-located 5003 sensors, the same pairing as the nested loop in removeInvalidSensors.  Sensors are at the
+# same place when their (last seen) utm coordinates are exactly equal; they are grouped by sorting on the
+# coordinates (or on the sensor registry's location_group, which numbers the distinct coordinates).  In a
+# group, in order of first appearance, every sensor is paired with the last one and the last one with the one
+# before it.  Returns the partner's code for each sensor code, -1 for no partner.
+def match5003Sensors(sensor_data, codes, num_ids):
+    rows = np.flatnonzero(sensor_data['type'] == '5003')
+    if rows.shape[0] == 0:
+        return np.full(num_ids, -1, dtype=np.int64)
+    sensor_codes, first_rows = np.unique(codes[rows], return_index=True)
+    # the location of a sensor is the one in its last row
+    last_rows = rows.shape[0] - 1 - np.unique(codes[rows][::-1], return_index=True)[1]
+    if 'location_group' in sensor_data:
+        # the sensor registry has already numbered the distinct coordinates
+        xs = sensor_data['location_group'][rows[last_rows]].astype(float)
+        ys = np.zeros(xs.shape[0])
+    else:
+        xs = sensor_data['utm_x'][rows[last_rows]]
+        ys = sensor_data['utm_y'][rows[last_rows]]
+    return pair5003Sensors(sensor_codes, first_rows, xs, ys, num_ids)
+
+
+# the pairing itself, for each 5003 sensor's code, the position of its first row and its location
+def pair5003Sensors(sensor_codes, first_rows, xs, ys, num_ids):
+    partners = np.full(num_ids, -1, dtype=np.int64)
+    # nan is never equal to anything
+    located = ~(np.isnan(xs) | np.isnan(ys))
+    sensor_codes, first_rows, xs, ys = sensor_codes[located], first_rows[located], xs[located], ys[located]
+
+    order = np.lexsort((first_rows, ys, xs))
+    sensor_codes, xs, ys = sensor_codes[order], xs[order], ys[order]
+    new_group = np.concatenate(([True], (xs[1:] != xs[:-1]) | (ys[1:] != ys[:-1])))
+    group_starts = np.flatnonzero(new_group)
+    group_sizes = np.diff(np.append(group_starts, sensor_codes.shape[0]))
+    group_ends = np.repeat(group_starts + group_sizes, group_sizes)
+    paired = np.repeat(group_sizes > 1, group_sizes)
+    partner_positions = group_ends - 1
+    is_last = np.arange(sensor_codes.shape[0]) == group_ends - 1
+    partner_positions[is_last] -= 1
+    partners[sensor_codes[paired]] = sensor_codes[partner_positions[paired]]
+    return partners
+
+
+# (daysSinceEpoch, ID) pairs for logging, like the keys removeInvalidSensors reports
+def dayKeysToTuples(keys, ids, num_ids):
+    return {(int(key // num_ids), ids[key % num_ids]) for key in np.unique(keys)}
+
+
 def applyCorrectionFactor(factors, data_timestamp, data, sensor_type):
     for factor in factors:
         factor_start = factor['start_date']
@@ -221,6 +384,58 @@ def applyCorrectionFactor(factors, data_timestamp, data, sensor_type):
     return np.maximum(data, 0.0)
 
 
+# The correction factor table compiled for applyCorrectionFactorsColumns.  All of the factors' start and
+# end dates, sorted, split time into elementary intervals, and each interval gets the slope and intercept
+# of the first factor (in file order) whose date range contains it, which is the factor
+# applyCorrectionFactor would pick for any time in that interval.  Intervals without a factor, and sensor
+# types without factors, get slope 1 and intercept 0.
+#   boundaries: sorted datetime64 dates
+#   slopes, intercepts: (len(CORRECTED_SENSOR_TYPES) + 1, len(boundaries) + 1) arrays.  Column i is the
+#       interval ending at boundaries[i], the last row is for the types that are never corrected.
+def compileCorrectionFactors(factors):
+    starts = np.array([toDatetime64(factor['start_date']) for factor in factors], dtype='datetime64[us]')
+    ends = np.array([toDatetime64(factor['end_date']) for factor in factors], dtype='datetime64[us]')
+    boundaries = np.unique(np.concatenate((starts, ends)))
+    num_types = len(CORRECTED_SENSOR_TYPES)
+    slopes = np.ones((num_types + 1, boundaries.shape[0] + 1))
+    intercepts = np.zeros((num_types + 1, boundaries.shape[0] + 1))
+    assigned = np.zeros(boundaries.shape[0] + 1, dtype=bool)
+    for factor, start, end in zip(factors, starts, ends):
+        # the intervals [boundaries[i-1], boundaries[i]) that lie inside [start, end)
+        columns = np.arange(np.searchsorted(boundaries, start) + 1, np.searchsorted(boundaries, end) + 1)
+        columns = columns[~assigned[columns]]
+        for type_index, sensor_type in enumerate(CORRECTED_SENSOR_TYPES):
+            slopes[type_index, columns] = factor[sensor_type + '_slope']
+            intercepts[type_index, columns] = factor[sensor_type + '_intercept']
+        assigned[columns] = True
+    return {'boundaries': boundaries, 'slopes': slopes, 'intercepts': intercepts}
+
+
+# applyCorrectionFactor for every measurement in a SensorData at once, with one searchsorted for the
+# factors and one multiply-add.  Readings without a factor are multiplied by 1 and have 0 added, which
+# leaves them exactly as they were, and the products are rounded before the add just like in
+# applyCorrectionFactor (numpy has no fused multiply-add), so the results are bit for bit the same.
+# The one difference: every corrected value is clamped to be >= 0, not only the ones without a factor.
+def applyCorrectionFactorsColumns(compiled_factors, sensor_data):
+    columns = np.searchsorted(compiled_factors['boundaries'], sensor_data['time'], side='right')
+    types = sensor_data['type']
+    type_rows = np.full(types.shape[0], len(CORRECTED_SENSOR_TYPES))
+    for type_index, sensor_type in enumerate(CORRECTED_SENSOR_TYPES):
+        type_rows[types == sensor_type] = type_index
+    slopes = compiled_factors['slopes'][type_rows, columns]
+    intercepts = compiled_factors['intercepts'][type_rows, columns]
+    corrected = sensor_data['PM2_5'] * slopes + intercepts
+    # make sure corrected values are positive
+    sensor_data['PM2_5'] = np.maximum(corrected, 0.0)
+
+
+def toDatetime64(date):
+    """Convert a timezone aware datetime (or a datetime64) into the naive UTC datetime64 used in the sensor data"""
+    if isinstance(date, np.datetime64):
+        return date.astype('datetime64[us]')
+    return np.datetime64(date.astimezone(timezone.utc).replace(tzinfo=None), 'us')
+
+
 def getScalesInTimeRange(scales, start_time, end_time):
     relevantScales = []
     for scale in scales:
@@ -231,14 +446,21 @@ def getScalesInTimeRange(scales, start_time, end_time):
     return relevantScales
 
 
+# the query dates from start to end (both included) every period hours, as a datetime64 array
 def interpolateQueryDates(start_datetime, end_datetime, period):
-    query_dates = []
-    query_date = start_datetime
-    while query_date <= end_datetime:
-        query_dates.append(query_date)
-        query_date = query_date + timedelta(hours=period)
+    start_datetime = toDatetime64(start_datetime)
+    end_datetime = toDatetime64(end_datetime)
+    step = hoursToTimedelta64(period)
+    if step <= np.timedelta64(0, 'us'):
+        raise ValueError(f'The period between query dates must be positive, not {period} hours')
+    num_dates = max((end_datetime - start_datetime) // step + 1, 0)
+    return start_datetime + np.arange(num_dates) * step
+
 
-    return query_dates
+# the query dates as the strings the estimate routes return, like strftime('%Y-%m-%d %H:%M:%S%z') of UTC datetimes
+def formatQueryDates(query_dates):
+    return [date.replace('T', ' ') + '+0000'
+            for date in np.datetime_as_string(np.asarray(query_dates, dtype='datetime64[s]'), unit='s')]
 
 # Not yet sure if this is needed
 # build a grid of coordinates that will consistute the "map"
@@ -274,6 +496,145 @@ def boundingBoxUnion(bbox1, bbox2):
     return min(bbox1[0], bbox2[0]), max(bbox1[1], bbox2[1]), min(bbox1[2], bbox2[2]), max(bbox1[3], bbox2[3])
 
 
+# the array versions of the above.  utm converts a whole array in the zone of its first element, so these
+# split the locations by their own UTM zone (number and letter, as utm would pick them for each location on
+# its own) and convert each zone in one call.  The results are the same as converting one at a time.
+UTM_ZONE_LETTERS = np.array(list("CDEFGHJKLMNPQRSTUVWXX"))
+
+
+def latlonToZones(lats, lons):
+    """UTM zone numbers and letters of each location, as utm.latlon_to_zone_number/latitude_to_zone_letter"""
+    lats = np.asarray(lats, dtype=float)
+    lons = np.asarray(lons, dtype=float)
+    lons = (lons % 360 + 540) % 360 - 180
+    zone_nums = ((lons + 180) / 6).astype(np.int64) + 1
+    # the special zones for Norway and Svalbard
+    zone_nums = np.where((56 <= lats) & (lats < 64) & (3 <= lons) & (lons < 12), 32, zone_nums)
+    svalbard = (72 <= lats) & (lats <= 84) & (0 <= lons) & (lons < 42)
+    zone_nums = np.where(svalbard, np.array([31, 33, 35, 37])[np.searchsorted([9, 21, 33], lons, side='right')],
+                         zone_nums)
+    zone_lets = UTM_ZONE_LETTERS[np.clip((lats + 80).astype(np.int64) >> 3, 0, UTM_ZONE_LETTERS.shape[0] - 1)]
+    return zone_nums, zone_lets
+
+
+def utmZoneGroups(zone_nums, zone_lets):
+    """(zone number, zone letter, index array) for each zone that appears"""
+    # one integer per zone, the number and the letter's character code
+    zone_keys = np.asarray(zone_nums, dtype=np.int64) * 128 + np.asarray(zone_lets, dtype='U1').view(np.uint32)
+    zones, zone_index = np.unique(zone_keys, return_inverse=True)
+    return [(int(zone_key // 128), chr(zone_key % 128), np.flatnonzero(zone_index.reshape(-1) == i))
+            for i, zone_key in enumerate(zones.tolist())]
+
+
+def latlonToUTMArrays(lats, lons, force_zone_number=None):
+    """UTM eastings, northings, zone numbers and zone letters of arrays of lats and lons"""
+    lats = np.asarray(lats, dtype=float).reshape(-1)
+    lons = np.asarray(lons, dtype=float).reshape(-1)
+    E = np.empty(lats.shape[0])
+    N = np.empty(lats.shape[0])
+    zone_nums, zone_lets = latlonToZones(lats, lons)
+    if force_zone_number is not None:
+        zone_nums = np.full(lats.shape[0], force_zone_number, dtype=np.int64)
+    for zone_num, zone_let, index in utmZoneGroups(zone_nums, zone_lets):
+        E[index], N[index], tmp_num, tmp_let = utm.from_latlon(lats[index], lons[index], force_zone_number=zone_num)
+    return E, N, zone_nums, zone_lets
+
+
+def UTMToLatlonArrays(E, N, zone_nums, zone_lets):
+    lats = np.empty(E.shape[0])
+    lons = np.empty(E.shape[0])
+    for zone_num, zone_let, index in utmZoneGroups(zone_nums, zone_lets):
+        lats[index], lons[index] = utm.to_latlon(E[index], N[index], zone_num, zone_let)
+    return lats, lons
+
+
+def latlonBoundingBoxes(lats, lons, distance_meters):
+    """latlonBoundingBox of every location, as four arrays lat_lo, lat_hi, lon_lo, lon_hi"""
+    E, N, zone_nums, zone_lets = latlonToUTMArrays(lats, lons)
+    # the four points of all of the boxes in one go
+    lats4, lons4 = UTMToLatlonArrays(np.concatenate((E, E, E - distance_meters, E + distance_meters)),
+                                     np.concatenate((N - distance_meters, N + distance_meters, N, N)),
+                                     np.tile(zone_nums, 4), np.tile(zone_lets, 4))
+    lats4 = lats4.reshape(4, -1)
+    lons4 = lons4.reshape(4, -1)
+    return lats4[0], lats4[1], lons4[2], lons4[3]
+
+
+# one box that holds the boxes of all of the locations (the union of their latlonBoundingBoxes)
+def latlonBoundingBoxUnion(lats, lons, distance_meters):
+    lat_lo, lat_hi, lon_lo, lon_hi = latlonBoundingBoxes(lats, lons, distance_meters)
+    return lat_lo.min(), lat_hi.max(), lon_lo.min(), lon_hi.max()
+
+
+# Groups query locations so that each group can get its own (small) query and model.  Locations are
+# binned into square UTM cells of size link_distance, and cells that touch (including diagonally) end up in
+# the same group, so any two locations closer than link_distance are always together.  Returns a list of
+# index arrays into lats/lons, ordered by the first location in each group.
+def clusterQueryLocations(lats, lons, link_distance):
+    lats = np.atleast_1d(lats)
+    lons = np.atleast_1d(lons)
+    if lats.shape[0] == 0:
+        return []
+    # everything in the zone of the first location, so that the cells line up across a zone boundary
+    zone_nums, zone_lets = latlonToZones(lats[:1], lons[:1])
+    E, N, zone_nums, zone_lets = latlonToUTMArrays(lats, lons, force_zone_number=int(zone_nums[0]))
+    cells = list(zip(np.floor(E/link_distance).astype(np.int64).tolist(),
+                     np.floor(N/link_distance).astype(np.int64).tolist()))
+
+    # union-find over the occupied cells
+    parent = {cell: cell for cell in cells}
+
+    def find(cell):
+        while parent[cell] != cell:
+            parent[cell] = parent[parent[cell]]
+            cell = parent[cell]
+        return cell
+
+    for cell in parent:
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                neighbor = (cell[0] + dx, cell[1] + dy)
+                if neighbor in parent:
+                    root, neighbor_root = find(cell), find(neighbor)
+                    if root != neighbor_root:
+                        parent[neighbor_root] = root
+
+    groups = {}
+    for i, cell in enumerate(cells):
+        groups.setdefault(find(cell), []).append(i)
+    return [np.array(indices) for indices in groups.values()]
+
+
+# Splits a rows x columns grid (a map) into tiles of about tile_cells x tile_cells cells, each grown by
+# overlap_cells on the sides it shares with another tile.  Returns a list of (row slice, column slice, weights),
+# where weights (the shape of the tile) blend the overlapping tiles: across each shared border (the 2*overlap_cells
+# cells that both tiles cover) one tile's weight ramps down linearly as the other's ramps up, and the weights add
+# up to 1 at every cell of the grid.
+def mapTiles(rows, columns, tile_cells, overlap_cells):
+    def axisTiles(size):
+        count = max(1, int(round(size / float(tile_cells))))
+        edges = np.linspace(0, size, count + 1).round().astype(int)
+        tiles = []
+        for lo, hi in zip(edges[:-1], edges[1:]):
+            first, last = max(0, lo - overlap_cells), min(size, hi + overlap_cells)
+            cells = np.arange(first, last)
+            ramp = np.ones(last - first)
+            if first < lo:
+                ramp = np.minimum(ramp, (cells - first + 0.5) / (2.0*overlap_cells))
+            if last > hi:
+                ramp = np.minimum(ramp, (last - cells - 0.5) / (2.0*overlap_cells))
+            tiles.append((slice(first, last), ramp))
+        return tiles
+
+    tiles = [(row_slice, column_slice, np.outer(row_ramp, column_ramp))
+             for row_slice, row_ramp in axisTiles(rows) for column_slice, column_ramp in axisTiles(columns)]
+    totals = np.zeros((rows, columns))
+    for row_slice, column_slice, weights in tiles:
+        totals[row_slice, column_slice] += weights
+    return [(row_slice, column_slice, weights / totals[row_slice, column_slice])
+            for row_slice, column_slice, weights in tiles]
+
+
 # convenience/wrappers for the utm toolbox
 def latlonToUTM(lat, lon):
     return utm.from_latlon(lat, lon)
@@ -284,3 +645,17 @@ def UTM(E, N, zone_num, zone_let):
 def convertLatLonToUTM(sensor_data):
     for datum in sensor_data:
         datum['utm_x'], datum['utm_y'], datum['zone_num'], zone_let = latlonToUTM(datum['Latitude'], datum['Longitude'])
+
+
+# distinct (lat, lon) pairs and, for every measurement, the index of its pair
+def uniqueLocations(sensor_data):
+    locations = np.column_stack((sensor_data['Latitude'], sensor_data['Longitude']))
+    locations, location_index = np.unique(locations, axis=0, return_inverse=True)
+    return locations, location_index.reshape(-1)
+
+
+# NOTICE - the elevation object takes locations in the form "lon-lat"
+def addElevationColumn(sensor_data, elevation_interpolator):
+    locations, location_index = uniqueLocations(sensor_data)
+    elevations = elevation_interpolator.points(locations[:, 1], locations[:, 0])
+    sensor_data['Altitude'] = elevations[location_index] if elevations.shape[0] > 0 else np.empty(0)
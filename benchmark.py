@@ -0,0 +1,660 @@
+# Benchmarks for the data preparation stages of the estimate pipeline.
+#
+# Runs on synthetic regional data from the fake measurement store, so no credentials or network are
+# needed (the app's config.py and elevation_map.mat still have to be in place, the app is imported).
+# Each benchmark times the current implementation against the original one it replaced and checks
+# that both give the same answer.
+#
+#   python benchmark.py                  # all benchmarks
+#   python benchmark.py screening        # just the ones named
+#   python benchmark.py --days 3 --sensors 100
+
+import argparse
+import logging
+import os
+import time
+from datetime import datetime, timedelta, timezone
+
+os.environ["MEASUREMENT_STORE"] = "fake"
+os.environ["FETCH_CACHE_MAX_MB"] = "0"
+os.environ["LIVE_SNAPSHOT_POLL_SECONDS"] = "0"
+os.environ["SENSOR_REGISTRY_PATH"] = ""
+
+import numpy as np  # noqa: E402
+from aqandu import measurement_store, utils  # noqa: E402
+from aqandu.sensor_data import SensorData  # noqa: E402
+
+
+START = datetime(2020, 7, 1, tzinfo=timezone.utc)
+SENSOR_SOURCE_TO_TYPE = {'AirU': '3003', 'PurpleAir': '5003', 'DAQ': '0000'}
+
+
+def timed(function, *args, repeat=3):
+    """Best of repeat runs (in seconds) and the result of the last one"""
+    best = None
+    for i in range(repeat):
+        started = time.perf_counter()
+        result = function(*args)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+# same is whether the results match, or for an approximation (outcome="error") how far apart they are
+def report(name, old_seconds, new_seconds, same, outcome="same result"):
+    print(f"{name:<24} old {old_seconds:9.3f} s   new {new_seconds:9.3f} s   "
+          f"speedup {old_seconds / new_seconds:8.1f}x   {outcome}: {same}")
+
+
+# the utm columns of sensor_data, as the registry has them for the app -- sensors sit still, so each distinct
+# location is converted once and the result spread over its measurements
+def convertLatLonToUTMColumns(sensor_data):
+    locations, location_index = utils.uniqueLocations(sensor_data)
+    utm_x, utm_y, zone_num, zone_let = utils.latlonToUTMArrays(locations[:, 0], locations[:, 1])
+    sensor_data['utm_x'] = utm_x[location_index]
+    sensor_data['utm_y'] = utm_y[location_index]
+    sensor_data['zone_num'] = zone_num[location_index]
+
+
+# a week (by default) of regional data, with the types and utm coordinates the screening stage needs.
+# The fake sensors are all in different places, so some PurpleAir sensors get a co-located twin (some
+# agreeing, some not) and a few sensor days are pushed over the 350 ug/m3 limit.
+def regionalData(days, sensors):
+    store = measurement_store.FakeStore(num_sensors=sensors)
+    column_data = store.queryColumns(-90, 90, -180, 180, START, START + timedelta(days=days))
+    is_purple = np.flatnonzero(np.isin(column_data["ID"], store.ids[store.sources == "PurpleAir"][::3]))
+    twins = {name: values[is_purple] for name, values in column_data.items()}
+    twins["ID"] = np.array([sensor_id + "B" for sensor_id in twins["ID"]], dtype=object)
+    # every other twin reads 30% high
+    odd = np.array([int(sensor_id[4:9]) % 2 == 1 for sensor_id in twins["ID"]])
+    twins["PM2_5"] = np.where(odd, twins["PM2_5"] * 1.3, twins["PM2_5"] * 1.05)
+    column_data = measurement_store.concatenateColumns([column_data, twins], measurement_store.MEASUREMENT_COLUMNS)
+    day = (column_data["time"] - np.datetime64(START.replace(tzinfo=None), "us")) // np.timedelta64(1, "D")
+    spikes = np.isin(column_data["ID"], store.ids[::17]) & (day == days // 2)
+    column_data["PM2_5"][spikes] = 400.0
+
+    sensor_data = SensorData(column_data)
+    convertLatLonToUTMColumns(sensor_data)
+    sensor_types = np.full(len(sensor_data), '', dtype=object)
+    for source, sensor_type in SENSOR_SOURCE_TO_TYPE.items():
+        sensor_types[sensor_data['SensorSource'] == source] = sensor_type
+    sensor_data['type'] = sensor_types
+    return sensor_data
+
+
+def benchmarkScreening(sensor_data):
+    records = sensor_data.toRecords(sensor_data.columnNames())
+    old_seconds, old_result = timed(utils.removeInvalidSensors, records, repeat=1)
+    new_seconds, new_result = timed(utils.removeInvalidSensorsColumns, sensor_data)
+    old_kept = sorted((record['ID'], record['time']) for record in old_result)
+    new_kept = sorted(zip(new_result['ID'].tolist(), [measurement_store.fromDatetime64(time_value)
+                                                       for time_value in new_result['time']]))
+    report("screening", old_seconds, new_seconds, old_kept == new_kept)
+
+
+def benchmarkCorrection(sensor_data):
+    factors = utils.loadCorrectionFactors('correction_factors.csv')
+    # move the data into a period the factors cover, with some times right on the factor boundaries
+    shift = np.datetime64("2019-06-30T12:00:00", "us") - np.datetime64(START.replace(tzinfo=None), "us")
+    times = sensor_data['time'] + shift
+    times[::1000] = np.datetime64("2019-07-04T00:00:00", "us")
+    records = [(measurement_store.fromDatetime64(time_value), value, sensor_type) for time_value, value, sensor_type
+               in zip(times, sensor_data['PM2_5'].tolist(), sensor_data['type'].tolist())]
+
+    def correctEach():
+        return np.array([utils.applyCorrectionFactor(factors, time_value, value, sensor_type)
+                         for time_value, value, sensor_type in records])
+
+    def correctColumns():
+        corrected = SensorData({'time': times, 'PM2_5': sensor_data['PM2_5'], 'type': sensor_data['type']})
+        utils.applyCorrectionFactorsColumns(utils.compileCorrectionFactors(factors), corrected)
+        return corrected['PM2_5']
+
+    old_seconds, old_result = timed(correctEach, repeat=1)
+    new_seconds, new_result = timed(correctColumns)
+    # the old version only clamped the readings without a factor
+    report("correction factors", old_seconds, new_seconds, np.array_equal(np.maximum(old_result, 0.0), new_result))
+
+
+def benchmarkRegistry(sensor_data):
+    from aqandu import elevation_interpolator
+    from aqandu.registry import SensorRegistry
+    base = SensorData({name: sensor_data[name] for name in measurement_store.MEASUREMENT_COLUMNS})
+
+    def perRequest():
+        joined = SensorData(base.columns)
+        convertLatLonToUTMColumns(joined)
+        utils.addElevationColumn(joined, elevation_interpolator)
+        return joined
+
+    # a registry that has seen these sensors before, as it will have after the first few requests
+    registry = SensorRegistry(elevation_interpolator)
+    registry.join(SensorData(base.columns))
+
+    def fromRegistry():
+        joined = SensorData(base.columns)
+        registry.join(joined)
+        return joined
+
+    old_seconds, old_result = timed(perRequest)
+    new_seconds, new_result = timed(fromRegistry)
+    same = all(np.array_equal(old_result[name], new_result[name]) for name in ['utm_x', 'utm_y', 'zone_num', 'Altitude'])
+    same = same and np.array_equal(sensor_data['type'], new_result['type'])
+    report("sensor registry", old_seconds, new_seconds, same)
+
+
+# the geodesy a map request does before any modeling: the query bounding box of every grid point and
+# the UTM cell that clusters it, for a map_size x map_size grid over the sensors' region
+def benchmarkGeodesy(sensor_data, map_size=200):
+    import utm
+    lat_vector = np.linspace(sensor_data['Latitude'].min(), sensor_data['Latitude'].max(), map_size)
+    lon_vector = np.linspace(sensor_data['Longitude'].min(), sensor_data['Longitude'].max(), map_size)
+    locations_lon, locations_lat = np.meshgrid(lon_vector, lat_vector)
+    lats = locations_lat.flatten()
+    lons = locations_lon.flatten()
+    radius = 8600.0
+
+    def perPoint():
+        bbox = utils.latlonBoundingBox(lats[0], lons[0], radius)
+        for i in range(1, lats.shape[0]):
+            bbox = utils.boundingBoxUnion(utils.latlonBoundingBox(lats[i], lons[i], radius), bbox)
+        E, N, zone_num, zone_let = utm.from_latlon(lats[0], lons[0])
+        cells = []
+        for lat, lon in zip(lats, lons):
+            E, N, tmp_num, tmp_let = utm.from_latlon(lat, lon, force_zone_number=zone_num)
+            cells.append((int(np.floor(E/radius)), int(np.floor(N/radius))))
+        return bbox, cells
+
+    def arrays():
+        bbox = utils.latlonBoundingBoxUnion(lats, lons, radius)
+        zone_nums, zone_lets = utils.latlonToZones(lats[:1], lons[:1])
+        E, N, zone_nums, zone_lets = utils.latlonToUTMArrays(lats, lons, force_zone_number=int(zone_nums[0]))
+        return bbox, list(zip(np.floor(E/radius).astype(np.int64).tolist(), np.floor(N/radius).astype(np.int64).tolist()))
+
+    old_seconds, old_result = timed(perPoint, repeat=1)
+    new_seconds, new_result = timed(arrays)
+    report(f"geodesy ({map_size}x{map_size} map)", old_seconds, new_seconds, old_result == new_result)
+
+
+# loading the elevation map when a worker starts, and looking up the elevations of scattered locations the
+# way the estimate routes did it (one interp2d call per location) against one vectorized call
+def benchmarkElevation(sensor_data, num_points=5000):
+    from aqandu import elevation
+    rng = np.random.default_rng(0)
+    lats = rng.uniform(sensor_data['Latitude'].min(), sensor_data['Latitude'].max(), num_points)
+    lons = rng.uniform(sensor_data['Longitude'].min(), sensor_data['Longitude'].max(), num_points)
+
+    # (the first load converts the .mat, that only happens once)
+    elevation.loadElevationMap('elevation_map.mat')
+    old_seconds, old_map = timed(utils.setupElevationInterpolator, 'elevation_map.mat')
+    new_seconds, new_map = timed(elevation.loadElevationMap, 'elevation_map.mat')
+    # FITPACK fits the same spline for both, up to rounding
+    same = np.allclose(old_map(lons[:100], lats[:100]), new_map(lons[:100], lats[:100]), rtol=0, atol=1e-6)
+    report("elevation cold start", old_seconds, new_seconds, same)
+
+    def eachPoint():
+        return np.array([old_map(lon, lat)[0] for lat, lon in zip(lats, lons)])
+
+    old_seconds, old_result = timed(eachPoint, repeat=1)
+    new_seconds, new_result = timed(new_map.points, lons, lats)
+    report(f"elevation ({num_points} points)", old_seconds, new_seconds, np.allclose(old_result, new_result, rtol=0, atol=1e-6))
+
+
+# the column versions of gaussian_model_utils.createTimeVector, createSpaceVector2 and assignTimeData (with
+# getTimeCoordinateBin for whole arrays) that gaussian_model_utils.binSensorData replaced, to check that one
+# against.  They fill the same device_location_map as the originals, for computeTimeArrays.
+def getTimeCoordinateBins(times, time_offset=0):
+    from aqandu.gaussian_model_utils import JANUARY1ST64, NUM_MINUTES_PER_BIN
+    tmp = ((times - JANUARY1ST64) / np.timedelta64(1, 's')) / 60
+    tmp = np.trunc(tmp / NUM_MINUTES_PER_BIN) * NUM_MINUTES_PER_BIN
+    return tmp / 60 - time_offset
+
+
+# measurements outside the bounds get a bin number of nan
+def createTimeVectorColumns(sensor_data, time_lo_bound=-1.0, time_hi_bound=-1.0):
+    from aqandu.gaussian_model_utils import TIME_COORDINATE_BIN_NUMBER_KEY, timeBoundsMask
+    in_range = timeBoundsMask(sensor_data, time_lo_bound, time_hi_bound)
+    bin_numbers = getTimeCoordinateBins(sensor_data['time'][in_range])
+
+    if bin_numbers.shape[0] == 0:
+        lowest_bin_number = None
+        time_coordinates = np.empty((0, 1))
+    else:
+        lowest_bin_number = bin_numbers.min()
+        bin_numbers = bin_numbers - lowest_bin_number
+        time_coordinates = np.expand_dims(np.unique(bin_numbers), axis=1)
+
+    all_bin_numbers = np.full(len(sensor_data), np.nan)
+    all_bin_numbers[in_range] = bin_numbers
+    sensor_data[TIME_COORDINATE_BIN_NUMBER_KEY] = all_bin_numbers
+
+    return time_coordinates, lowest_bin_number
+
+
+# measurements are sorted by (sensor, bin) so each set is filled in one go
+def assignTimeDataColumns(sensor_data, device_location_map, time_offset, time_lo_bound=-1.0, time_hi_bound=-1.0):
+    from aqandu.gaussian_model_utils import TIME_MAP_INDEX, timeBoundsMask
+    in_range = timeBoundsMask(sensor_data, time_lo_bound, time_hi_bound)
+    ids = sensor_data['ID'][in_range].astype(str)
+    bin_numbers = getTimeCoordinateBins(sensor_data['time'][in_range]) - time_offset
+    values = sensor_data['PM2_5'][in_range]
+
+    order = np.lexsort((bin_numbers, ids))
+    ids = ids[order]
+    bin_numbers = bin_numbers[order]
+    values = values[order]
+    boundaries = np.flatnonzero((ids[1:] != ids[:-1]) | (bin_numbers[1:] != bin_numbers[:-1])) + 1
+    starts = np.concatenate(([0], boundaries)).tolist()
+    ends = np.concatenate((boundaries, [ids.shape[0]])).tolist()
+    for start, end in zip(starts, ends):
+        if end > start:
+            device_location_map[ids[start]][TIME_MAP_INDEX][bin_numbers[start].item()] = set(values[start:end].tolist())
+
+
+# devices keep the order in which they first appear in the data, and the location of a device is the one of its
+# first measurement
+def createSpaceVectorColumns(sensor_data, time_array_size):
+    ids, codes = sensor_data.sensorCodes()
+    unique_codes, first_index = np.unique(codes, return_index=True)
+    space_coordinates = np.column_stack((sensor_data['utm_x'][first_index],
+                                         sensor_data['utm_y'][first_index],
+                                         sensor_data['Altitude'][first_index])).astype(float)
+
+    device_location_map = {}
+    for index, device_id in enumerate(ids.tolist()):
+        # for the meaning of these entries, see the index set at the top of gaussian_model_utils
+        device_location_map[device_id] = [space_coordinates[index, 0], space_coordinates[index, 1],
+                                          space_coordinates[index, 2], index, {},
+                                          np.full((time_array_size), -1.0)]
+
+    return space_coordinates, device_location_map
+
+
+# building the sensors x bins data matrix (before the gap filling) for the whole period.  The old version
+# took the median of the set of readings in a bin, dropping repeated values, so the readings are made
+# distinct first to compare the two.
+def benchmarkBinning(sensor_data):
+    from aqandu import gaussian_model_utils
+    binned = SensorData({name: sensor_data[name] for name in ['ID', 'time', 'utm_x', 'utm_y']})
+    binned['PM2_5'] = sensor_data['PM2_5'] + np.arange(len(sensor_data)) * 1e-9
+    binned['Altitude'] = np.zeros(len(sensor_data))
+
+    def perDevice():
+        time_coordinates, time_offset = createTimeVectorColumns(binned)
+        space_coordinates, device_location_map = createSpaceVectorColumns(
+            binned, time_coordinates.shape[0])
+        assignTimeDataColumns(binned, device_location_map, time_offset)
+        gaussian_model_utils.computeTimeArrays(binned, device_location_map, time_coordinates)
+        data_matrix = np.full((space_coordinates.shape[0], time_coordinates.shape[0]), -1.0)
+        for device in device_location_map.values():
+            data_matrix[device[gaussian_model_utils.SPACE_COORD_INDEX]] = device[gaussian_model_utils.TIME_ARRAY_INDEX]
+        return data_matrix, space_coordinates, time_coordinates, time_offset
+
+    old_seconds, old_result = timed(perDevice, repeat=1)
+    new_seconds, new_result = timed(gaussian_model_utils.binSensorData, binned)
+    same = all(np.array_equal(old, new) for old, new in zip(old_result[:3], new_result[:3]))
+    report("binning", old_seconds, new_seconds, same and old_result[3] == new_result[3])
+
+
+# the original element by element gaussian_model_utils.interpolateBadElements, to check that one against
+def interpolateBadElementsLoop(matrix, bad_value=0):
+    from aqandu.gaussian_model_utils import SENSOR_INTERPOLATE_DISTANCE
+    for row in matrix:
+        prevValueIndex = None
+        for i in range(row.shape[0]):
+            if row[i] != bad_value:
+                if prevValueIndex is None:
+                    prevValueIndex = i
+                    # this takes care of the boundary at the beginning of the time sequence
+                    if (i > 0) and (i < SENSOR_INTERPOLATE_DISTANCE):
+                        row[0:i] = row[i]
+                else:
+                    curValueIndex = i
+                    distance = curValueIndex - prevValueIndex
+                    if (distance > 1) and (distance < SENSOR_INTERPOLATE_DISTANCE):
+                        # interpolate zeros between prev and cur
+                        terp = np.interp(range(prevValueIndex + 1, curValueIndex), [prevValueIndex, curValueIndex],
+                                         [row[prevValueIndex], row[curValueIndex]])
+                        row[prevValueIndex + 1:curValueIndex] = terp
+                        prevValueIndex = curValueIndex
+        # take care of bad values and end of time range
+        if row[-1] == bad_value and prevValueIndex is not None:
+            curValueIndex = row.shape[0] - 1
+            if curValueIndex - prevValueIndex < SENSOR_INTERPOLATE_DISTANCE:
+                row[prevValueIndex + 1:curValueIndex + 1] = row[prevValueIndex]
+
+
+# the original element by element gaussian_model_utils.fillInMissingReadings
+def fillInMissingReadingsLoop(data_matrix, bad_value=0.):
+    data_mask = (data_matrix != bad_value)
+    data_counts = np.sum(data_mask, 0)
+    sum_tmp = np.sum(np.multiply(data_matrix, data_mask), 0)
+    time_averages = np.divide(sum_tmp, data_counts, out=np.zeros_like(sum_tmp), where=(data_counts != 0))
+    for idx in np.ndindex(data_matrix.shape):
+        if data_matrix[idx] == bad_value:
+            data_matrix[idx] = time_averages[idx[1]]
+    return data_matrix
+
+
+# the gap filling on the sensors x bins matrix of the whole period: interpolating the short gaps and then
+# filling what is left with the time slice averages
+def benchmarkGapFill(sensor_data):
+    from aqandu import gaussian_model_utils
+    binned = SensorData({name: sensor_data[name] for name in ['ID', 'time', 'PM2_5', 'utm_x', 'utm_y']})
+    binned['Altitude'] = np.zeros(len(sensor_data))
+    data_matrix = gaussian_model_utils.binSensorData(binned)[0]
+
+    def fill(interpolate, fill_in):
+        filled = data_matrix.copy()
+        interpolate(filled, -1)
+        return fill_in(filled, -1)
+
+    old_seconds, old_result = timed(fill, interpolateBadElementsLoop, fillInMissingReadingsLoop, repeat=1)
+    new_seconds, new_result = timed(fill, gaussian_model_utils.interpolateBadElements,
+                                    gaussian_model_utils.fillInMissingReadings)
+    same = np.array_equal(old_result, new_result)
+    report(f"gap fill ({data_matrix.shape[0]}x{data_matrix.shape[1]})", old_seconds, new_seconds, same)
+    assert same, "interpolateBadElements/fillInMissingReadings differ from the element by element originals"
+
+
+# the data matrices of all of the time chunks of an estimate over the whole period: binning the data again
+# for every chunk, as createModel does, against binning it once and taking each chunk's window
+def benchmarkChunks(sensor_data):
+    from aqandu import gaussian_model_utils
+    from aqandu.api_routes import TIME_KERNEL_FACTOR_PADDING, TIME_SEQUENCE_SIZE
+    binned = SensorData({name: sensor_data[name] for name in ['ID', 'time', 'PM2_5', 'utm_x', 'utm_y']})
+    binned['Altitude'] = np.zeros(len(sensor_data))
+    time_length_scale = 0.25
+    query_dates = utils.interpolateQueryDates(START, START + timedelta(days=int(np.ceil(
+        (sensor_data['time'].max() - sensor_data['time'].min()) / np.timedelta64(1, 'D')))), time_length_scale)
+    sensor_sequence, query_sequence = utils.chunkTimeQueryData(
+        query_dates, timedelta(hours=TIME_SEQUENCE_SIZE*time_length_scale),
+        timedelta(hours=TIME_KERNEL_FACTOR_PADDING*time_length_scale))
+
+    def binEachChunk():
+        return [gaussian_model_utils.binSensorData(binned, lo, hi) for lo, hi in sensor_sequence]
+
+    def windowEachChunk():
+        binned_data = gaussian_model_utils.binAllSensorData(binned)
+        return [gaussian_model_utils.windowDataMatrix(binned_data, lo, hi) for lo, hi in sensor_sequence]
+
+    old_seconds, old_result = timed(binEachChunk, repeat=1)
+    new_seconds, new_result = timed(windowEachChunk)
+    same = all(np.array_equal(old[0], new[0]) and np.array_equal(old[2], new[2]) and old[3] == new[3]
+               for old, new in zip(old_result, new_result))
+    report(f"chunk matrices ({len(sensor_sequence)})", old_seconds, new_seconds, same)
+
+
+# the original utils.chunkTimeQueryData, on lists of datetimes
+def chunkTimeQueryDataLoop(query_dates, time_sequence_size, time_padding):
+    start_date = query_dates[0]
+    end_date = query_dates[-1]
+    query_length = (end_date - start_date)
+    num_short_queries = int(query_length / time_sequence_size)
+    # cover the special corner case where the time series is shorter than the specified chunk size
+    if (num_short_queries == 0):
+        query_time_sequence = [query_dates]
+    else:
+        short_query_length = query_length / num_short_queries
+        time_index = 0
+        query_time_sequence = []
+        for i in range(0, num_short_queries - 1):
+            query_time_sequence.append([])
+            while query_dates[time_index] < start_date + (i + 1) * short_query_length:
+                query_time_sequence[-1].append(query_dates[time_index])
+                time_index += 1
+        # put the last sequence in place
+        query_time_sequence.append(query_dates[time_index:])
+
+    sensor_time_sequence = [[dates[0] - time_padding, dates[-1] + time_padding] for dates in query_time_sequence]
+    return sensor_time_sequence, query_time_sequence
+
+
+# the original utils.interpolateQueryDates, a list of datetimes
+def interpolateQueryDatesLoop(start_datetime, end_datetime, period):
+    query_dates = []
+    query_date = start_datetime
+    while query_date <= end_datetime:
+        query_dates.append(query_date)
+        query_date = query_date + timedelta(hours=period)
+    return query_dates
+
+
+# the query dates of a month of estimates every minute and their time chunks: the lists of datetimes
+# built in a loop, against datetime64 arrays
+def benchmarkQueryDates(sensor_data, days=30, period=1/60):
+    from aqandu.api_routes import TIME_KERNEL_FACTOR_PADDING, TIME_SEQUENCE_SIZE
+    time_length_scale = 0.25
+    end = START + timedelta(days=days)
+
+    def loop():
+        query_dates = interpolateQueryDatesLoop(START, end, period)
+        return query_dates, chunkTimeQueryDataLoop(
+            query_dates, timedelta(hours=TIME_SEQUENCE_SIZE*time_length_scale),
+            timedelta(hours=TIME_KERNEL_FACTOR_PADDING*time_length_scale))
+
+    def vectorized():
+        query_dates = utils.interpolateQueryDates(START, end, period)
+        return query_dates, utils.chunkTimeQueryData(
+            query_dates, utils.hoursToTimedelta64(TIME_SEQUENCE_SIZE*time_length_scale),
+            utils.hoursToTimedelta64(TIME_KERNEL_FACTOR_PADDING*time_length_scale))
+
+    old_seconds, (old_dates, (old_sensor, old_query)) = timed(loop)
+    new_seconds, (new_dates, (new_sensor, new_query)) = timed(vectorized)
+    same = (np.array_equal([utils.toDatetime64(date) for date in old_dates], new_dates) and
+            utils.formatQueryDates(new_dates) == [date.strftime('%Y-%m-%d %H:%M:%S%z') for date in old_dates] and
+            len(old_query) == len(new_query) and
+            all(np.array_equal([utils.toDatetime64(date) for date in old], new) for old, new in zip(old_query, new_query)) and
+            all(np.array_equal([utils.toDatetime64(date) for date in old], new) for old, new in zip(old_sensor, new_sensor)))
+    report(f"query dates ({len(new_dates)})", old_seconds, new_seconds, same)
+    assert same, "interpolateQueryDates/chunkTimeQueryData differ from the originals"
+
+
+# a sensors x bins window of the data from START, and locations a little off some of its sensors to estimate at
+def smallWindow(sensor_data, sensors, bins, locations):
+    import torch
+    from aqandu import gaussian_model_utils
+    binned = SensorData({name: sensor_data[name] for name in ['ID', 'time', 'PM2_5', 'utm_x', 'utm_y']})
+    binned['Altitude'] = np.zeros(len(sensor_data))
+    window_end = START + timedelta(minutes=gaussian_model_utils.NUM_MINUTES_PER_BIN * bins - 1)
+    data_matrix, space_coordinates, time_coordinates, time_offset = gaussian_model_utils.binSensorData(
+        binned, START, window_end)
+    data_matrix, space_coordinates = gaussian_model_utils.cleanDataMatrix(data_matrix, space_coordinates)
+    data_matrix, space_coordinates = data_matrix[:sensors], space_coordinates[:sensors]
+    picked = np.random.default_rng(0).choice(space_coordinates.shape[0], locations, replace=False)
+    query_space = torch.tensor(space_coordinates[picked] + [500.0, 500.0, 0.0])
+    return data_matrix, space_coordinates, time_coordinates, query_space
+
+
+# fitting the model to a sensors x bins window of the data and estimating at a few locations for every bin,
+# with the original dense (S*T) x (S*T) solve against the Kronecker factored one.  The dense solve has to
+# fit in memory, so the window is kept small.
+def benchmarkKronecker(sensor_data, sensors=80, bins=60, locations=20):
+    import torch
+    from aqandu import gaussian_model
+    data_matrix, space_coordinates, time_coordinates, query_space = smallWindow(sensor_data, sensors, bins, locations)
+    query_time = torch.tensor(time_coordinates)
+
+    def estimate(factored):
+        model = gaussian_model.gaussian_model(
+            torch.tensor(space_coordinates), torch.tensor(time_coordinates), torch.tensor(data_matrix),
+            noise_variance=36.0, signal_variance=400.0, time_structured=False, factored=factored)
+        return model(query_space, query_time)
+
+    old_seconds, old_result = timed(estimate, False, repeat=1)
+    new_seconds, new_result = timed(estimate, True)
+    same = (np.allclose(old_result[0].numpy(), new_result[0].numpy(), rtol=1e-9, atol=1e-9) and
+            np.allclose(old_result[1].numpy(), new_result[1].numpy(), rtol=1e-9, atol=1e-6))
+    size = data_matrix.shape[0] * data_matrix.shape[1]
+    report(f"kronecker ({data_matrix.shape[0]}x{data_matrix.shape[1]})", old_seconds, new_seconds, same)
+    print(f"{'  dense matrix':<24} {size}x{size}, {size * size * 8 / 2**20:.0f} MB each")
+
+
+# fitting the model to the whole period as one window and estimating at a few locations at every query time, with
+# the temporal kernel decomposed against the time structured (FFT) solve.  Both solves are exact, so the means and
+# variances have to agree to rounding.  The window has to be long enough for the structured solve (at least
+# gaussian_model.STRUCTURED_MIN_TIMES bins, and STRUCTURED_TIMES_PER_SENSOR per sensor), so use --days 7 or more.
+def benchmarkCirculant(sensor_data, locations=5, time_length_scale=0.25):
+    import torch
+    from aqandu import gaussian_model, gaussian_model_utils
+    from aqandu.api_routes import TIME_KERNEL_FACTOR_PADDING
+    binned = SensorData({name: sensor_data[name] for name in ['ID', 'time', 'PM2_5', 'utm_x', 'utm_y']})
+    binned['Altitude'] = np.zeros(len(sensor_data))
+    binned_data = gaussian_model_utils.binAllSensorData(binned)
+    days = int(np.ceil((sensor_data['time'].max() - sensor_data['time'].min()) / np.timedelta64(1, 'D')))
+    query_dates = utils.interpolateQueryDates(START, START + timedelta(days=days), time_length_scale)
+    time_padding = utils.hoursToTimedelta64(TIME_KERNEL_FACTOR_PADDING*time_length_scale)
+    window = gaussian_model_utils.windowDataMatrix(binned_data, query_dates[0] - time_padding,
+                                                   query_dates[-1] + time_padding)
+    picked = np.random.default_rng(0).choice(binned_data['space_coordinates'].shape[0], locations, replace=False)
+    query_space = torch.tensor(binned_data['space_coordinates'][picked] + [500.0, 500.0, 0.0])
+
+    def estimate(data_matrix, space_coordinates, time_coordinates, time_offset, time_structured):
+        model, status = gaussian_model_utils.createModelFromDataMatrix(
+            data_matrix.copy(), space_coordinates, time_coordinates, 4300., 30., time_length_scale,
+            time_structured=time_structured)
+        query_time = torch.tensor(
+            gaussian_model_utils.convertToTimeCoordinatesVector(query_dates, time_offset).reshape(-1, 1))
+        return model, model(query_space, query_time)
+
+    old_seconds, (old_model, old_result) = timed(estimate, *window, False)
+    new_seconds, (new_model, new_result) = timed(estimate, *window, True)
+    size = f"{old_model.stData.shape[0]}x{old_model.stData.shape[1]}"
+    if new_model.time_step is None:
+        needed = max(gaussian_model.STRUCTURED_MIN_TIMES,
+                     gaussian_model.STRUCTURED_TIMES_PER_SENSOR*old_model.stData.shape[0])
+        print(f"{'circulant':<24} skipped, the {size} window is too short for the structured solve ({needed} bins)")
+        return
+    same_mean = np.allclose(old_result[0].numpy(), new_result[0].numpy(), rtol=0, atol=1e-6)
+    same = same_mean and np.allclose(old_result[1].numpy(), new_result[1].numpy(), rtol=0, atol=1e-4)
+    report(f"circulant ({size})", old_seconds, new_seconds, same)
+    assert same, "the time structured solve differs from the eigen decomposition"
+
+
+# a getEstimateMap grid over the whole region at one date: one model of every sensor for all of the cells, against
+# estimateMapTiles.  A tile's models only see the sensors within MAP_TILE_RADIUS_FACTOR length scales of the
+# tile, so the tiled map is an approximation that differs by what the sensors beyond it contribute.  The largest
+# and the mean absolute differences of the estimates are reported rather than a same result.
+def benchmarkTiles(sensor_data, lat_size=200, lon_size=200, tile_cells=50, overlap_cells=2, length_scales=(4300., 30., 0.25)):
+    from aqandu import gaussian_model_utils
+    from aqandu.api_routes import (MAP_TILE_RADIUS_FACTOR, TIME_KERNEL_FACTOR_PADDING, TIME_SEQUENCE_SIZE,
+                                   estimateFromBinnedData, estimateMapTiles)
+    binned = SensorData({name: sensor_data[name] for name in ['ID', 'time', 'PM2_5', 'utm_x', 'utm_y']})
+    binned['Altitude'] = np.zeros(len(sensor_data))
+    binned_data = gaussian_model_utils.binAllSensorData(binned)
+    lat_vector = np.linspace(sensor_data['Latitude'].min(), sensor_data['Latitude'].max(), lat_size)
+    lon_vector = np.linspace(sensor_data['Longitude'].min(), sensor_data['Longitude'].max(), lon_size)
+    elevations = np.zeros((lat_size, lon_size))
+    days = int(np.ceil((sensor_data['time'].max() - sensor_data['time'].min()) / np.timedelta64(1, 'D')))
+    query_dates = np.array([utils.toDatetime64(START + timedelta(days=days / 2.0))])
+    sensor_sequence, query_sequence = utils.chunkTimeQueryData(
+        query_dates, utils.hoursToTimedelta64(TIME_SEQUENCE_SIZE*length_scales[2]),
+        utils.hoursToTimedelta64(TIME_KERNEL_FACTOR_PADDING*length_scales[2]))
+    radius = MAP_TILE_RADIUS_FACTOR*length_scales[0]
+
+    def whole(variance):
+        locations_lon, locations_lat = np.meshgrid(lon_vector, lat_vector)
+        return estimateFromBinnedData(binned_data, sensor_sequence, query_sequence, locations_lat.flatten(),
+                                      locations_lon.flatten(), elevations.flatten(), *length_scales, variance)
+
+    def tiled(variance):
+        return estimateMapTiles(binned_data, sensor_sequence, query_sequence, lat_vector, lon_vector, elevations,
+                                radius, *length_scales, variance, tile_cells, overlap_cells)
+
+    for variance in [True, False]:
+        old_seconds, old_result = timed(whole, variance)
+        new_seconds, new_result = timed(tiled, variance)
+        difference = np.abs(old_result[0] - new_result[0])
+        report(f"tiles ({lat_size}x{lon_size}{'' if variance else ', mean'})", old_seconds, new_seconds,
+               f"max {difference.max():.3g}, mean {difference.mean():.2g}", outcome="approximation error")
+        if variance:
+            variance_difference = np.abs(old_result[1] - new_result[1])
+            print(f"{'  variance error':<24} max {variance_difference.max():.3g}, "
+                  f"mean {variance_difference.mean():.2g}")
+    print(f"{'  estimates':<24} up to {np.abs(old_result[0]).max():.3g}, "
+          f"{len(utils.mapTiles(lat_size, lon_size, tile_cells, overlap_cells))} tiles, "
+          f"{binned_data['space_coordinates'].shape[0]} sensors")
+
+
+# data preparation for an estimate over the whole period: loading the query and then screening, correcting
+# and binning it (binClusterData), against streaming it batch by batch through the same stages.  Also
+# reports the peak memory allocated by each (as traced by tracemalloc).
+def benchmarkStreaming(sensor_data, batch_size=measurement_store.BATCH_ROWS):
+    import tracemalloc
+    from aqandu import elevation_interpolator, gaussian_model_utils, streaming
+    from aqandu.registry import SensorRegistry
+    stored = {name: sensor_data[name] for name in measurement_store.MEASUREMENT_COLUMNS}
+    factors = utils.compileCorrectionFactors(utils.loadCorrectionFactors('correction_factors.csv'))
+    registry = SensorRegistry(elevation_interpolator)
+    registry.join(SensorData(dict(stored)))
+
+    # hands out copies, as a store reading them from somewhere would
+    class ColumnStore:
+        def queryColumns(self, *args, columns=None):
+            return {name: values.copy() for name, values in stored.items()}
+
+        def queryBatches(self, *args, columns=None, batch_size=batch_size):
+            for batch in measurement_store.sliceColumns(stored, batch_size):
+                yield {name: values.copy() for name, values in batch.items()}
+
+    def loadAll():
+        loaded = SensorData(ColumnStore().queryColumns())
+        loaded['ID'] = loaded['ID'].astype(str).astype(object)
+        registry.join(loaded)
+        loaded = loaded.select(loaded['zone_num'] == 12)
+        loaded = utils.removeInvalidSensorsColumns(loaded)
+        utils.applyCorrectionFactorsColumns(factors, loaded)
+        return gaussian_model_utils.binAllSensorData(loaded)
+
+    def stream():
+        return streaming.streamBinnedData(ColumnStore(), -90, 90, -180, 180, START, START, registry, factors,
+                                          batch_size=batch_size)
+
+    def peakMemory(function):
+        tracemalloc.start()
+        function()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return peak
+
+    old_seconds, old_result = timed(loadAll)
+    new_seconds, new_result = timed(stream)
+    same = all(np.array_equal(old_result[name], new_result[name])
+               for name in ['data_matrix', 'space_coordinates', 'bin_numbers'])
+    report(f"streaming ({batch_size} rows)", old_seconds, new_seconds, same)
+    print(f"{'  peak memory':<24} old {peakMemory(loadAll) / 2**20:7.1f} MB   new {peakMemory(stream) / 2**20:7.1f} MB")
+
+
+BENCHMARKS = {
+    "screening": benchmarkScreening,
+    "correction": benchmarkCorrection,
+    "registry": benchmarkRegistry,
+    "geodesy": benchmarkGeodesy,
+    "elevation": benchmarkElevation,
+    "binning": benchmarkBinning,
+    "gapfill": benchmarkGapFill,
+    "chunks": benchmarkChunks,
+    "querydates": benchmarkQueryDates,
+    "kronecker": benchmarkKronecker,
+    "circulant": benchmarkCirculant,
+    "tiles": benchmarkTiles,
+    "streaming": benchmarkStreaming,
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the estimate pipeline's data preparation stages")
+    parser.add_argument("benchmarks", nargs="*", help=f"which of {list(BENCHMARKS)} to run (default all)")
+    parser.add_argument("--days", type=int, default=7, help="days of data (default 7)")
+    parser.add_argument("--sensors", type=int, default=200, help="number of fake sensors (default 200)")
+    args = parser.parse_args()
+    unknown = [name for name in args.benchmarks if name not in BENCHMARKS]
+    if unknown:
+        parser.error(f"unknown benchmarks {unknown}, must be in {list(BENCHMARKS)}")
+    # the stages log every sensor day they drop
+    logging.disable(logging.INFO)
+
+    data = regionalData(args.days, args.sensors)
+    print(f"{len(data)} measurements from {len(data.uniqueIDs())} sensors over {args.days} days")
+    for name in args.benchmarks or list(BENCHMARKS):
+        BENCHMARKS[name](data)